@@ -0,0 +1,176 @@
+import csv
+import gzip
+import io
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+
+import streamlit as st
+
+from result_store import csv_header, csv_row, make_sink, writer_status
+
+# 管理者用の結果エクスポート。
+# 結果ファイル全体をページ表示のたびに st.download_button に渡すのをやめ、
+# ボタンが押されたときだけ、条件に合う行をチャンクごとに一時ファイルへ書き出す。
+# ダウンロードボタンはファイルを開かず、押されたときに一時ファイルを読んで渡し、渡したら消す。
+
+CHUNK_ROWS = 1000
+EXPORT_PREFIX = "quiz_export_"
+EXPORT_MAX_AGE = 3600    # ダウンロードされずに残った一時ファイルを消すまでの秒数
+
+
+@dataclass(frozen=True)
+class ExportFilter:
+    start_date: str = ""     # "YYYY-MM-DD"（空なら制限なし）
+    end_date: str = ""
+    user_prefix: str = ""    # 研修IDの前方一致
+    quiz: str = ""           # クイズファイル名（空ならすべて）
+
+    def matches(self, record):
+        day = record.timestamp[:10]
+        if self.start_date and day < self.start_date:
+            return False
+        if self.end_date and day > self.end_date:
+            return False
+        if self.user_prefix and not record.user_id.startswith(self.user_prefix):
+            return False
+        # 再採点・修了証と同じく、QUIZ_DIR の有無でパスが違ってもファイル名で比べる
+        if self.quiz and os.path.basename(record.quiz) != os.path.basename(self.quiz):
+            return False
+        return True
+
+
+def iter_chunks(records, export_filter, chunk_rows=CHUNK_ROWS):
+    chunk = []
+    for record in records:
+        if export_filter.matches(record):
+            chunk.append(record)
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def write_export(out, records, export_filter, chunk_rows=CHUNK_ROWS):
+    # out はテキストストリーム。書き出した行数を返す
+    writer = csv.writer(out)
+    count = 0
+    for chunk in iter_chunks(records, export_filter, chunk_rows):
+        if count == 0:
+            writer.writerow(csv_header(chunk[0]))
+        writer.writerows(csv_row(record) for record in chunk)
+        count += len(chunk)
+    return count
+
+
+def export_results(export_filter, compress=False, sink=None):
+    # 条件に合う行を一時ファイルに書き出し、(パス, 行数) を返す
+    sink = sink or make_sink()
+    fd, path = tempfile.mkstemp(prefix=EXPORT_PREFIX, suffix=".csv.gz" if compress else ".csv")
+    with os.fdopen(fd, "wb") as raw:
+        stream = gzip.GzipFile(fileobj=raw, mode="wb") if compress else raw
+        with io.TextIOWrapper(stream, encoding="utf-8-sig", newline="") as out:
+            count = write_export(out, sink.iter_records(), export_filter)
+    return path, count
+
+
+def _discard_previous_export():
+    previous = st.session_state.pop("admin_export", None)
+    if previous and os.path.exists(previous["path"]):
+        os.remove(previous["path"])
+
+
+def _sweep_exports():
+    # ダウンロードされないまま管理者のセッションが終わった一時ファイルを消す
+    directory = tempfile.gettempdir()
+    cutoff = time.time() - EXPORT_MAX_AGE
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith(EXPORT_PREFIX):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _serve_once(path):
+    # download_button に渡す。押されたときにだけ読み、渡したら一時ファイルを消す
+    def read():
+        with open(path, "rb") as f:
+            data = f.read()
+        os.remove(path)
+        return data
+    return read
+
+
+def show_writer_status():
+    # このプロセスの結果の書き込みで失敗があれば知らせる（退避先に残っている件数も）
+    status = writer_status()
+    if status is None or not (status["failed_batches"] or status["spilled"] or status["lost"]):
+        return
+    if status["lost"]:
+        st.error(f"結果の保存に失敗し、{status['lost']}件を退避もできませんでした。")
+    if status["spilled"]:
+        st.error(f"保存できなかった{status['spilled']}件を {status['spill_path']} に退避しています（保存先に書けるようになれば書き戻します）。")
+    if status["failing"]:
+        st.error("結果の保存が失敗し続けています。保存先のディスクの空きやロックを確認してください。")
+    st.caption(f"書き込みに失敗したバッチ: {status['failed_batches']}件　直近のエラー: {status['last_error']}")
+
+
+def show_admin_download():
+    st.title("管理者用ダウンロード画面")
+    show_writer_status()
+    sink = make_sink()
+    if not os.path.exists(sink.path):
+        st.info("結果ファイルがまだありません。")
+        return
+
+    # フォームにしておくと、条件を入力している間は再実行されない
+    with st.form("export_form"):
+        col1, col2 = st.columns(2)
+        start_date = col1.date_input("開始日", value=None)
+        end_date = col2.date_input("終了日", value=None)
+        user_prefix = st.text_input("研修ID（前方一致）")
+        quiz = st.text_input("クイズ（例: quiz_data_v4.json、空欄ならすべて）")
+        compress = st.checkbox("gzip で圧縮する")
+        submitted = st.form_submit_button("エクスポートを作成")
+
+    if submitted:
+        _discard_previous_export()
+        _sweep_exports()
+        export_filter = ExportFilter(
+            start_date=start_date.isoformat() if start_date else "",
+            end_date=end_date.isoformat() if end_date else "",
+            user_prefix=user_prefix.strip(),
+            quiz=quiz.strip(),
+        )
+        with st.spinner("エクスポートを作成しています..."):
+            path, count = export_results(export_filter, compress=compress, sink=sink)
+        if count == 0:
+            os.remove(path)
+        st.session_state["admin_export"] = {"path": path, "count": count, "compress": compress}
+
+    export = st.session_state.get("admin_export")
+    if export is None:
+        return
+    if export["count"] == 0:
+        st.warning("条件に合う結果がありません。")
+        return
+    if not os.path.exists(export["path"]):
+        # ダウンロード済み（もう一度ダウンロードするときはエクスポートを作り直す）
+        return
+    st.success(f"{export['count']}件の結果をエクスポートしました。")
+    st.download_button(
+        label="結果CSVをダウンロード",
+        data=_serve_once(export["path"]),
+        file_name="quiz_result.csv.gz" if export["compress"] else "quiz_result.csv",
+        mime="application/gzip" if export["compress"] else "text/csv"
+    )
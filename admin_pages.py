@@ -0,0 +1,31 @@
+import streamlit as st
+
+from admin_export import show_admin_download
+from quiz_analytics import show_admin_analytics
+from quiz_history import show_history
+from quiz_live import show_live_monitor
+
+# 管理者・講師用の画面の振り分け。各アプリと quiz_app.py の main() の最初で呼ぶ。
+#   ?admin=1                  結果のダウンロードと設問別の分析
+#   ?admin=1&history=<研修ID>  研修IDごとの受験履歴（管理者用画面と同じく admin=1 のときだけ）
+#   ?admin=live               講師用のライブモニター
+
+
+def show_admin_pages():
+    # 管理者・講師用の画面を表示したら True（受講の画面は出さない）
+    admin = st.query_params.get("admin", "")
+    if admin == "1":
+        history_id = st.query_params.get("history", "")
+        if history_id:
+            show_history(history_id)
+            return True
+        tab_download, tab_analytics = st.tabs(["ダウンロード", "分析"])
+        with tab_download:
+            show_admin_download()
+        with tab_analytics:
+            show_admin_analytics()
+        return True
+    if admin == "live":
+        show_live_monitor()
+        return True
+    return False
@@ -0,0 +1,115 @@
+import hashlib
+import io
+import os
+import threading
+from dataclasses import dataclass
+
+import streamlit as st
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# バナー画像をプロセス起動後に一度だけデコードし、幅の違う WebP / JPEG を static/ に書き出す。
+# ファイル名に内容ハッシュを含めるので、ブラウザは同じ URL を使い回してキャッシュできる。
+# 静的ファイル配信（server.enableStaticServing）が無効なときは従来どおり st.image で表示する。
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_URL = "app/static"
+BANNER_WIDTHS = (480, 960, 1440)
+# (拡張子, Pillow の形式, MIME タイプ, 保存オプション)
+FORMATS = (
+    ("webp", "WEBP", "image/webp", {"quality": 80, "method": 6}),
+    ("jpg", "JPEG", "image/jpeg", {"quality": 82, "optimize": True, "progressive": True}),
+)
+
+
+@dataclass(frozen=True)
+class ImageVariants:
+    alt: str
+    width: int
+    height: int
+    files: tuple    # ((拡張子, 幅, ファイル名), ...)
+
+    def srcset(self, ext):
+        return ", ".join(f"{STATIC_URL}/{name} {w}w" for e, w, name in self.files if e == ext)
+
+    def fallback(self):
+        # srcset を解釈しないブラウザ向けの、いちばん大きい JPEG
+        return [name for e, _, name in self.files if e == "jpg"][-1]
+
+    def html(self):
+        sources = "".join(
+            f"<source type='{mime}' srcset='{self.srcset(ext)}' sizes='100vw'>"
+            for ext, _, mime, _ in FORMATS if ext != "jpg"
+        )
+        return (
+            f"<picture>{sources}"
+            f"<img src='{STATIC_URL}/{self.fallback()}' srcset='{self.srcset('jpg')}' sizes='100vw' "
+            f"width='{self.width}' height='{self.height}' alt='{self.alt}' "
+            f"style='width:100%;height:auto;'>"
+            f"</picture>"
+        )
+
+
+def _save_atomic(image, path, fmt, options):
+    # 複数プロセスが同時に作っても壊れたファイルを配信しないよう、書き終えてから差し替える
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    image.save(tmp_path, fmt, **options)
+    os.replace(tmp_path, path)
+
+
+def build_variants(src, static_dir=STATIC_DIR, widths=BANNER_WIDTHS):
+    with open(src, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    base = os.path.splitext(os.path.basename(src))[0]
+    # Image.open はヘッダーだけを読むので、サイズの確認だけならデコードは走らない
+    image = Image.open(io.BytesIO(data))
+    original_width, original_height = image.size
+    # 元画像より大きくは拡大しない
+    targets = sorted({min(w, original_width) for w in widths})
+
+    os.makedirs(static_dir, exist_ok=True)
+    decoded = None
+    files = []
+    for width in targets:
+        height = round(original_height * width / original_width)
+        for ext, fmt, _, options in FORMATS:
+            name = f"{base}-{digest}-{width}.{ext}"
+            path = os.path.join(static_dir, name)
+            if not os.path.exists(path):
+                if decoded is None:
+                    decoded = image.convert("RGB")
+                resized = decoded if width == original_width else decoded.resize((width, height), Image.LANCZOS)
+                _save_atomic(resized, path, fmt, options)
+            files.append((ext, width, name))
+    return ImageVariants(base, original_width, original_height, tuple(files))
+
+
+_lock = threading.Lock()
+_variants = {}
+
+
+def get_variants(src):
+    # 使えないとき（Pillow がない、静的配信が無効）は None
+    if Image is None or not st.get_option("server.enableStaticServing"):
+        return None
+    if src not in _variants:
+        with _lock:
+            if src not in _variants:
+                try:
+                    _variants[src] = build_variants(src)
+                except OSError as e:
+                    print(f"バナー画像の変換に失敗しました: {e}")
+                    _variants[src] = None
+    return _variants[src]
+
+
+def show_banner(src):
+    variants = get_variants(src)
+    if variants is None:
+        st.image(src, width="stretch")
+    else:
+        st.markdown(variants.html(), unsafe_allow_html=True)
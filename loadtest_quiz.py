@@ -0,0 +1,448 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 同時受講者の負荷試験。
+# N 人の受講者が考える時間を挟みながらランダムに回答し、クイズを最後まで進めてやり直すまでを繰り返す。
+# 操作（answer / next / finish / retry）ごとの応答時間の p50/p95/p99、1秒あたりの再実行数、最大メモリを出す。
+# 回数の制限（QUIZ_TRANSITION_RATE）で受け付けられなかった押下は answer / next に数えず、throttled に分ける。
+#
+#   python loadtest_quiz.py --app v4 --learners 20 --attempts 2
+#   python loadtest_quiz.py --app v2 --driver websocket --launch --learners 50
+#
+# apptest ドライバーは streamlit.testing.v1.AppTest でスクリプトをこのプロセス内で実行する（サーバー不要）。
+# AppTest は実行のたびにプロセス共通のランタイムを差し替えるため、同時に実行できるのは1つだけ。
+# 受講者は並行して考え、再実行は1つずつ順に処理する（応答時間には順番待ちを含めない）。
+# websocket ドライバーは起動中のサーバー（--launch なら自分で起動）に /_stcore/stream で接続し、
+# ブラウザと同じ BackMsg を送る。こちらは websockets パッケージが必要。
+# 結果・操作ログ・進行状況・受験履歴・クイズの版・修了証・アウトボックス・分析の集計は一時ディレクトリに書くので、
+# 本番のファイルには混ざらない。QUIZ_WEBHOOKS は外すので、外部への通知も送らない。
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APPS = {
+    "v4": ("streamlit_quiz_v4.py", "quiz_data_v4.json"),
+    "v2": ("streamlit_quiz_v2.py", "quiz_data_v2.json"),
+}
+TRANSITIONS = ("answer", "next", "finish", "retry", "throttled")
+ANSWER_LABEL = "回答する"
+NEXT_LABELS = ("次へ", "スタート")
+RETRY_LABELS = ("再チャレンジ", "再挑戦", "終了")
+MAX_CLICKS = 200    # 1回の受講でこれ以上押しても終わらなければ打ち切る
+
+
+class Recorder:
+    # 受講者のスレッド（タスク）から操作ごとの所要時間を集める
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {name: [] for name in TRANSITIONS}
+        self.errors = []
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def add(self, transition, seconds):
+        with self._lock:
+            self.latencies[transition].append(seconds)
+
+    def error(self, learner, message):
+        with self._lock:
+            self.errors.append(f"受講者{learner}: {message}")
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+
+def percentile(values, p):
+    # 最近傍順位法（値がなければ None）
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def choose_transition(labels, rng):
+    # 画面にあるボタンから次に押すものを決め、(ボタン名, 操作の種類) を返す
+    if ANSWER_LABEL in labels:
+        return ANSWER_LABEL, "answer"
+    for label in NEXT_LABELS:
+        if label in labels:
+            return label, "next"
+    retry = [label for label in RETRY_LABELS if label in labels]
+    if retry:
+        return rng.choice(retry), "retry"
+    return None, None
+
+
+def on_result_screen(labels):
+    # 結果画面か。v4 の満点の画面にはやり直しのボタンがないので、ボタンが1つもない画面も結果画面とみなす
+    return not labels or any(label in RETRY_LABELS for label in labels)
+
+
+def think(rng, args):
+    time.sleep(rng.uniform(args.think_min, args.think_max))
+
+
+# --- AppTest ドライバー ---
+
+_apptest_lock = threading.Lock()
+
+
+def _timed_run(at):
+    with _apptest_lock:
+        start = time.perf_counter()
+        at.run()
+        return time.perf_counter() - start
+
+
+def run_apptest_learner(n, args, recorder):
+    from streamlit.testing.v1 import AppTest
+
+    from quiz_session import THROTTLE_MESSAGE
+
+    rng = random.Random(args.seed * 100003 + n)
+    script, _ = APPS[args.app]
+    at = AppTest.from_file(os.path.join(BASE_DIR, script), default_timeout=args.timeout)
+    at.query_params["user_id"] = f"load{n:04d}"
+    _timed_run(at)
+    for _ in range(args.attempts):
+        on_result = False
+        for _ in range(MAX_CLICKS):
+            if at.exception:
+                recorder.error(n, at.exception[0].message)
+                return
+            labels = [b.label for b in at.button]
+            label, transition = choose_transition(labels, rng)
+            if label is None:
+                if on_result:
+                    # やり直せない結果画面（v4 の満点）まで進んだので、この受講者は終わり
+                    return
+                recorder.error(n, f"押せるボタンがありません: {labels}")
+                return
+            think(rng, args)
+            if transition == "answer":
+                for checkbox in at.checkbox:
+                    checkbox.set_value(rng.random() < args.check_rate)
+            next(b for b in at.button if b.label == label).click()
+            seconds = _timed_run(at)
+            if any(toast.value == THROTTLE_MESSAGE for toast in at.toast):
+                # 受け付けられなかった押下は同じ画面のまま。answer / next には数えない
+                recorder.add("throttled", seconds)
+                continue
+            # 押した結果、結果画面が出たら finish として数える
+            reached = on_result_screen([b.label for b in at.button])
+            if transition == "retry":
+                recorder.add("retry", seconds)
+                break
+            recorder.add("finish" if reached and not on_result else transition, seconds)
+            on_result = reached
+
+
+def run_apptest(args, recorder):
+    # 受講者のスレッドから AppTest を操作すると出る警告（動作には関係しない）を抑える
+    # （streamlit がログレベルを設定し直すので、レベルではなくフィルターで落とす）
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(
+        lambda record: "missing ScriptRunContext" not in record.getMessage()
+    )
+    with ThreadPoolExecutor(max_workers=args.learners) as pool:
+        futures = [pool.submit(run_apptest_learner, n, args, recorder) for n in range(args.learners)]
+        for n, future in enumerate(futures):
+            try:
+                future.result()
+            except Exception as e:
+                recorder.error(n, repr(e))
+
+
+# --- websocket ドライバー ---
+
+class StreamlitClient:
+    # ブラウザの代わりに BackMsg を送り、ForwardMsg から画面上のボタンとチェックボックスを拾う
+    def __init__(self, ws, query_string):
+        self.ws = ws
+        self.query_string = query_string
+        self.page_script_hash = ""
+        self.widgets = {}    # delta_path -> (種類, id, ラベル, fragment_id)
+        self.toasts = []     # 直前の再実行で出たトーストの本文
+
+    async def rerun(self, widget_states=(), fragment_id=""):
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        msg = BackMsg()
+        state = msg.rerun_script
+        state.query_string = self.query_string
+        state.page_script_hash = self.page_script_hash
+        state.fragment_id = fragment_id
+        for widget_state in widget_states:
+            state.widget_states.widgets.append(WidgetState(**widget_state))
+        await self.ws.send(msg.SerializeToString())
+        self.toasts = []
+        await self._receive_until_finished()
+
+    async def _receive_until_finished(self):
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        while True:
+            msg = ForwardMsg()
+            msg.ParseFromString(await self.ws.recv())
+            kind = msg.WhichOneof("type")
+            if kind == "new_session":
+                self.page_script_hash = msg.new_session.page_script_hash
+                fragments = set(msg.new_session.fragment_ids_this_run)
+                # ページ全体の実行なら全部、フラグメントの実行ならそのフラグメントの部品だけ描き直される
+                self.widgets = {
+                    path: widget for path, widget in self.widgets.items()
+                    if fragments and widget[3] not in fragments
+                }
+            elif kind == "delta" and msg.delta.WhichOneof("type") == "new_element":
+                element = msg.delta.new_element
+                element_type = element.WhichOneof("type")
+                path = tuple(msg.metadata.delta_path)
+                if element_type in ("button", "checkbox"):
+                    widget = getattr(element, element_type)
+                    self.widgets[path] = (element_type, widget.id, widget.label, msg.delta.fragment_id)
+                elif element_type == "toast":
+                    self.toasts.append(element.toast.body)
+                else:
+                    self.widgets.pop(path, None)
+            elif kind == "script_finished":
+                if msg.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    return
+
+    def buttons(self):
+        return [w for w in self.widgets.values() if w[0] == "button"]
+
+    def checkboxes(self):
+        return [w for w in self.widgets.values() if w[0] == "checkbox"]
+
+    async def click(self, label, checked=()):
+        button = next(w for w in self.buttons() if w[2] == label)
+        states = [{"id": w[1], "bool_value": w[1] in checked} for w in self.checkboxes()]
+        states.append({"id": button[1], "trigger_value": True})
+        await self.rerun(states, fragment_id=button[3])
+
+
+async def run_websocket_learner(n, args, recorder):
+    from websockets.asyncio.client import connect
+
+    from quiz_session import THROTTLE_MESSAGE
+
+    rng = random.Random(args.seed * 100003 + n)
+    url = "ws" + args.url.rstrip("/").removeprefix("http") + "/_stcore/stream"
+    async with connect(url, subprotocols=["streamlit"], max_size=None) as ws:
+        client = StreamlitClient(ws, f"user_id=load{n:04d}")
+        await client.rerun()
+        for _ in range(args.attempts):
+            on_result = False
+            for _ in range(MAX_CLICKS):
+                labels = [w[2] for w in client.buttons()]
+                label, transition = choose_transition(labels, rng)
+                if label is None:
+                    if on_result:
+                        return
+                    recorder.error(n, f"押せるボタンがありません: {labels}")
+                    return
+                await asyncio.sleep(rng.uniform(args.think_min, args.think_max))
+                checked = ()
+                if transition == "answer":
+                    checked = {w[1] for w in client.checkboxes() if rng.random() < args.check_rate}
+                start = time.perf_counter()
+                await client.click(label, checked)
+                seconds = time.perf_counter() - start
+                if THROTTLE_MESSAGE in client.toasts:
+                    recorder.add("throttled", seconds)
+                    continue
+                reached = on_result_screen([w[2] for w in client.buttons()])
+                if transition == "retry":
+                    recorder.add("retry", seconds)
+                    break
+                recorder.add("finish" if reached and not on_result else transition, seconds)
+                on_result = reached
+
+
+async def _run_websocket_all(args, recorder):
+    async def learner(n):
+        # 接続が一斉に集中しないよう、開始を少しずつずらす
+        await asyncio.sleep(n * args.ramp_up / max(args.learners, 1))
+        try:
+            await run_websocket_learner(n, args, recorder)
+        except Exception as e:
+            recorder.error(n, repr(e))
+
+    await asyncio.gather(*(learner(n) for n in range(args.learners)))
+
+
+def launch_server(args, env):
+    script, _ = APPS[args.app]
+    port = args.url.rsplit(":", 1)[-1].strip("/")
+    command = [
+        sys.executable, "-m", "streamlit", "run", os.path.join(BASE_DIR, script),
+        "--server.headless", "true", "--server.port", port,
+        "--browser.gatherUsageStats", "false",
+    ]
+    server = subprocess.Popen(command, cwd=BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    health = args.url.rstrip("/") + "/_stcore/health"
+    from urllib.request import urlopen
+    for _ in range(100):
+        try:
+            with urlopen(health, timeout=1):
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit("サーバーが起動しませんでした")
+
+
+def run_websocket(args, recorder):
+    try:
+        import websockets  # noqa: F401
+    except ImportError:
+        raise SystemExit("websocket ドライバーには websockets パッケージが必要です（pip install websockets）")
+    asyncio.run(_run_websocket_all(args, recorder))
+
+
+def peak_rss_kb(pid=None):
+    # 自プロセスは getrusage、別プロセス（起動したサーバー）は /proc の VmHWM から読む
+    if pid is None:
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage // 1024 if sys.platform == "darwin" else usage
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def build_report(args, recorder, rss_kb):
+    elapsed = recorder.finished - recorder.started
+    total = sum(len(v) for v in recorder.latencies.values())
+    transitions = {}
+    for name, values in recorder.latencies.items():
+        transitions[name] = {
+            "count": len(values),
+            "p50_ms": _ms(percentile(values, 50)),
+            "p95_ms": _ms(percentile(values, 95)),
+            "p99_ms": _ms(percentile(values, 99)),
+            "max_ms": _ms(max(values) if values else None),
+        }
+    return {
+        "app": args.app,
+        "driver": args.driver,
+        "learners": args.learners,
+        "attempts": args.attempts,
+        "think_time_s": [args.think_min, args.think_max],
+        "elapsed_s": round(elapsed, 3),
+        "reruns": total,
+        "reruns_per_sec": round(total / elapsed, 2) if elapsed > 0 else None,
+        "transitions": transitions,
+        "peak_rss_kb": rss_kb,
+        "errors": recorder.errors,
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def print_report(report):
+    print(f"{report['app']} / {report['driver']}: 受講者 {report['learners']}人 × {report['attempts']}回, "
+          f"{report['elapsed_s']}秒")
+    print(f"再実行 {report['reruns']}回 ({report['reruns_per_sec']}/秒), 最大メモリ {report['peak_rss_kb']} KB")
+    print(f"{'操作':<8}{'回数':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (ms)")
+    for name, row in report["transitions"].items():
+        cells = "".join(f"{'-' if row[k] is None else row[k]:>10}" for k in ("p50_ms", "p95_ms", "p99_ms", "max_ms"))
+        print(f"{name:<8}{row['count']:>6}{cells}")
+    for message in report["errors"][:10]:
+        print(f"エラー: {message}")
+    if len(report["errors"]) > 10:
+        print(f"ほか {len(report['errors']) - 10}件のエラー")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="クイズアプリの同時受講者負荷試験")
+    parser.add_argument("--app", choices=sorted(APPS), default="v4")
+    parser.add_argument("--driver", choices=("apptest", "websocket"), default="apptest")
+    parser.add_argument("--learners", type=int, default=10)
+    parser.add_argument("--attempts", type=int, default=1, help="1人あたりの受講回数（毎回やり直す）")
+    parser.add_argument("--think-min", type=float, default=1.0, help="操作の間の考える時間（秒）の下限")
+    parser.add_argument("--think-max", type=float, default=5.0)
+    parser.add_argument("--check-rate", type=float, default=0.5, help="各選択肢にチェックを入れる確率")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=30.0, help="AppTest の1回の実行の制限時間（秒）")
+    parser.add_argument("--url", default="http://localhost:8599", help="websocket ドライバーの接続先")
+    parser.add_argument("--launch", action="store_true", help="websocket ドライバー用にサーバーを起動する")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="全員が接続し終えるまでの秒数")
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.think_max < args.think_min:
+        args.think_max = args.think_min
+    result_dir = tempfile.mkdtemp(prefix="quiz_loadtest_")
+    env = dict(os.environ)
+    # 結果・操作ログ・進行状況・受験履歴・クイズの版は一時ディレクトリに書く（指定があればそちら）
+    for name, file_name in (
+        ("QUIZ_RESULT_PATH", "quiz_result.csv"),
+        ("QUIZ_EVENT_DIR", "quiz_events"),
+        ("QUIZ_CHECKPOINT_PATH", "quiz_sessions.db"),
+        ("QUIZ_HISTORY_PATH", "quiz_history.db"),
+        ("QUIZ_VERSION_DIR", "quiz_versions"),
+    ):
+        env.setdefault(name, os.path.join(result_dir, file_name))
+    # 修了証・外部への通知のアウトボックス・分析の集計は、シェルの設定に関わらず一時ディレクトリに書き、
+    # 架空の受講者の結果を本物の LMS やアンケートに送らないよう、送り先（QUIZ_WEBHOOKS）は外す
+    for name, file_name in (
+        ("QUIZ_CERT_DIR", "certificates"),
+        ("QUIZ_OUTBOX_PATH", "quiz_outbox.db"),
+        ("QUIZ_ANALYTICS_PATH", "quiz_analytics.state"),
+    ):
+        env[name] = os.path.join(result_dir, file_name)
+    env.pop("QUIZ_WEBHOOKS", None)
+    os.environ.clear()
+    os.environ.update(env)
+    # アプリはクイズファイルをカレントディレクトリから読む
+    os.chdir(BASE_DIR)
+
+    recorder = Recorder()
+    server = None
+    if args.driver == "websocket":
+        if args.launch:
+            server = launch_server(args, env)
+        try:
+            run_websocket(args, recorder)
+            recorder.stop()
+            rss_kb = peak_rss_kb(server.pid) if server else None
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+    else:
+        run_apptest(args, recorder)
+        recorder.stop()
+        rss_kb = peak_rss_kb()
+
+    report = build_report(args, recorder, rss_kb)
+    report["result_path"] = env["QUIZ_RESULT_PATH"]
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+import copy
+import json
+import os
+import threading
+import time
+
+import streamlit as st
+
+from quiz_bank import is_bank_spec
+from quiz_engine import SHAPE_RULES
+from quiz_loader import load_quiz, load_version, split_answer
+from quiz_rank import RANKS, get_rank, get_rank_emoji
+from result_store import make_sink
+
+# 管理者用の設問別分析。
+# 集計値（ロールアップ）は結果ファイルのどこまで読んだか（チェックポイント）と一緒に保存し、
+# 表示のたびに新しく追記された分だけを読み足す。全履歴を読み直すことはない。
+# 正答は結果に記録された版（quiz_hash）のクイズで判定する。その版が残っていなければ正答率には数えない。
+# 管理者用画面は再実行のたびにタブを両方描くので、読み足しは QUIZ_ANALYTICS_REFRESH 秒（既定 30）に1回にする
+# （「最新の結果を読み込む」で今すぐ読み足す。0 なら毎回）。
+# ランクはランクを使うクイズ（v4 の形式）だけ、設問別の集計は受講者ごとに問題の違う問題バンクでは取らない。
+#   QUIZ_ANALYTICS_PATH     集計とチェックポイントの保存先（既定: quiz_analytics.state。クイズの *.json とは分ける）
+
+ANALYTICS_FILE = "quiz_analytics.state"
+STATE_VERSION = 3     # 集計の方法を変えたら上げる（保存済みの集計を捨てて集計し直す）
+REFRESH_SECONDS = float(os.environ.get("QUIZ_ANALYTICS_REFRESH", "30"))
+UNSELECTED = "（未選択）"
+
+
+def _empty_state(source):
+    return {"source": source, "version": STATE_VERSION, "checkpoint": 0, "quizzes": {}}
+
+
+def _empty_rollup():
+    return {"attempts": 0, "scores": {}, "ranks": {}, "questions": []}
+
+
+def _count(counter, key):
+    counter[key] = counter.get(key, 0) + 1
+
+
+class AnalyticsStore:
+    def __init__(self, sink, path=ANALYTICS_FILE):
+        self.sink = sink
+        self.path = path
+        self._lock = threading.Lock()
+        self._missing = set()
+        self._versions = {}     # (クイズファイル, 内容ハッシュ) -> その版の CompiledQuiz（残っていなければ None）
+        self._banks = {}        # クイズファイル -> 問題バンクの設定ファイルか
+        self._state = self._load()
+        self._snapshot = None   # 最後に読み足した時点の集計（画面からは読むだけ）
+        self._refreshed = 0.0
+
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("source") == self.sink.path and state.get("version") == STATE_VERSION:
+                return state
+        return _empty_state(self.sink.path)
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def quiz(self, name):
+        # 結果に記録されたクイズファイル（見つからなければ None）
+        if not name or name in self._missing:
+            return None
+        try:
+            return load_quiz(name)
+        except (OSError, ValueError):
+            self._missing.add(name)
+            return None
+
+    def is_bank(self, name):
+        if name not in self._banks:
+            self._banks[name] = bool(name) and is_bank_spec(name)
+        return self._banks[name]
+
+    def version(self, name, content_hash):
+        # 結果を採点したときの版。版の記録がない古い結果は今のクイズで、版が残っていなければ None
+        quiz = self.quiz(name)
+        if not content_hash or quiz is None or quiz.content_hash == content_hash:
+            return quiz
+        key = (name, content_hash)
+        if key not in self._versions:
+            try:
+                self._versions[key] = load_version(name, content_hash)
+            except ValueError:
+                self._versions[key] = None
+        return self._versions[key]
+
+    def _apply(self, record):
+        rollup = self._state["quizzes"].setdefault(record.quiz, _empty_rollup())
+        rollup["attempts"] += 1
+        _count(rollup["scores"], str(record.score))
+        current = self.quiz(record.quiz)
+        if current is not None and SHAPE_RULES[current.shape].ranks:
+            _count(rollup["ranks"], get_rank(record.score))
+        if self.is_bank(record.quiz):
+            # 問題バンクは受講者ごとに抽選するので、同じ位置でも違う問題になる
+            rollup["bank"] = True
+            return
+        quiz = self.version(record.quiz, record.quiz_hash)
+        questions = rollup["questions"]
+        for i, answer in enumerate(record.answers):
+            while len(questions) <= i:
+                questions.append({"answered": 0, "graded": 0, "correct": 0, "choices": {}})
+            stats = questions[i]
+            stats["answered"] += 1
+            if quiz is not None and i < len(quiz.questions):
+                q = quiz.questions[i]
+                selected = split_answer(answer, q.choices)
+                stats["graded"] += 1
+                if q.is_correct(selected):
+                    stats["correct"] += 1
+            else:
+                selected = answer.split(", ") if answer else []
+            for choice in selected or [UNSELECTED]:
+                _count(stats["choices"], choice)
+
+    def refresh(self, max_age=0.0):
+        # 前回のチェックポイント以降に追記された結果だけを集計に足す。
+        # 前に読み足してから max_age 秒以内なら、そのときの集計をそのまま返す
+        with self._lock:
+            now = time.monotonic()
+            if self._snapshot is not None and now - self._refreshed < max_age:
+                return self._snapshot
+            checkpoint = self._state["checkpoint"]
+            changed = False
+            while True:
+                records, next_checkpoint = self.sink.read_since(checkpoint)
+                if next_checkpoint < checkpoint:
+                    # 結果ファイルが作り直されたので集計し直す
+                    self._state = _empty_state(self.sink.path)
+                    changed = True
+                if next_checkpoint == checkpoint and not records:
+                    break
+                for record in records:
+                    self._apply(record)
+                checkpoint = next_checkpoint
+                self._state["checkpoint"] = checkpoint
+                changed = True
+            if changed:
+                self._save()
+            if changed or self._snapshot is None:
+                self._snapshot = copy.deepcopy(self._state["quizzes"])
+            self._refreshed = now
+            return self._snapshot
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_analytics():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = AnalyticsStore(make_sink(), os.environ.get("QUIZ_ANALYTICS_PATH", ANALYTICS_FILE))
+    return _store
+
+
+def _question_label(quiz, i):
+    if quiz is not None and i < len(quiz.questions):
+        text = "".join(quiz.questions[i].question_text)
+        return f"問{i+1} {text[:30]}"
+    return f"問{i+1}"
+
+
+def show_admin_analytics():
+    st.header("設問別の分析")
+    store = get_analytics()
+    reload = st.button("最新の結果を読み込む")
+    quizzes = store.refresh(0.0 if reload else REFRESH_SECONDS)
+    if not quizzes:
+        st.info("集計できる結果がまだありません。")
+        return
+
+    name = st.selectbox("クイズ", sorted(quizzes), format_func=lambda q: q or "（クイズ情報なし）")
+    rollup = quizzes[name]
+    quiz = store.quiz(name)
+    st.metric("受験数", rollup["attempts"])
+
+    st.subheader("スコア分布")
+    scores = sorted(rollup["scores"].items(), key=lambda item: int(item[0]))
+    st.bar_chart({"スコア": [int(s) for s, _ in scores], "人数": [n for _, n in scores]}, x="スコア", y="人数")
+
+    # ランクはランクを使うクイズの結果だけ数えている
+    if rollup["ranks"]:
+        st.subheader("ランク分布")
+        for rank in reversed(RANKS):
+            st.markdown(f"{get_rank_emoji(rank)} {rank}：{rollup['ranks'].get(rank, 0)}人")
+
+    if rollup.get("bank"):
+        st.info("問題バンクのクイズは受講者ごとに出題が違うため、設問別の集計はありません。")
+        return
+
+    st.subheader("設問別の正答率")
+    rows = []
+    for i, stats in enumerate(rollup["questions"]):
+        rate = f"{stats['correct'] / stats['graded']:.0%}" if stats["graded"] else "-"
+        rows.append({"設問": _question_label(quiz, i), "回答数": stats["answered"], "正答率": rate})
+    st.dataframe(rows, hide_index=True)
+
+    for i, stats in enumerate(rollup["questions"]):
+        with st.expander(f"{_question_label(quiz, i)} の選択分布"):
+            choices = sorted(stats["choices"].items(), key=lambda item: -item[1])
+            st.bar_chart({"選択肢": [c for c, _ in choices], "人数": [n for _, n in choices]}, x="選択肢", y="人数")
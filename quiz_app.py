@@ -0,0 +1,75 @@
+import os
+from urllib.parse import urlencode
+
+import streamlit as st
+
+import streamlit_quiz
+import streamlit_quiz_v2
+import streamlit_quiz_v4
+from admin_pages import show_admin_pages
+from quiz_bank import is_bank_spec
+from quiz_loader import QUIZ_DIR, load_quiz, quiz_path
+
+# 1つのプロセスで複数のクイズを配信する入口。?quiz=<ファイル名> でクイズを選ぶ。
+#   streamlit run quiz_app.py
+#   http://localhost:8501/?quiz=quiz_data_v2.json&user_id=A001
+# クイズの形式（ステージのリスト / stages / questions）に合わせて、既存の各アプリの画面で表示する。
+# 読み込んだクイズは quiz_loader のキャッシュ（件数・サイズ・未使用時間の上限つき）で共有される。
+# 問題バンクの設定ファイル（quiz_bank.py）は v4 の画面で、受講者ごとに抽選した問題を出す。
+
+# クイズの形式ごとの画面（採点ルールは quiz_engine.SHAPE_RULES）
+APPS = {
+    "list": streamlit_quiz,
+    "stages": streamlit_quiz_v2,
+    "questions": streamlit_quiz_v4,
+}
+
+
+def load_course(path):
+    # 問題のあるクイズなら CompiledQuiz、クイズでない JSON なら None
+    try:
+        quiz = load_quiz(path)
+    except (OSError, ValueError):
+        return None
+    return quiz if quiz.questions else None
+
+
+def list_quizzes():
+    names = sorted(name for name in os.listdir(QUIZ_DIR) if name.endswith(".json"))
+    return [name for name in names if quiz_path(name) and (load_course(quiz_path(name)) or is_bank_spec(quiz_path(name)))]
+
+
+def show_quiz_list():
+    st.title("クイズ一覧")
+    user_id = st.query_params.get("user_id", "")
+    for name in list_quizzes():
+        params = {"quiz": name, "user_id": user_id} if user_id else {"quiz": name}
+        st.markdown(f"- [{name}](?{urlencode(params)})")
+
+
+def main():
+    # 管理者用画面（?admin=1）と講師用のライブモニター（?admin=live）
+    if show_admin_pages():
+        return
+
+    name = st.query_params.get("quiz", "")
+    if not name:
+        show_quiz_list()
+        return
+    path = quiz_path(name)
+    if path is None:
+        st.error(f"クイズが見つかりません: {name}")
+        show_quiz_list()
+        return
+    if is_bank_spec(path):
+        streamlit_quiz_v4.main(path)
+        return
+    quiz = load_course(path)
+    if quiz is None:
+        st.error(f"クイズを読み込めません: {name}")
+        return
+    APPS[quiz.shape].main(path)
+
+
+if __name__ == "__main__":
+    main()
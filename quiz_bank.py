@@ -0,0 +1,381 @@
+import argparse
+import collections
+import hashlib
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+
+from quiz_compiler import validate_quiz
+from quiz_engine import QuizEngine
+from quiz_loader import RELOAD_CHECK_INTERVAL, as_lines, compile_quiz
+
+# 数万問の問題バンク（1行1問の JSONL）から、受講者ごとに問題を抽選して v4 形式のクイズにする。
+# バンクの隣の索引（.idx）に、分野（topic）× 難易度（difficulty）ごとにまとめた各行のバイト位置を持ち、
+# 起動時に読むのは索引のヘッダーと層の一覧だけ。抽選した行だけを mmap から読むので、
+# バンクが大きくなってもメモリ使用量は変わらない。
+#
+# バンクの1行は v4 の問題（question_text, choices, ...）に "topic" と "difficulty" を足したもの。
+# クイズとして配信するのは次のような設定ファイル（quiz_app.py の一覧にも出る）:
+#   {"title": "サイバー衛生研修", "bank": "question_bank.jsonl", "draw": 5,
+#    "topics": ["パスワード", "フィッシング"],          # 省略すると全分野
+#    "difficulty": {"easy": 2, "normal": 2, "hard": 1}}  # 省略すると draw 問を層の大きさに比例して配分
+#
+#   python quiz_bank.py index question_bank.jsonl     # 検証して索引を作る（アプリも古ければ作り直す）
+#   python quiz_bank.py draw bank_quiz.json --user A001
+#
+# 抽選は 研修ID とバンク・設定の内容から決まる乱数で行う。同じ受講者は接続し直しても
+# 再挑戦しても同じ問題になり、チェックポイント（quiz_checkpoint.py）からもそのまま再開できる。
+
+INDEX_EXT = ".idx"
+INDEX_MAGIC = b"QUIZIDX\0"
+INDEX_VERSION = 1
+# マジック, バージョン, バンクの大きさ, バンクの mtime_ns, バンクの sha256, 層の一覧（JSON）の長さ
+INDEX_HEADER = struct.Struct(f">{len(INDEX_MAGIC)}sHQQ32sI")
+RECORD = struct.Struct(">QI")   # 行のバイト位置, 行の長さ
+BANK_KEYS = ("topic", "difficulty", "id")
+MAX_ERRORS = 20
+ENGINE_CACHE_SIZE = int(os.environ.get("QUIZ_BANK_ENGINES", 1024))
+
+
+class BankError(ValueError):
+    pass
+
+
+@dataclass(frozen=True, slots=True)
+class Stratum:
+    topic: str
+    difficulty: str
+    start: int      # 索引の中の最初のレコード番号
+    count: int
+
+
+def index_path(bank_path):
+    return os.path.splitext(bank_path)[0] + INDEX_EXT
+
+
+def build_index(bank_path, out_path=None):
+    # バンクを1行ずつ検証し、層ごとにまとめた索引を書く。誤りがあれば BankError
+    strata = collections.defaultdict(lambda: (array("Q"), array("I")))
+    digest = hashlib.sha256()
+    errors = []
+    offset = 0
+    with open(bank_path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        for number, line in enumerate(f, 1):
+            digest.update(line)
+            start, offset = offset, offset + len(line)
+            if not line.strip():
+                continue
+            try:
+                question = json.loads(line)
+            except (UnicodeDecodeError, json.JSONDecodeError) as e:
+                errors.append(f"{number}行目: JSON として読めません: {e}")
+                continue
+            if not isinstance(question, dict):
+                errors.append(f"{number}行目: 問題はオブジェクトにしてください")
+                continue
+            body = {key: value for key, value in question.items() if key not in BANK_KEYS}
+            found, _ = validate_quiz({"questions": [body]})
+            errors.extend(error.replace("$.questions[0]", f"{number}行目", 1) for error in found)
+            if found:
+                continue
+            offsets, lengths = strata[(str(question.get("topic", "")), str(question.get("difficulty", "")))]
+            offsets.append(start)
+            lengths.append(len(line))
+    if errors:
+        raise BankError(f"{bank_path}: {len(errors)}件の誤りがあります\n" + "\n".join(errors[:MAX_ERRORS]))
+    if not strata:
+        raise BankError(f"{bank_path}: 問題が1問もありません")
+
+    table = []
+    records = bytearray()
+    for (topic, difficulty), (offsets, lengths) in sorted(strata.items()):
+        table.append([topic, difficulty, len(records) // RECORD.size, len(offsets)])
+        for item in zip(offsets, lengths):
+            records += RECORD.pack(*item)
+    table_bytes = json.dumps(table, ensure_ascii=False).encode("utf-8")
+    header = INDEX_HEADER.pack(
+        INDEX_MAGIC, INDEX_VERSION, stat.st_size, stat.st_mtime_ns, digest.digest(), len(table_bytes)
+    )
+
+    out_path = out_path or index_path(bank_path)
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header + table_bytes + records)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+class BankIndex:
+    # 索引とバンクを mmap で開いたもの。メモリに置くのはヘッダーと層の一覧だけ
+    def __init__(self, bank_path):
+        self.bank_path = bank_path
+        with open(index_path(bank_path), "rb") as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._index) < INDEX_HEADER.size:
+            raise BankError(f"{index_path(bank_path)}: 索引のヘッダーが不完全です")
+        magic, version, size, mtime_ns, bank_hash, table_length = INDEX_HEADER.unpack_from(self._index)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise BankError(f"{index_path(bank_path)}: 対応していない索引です")
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.bank_hash = bank_hash.hex()
+        table = json.loads(self._index[INDEX_HEADER.size:INDEX_HEADER.size + table_length].decode("utf-8"))
+        self.strata = tuple(Stratum(*row) for row in table)
+        self._records_at = INDEX_HEADER.size + table_length
+        with open(bank_path, "rb") as f:
+            self._bank = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def matches(self, stat):
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+    def read(self, record):
+        # record 番目の問題を読む
+        offset, length = RECORD.unpack_from(self._index, self._records_at + record * RECORD.size)
+        return json.loads(self._bank[offset:offset + length])
+
+
+class _Watched:
+    __slots__ = ("value", "checked")
+
+    def __init__(self, value, checked):
+        self.value = value
+        self.checked = checked
+
+
+_lock = threading.Lock()
+_banks = {}     # バンクの絶対パス -> _Watched(BankIndex)
+_specs = {}     # 設定ファイルの絶対パス -> _Watched((mtime_ns, size, BankSpec か None))
+
+
+def get_bank(bank_path):
+    # 索引を開く。索引がないかバンクと合わなければ作り直す
+    path = os.path.abspath(bank_path)
+    now = time.monotonic()
+    watched = _banks.get(path)
+    if watched is not None and now - watched.checked < RELOAD_CHECK_INTERVAL:
+        return watched.value
+    with _lock:
+        watched = _banks.get(path)
+        stat = os.stat(path)
+        if watched is not None and watched.value.matches(stat):
+            watched.checked = now
+            return watched.value
+        bank = None
+        if os.path.exists(index_path(path)):
+            try:
+                bank = BankIndex(path)
+            except BankError:
+                bank = None
+        if bank is None or not bank.matches(stat):
+            print(f"問題バンクの索引を作ります: {path}")
+            build_index(path)
+            bank = BankIndex(path)
+        _banks[path] = _Watched(bank, now)
+        return bank
+
+
+@dataclass(frozen=True, slots=True)
+class BankSpec:
+    path: str
+    content_hash: str
+    title: tuple
+    bank: str               # バンクのパス（設定ファイルからの相対パスは解決済み）
+    draw: int
+    topics: tuple           # 空なら全分野
+    difficulty: tuple       # ((難易度, 問題数), ...)。空なら draw 問を比例配分
+
+
+def _is_count(n):
+    # 0 以上の整数（JSON の true / false は数えない）
+    return isinstance(n, int) and not isinstance(n, bool) and n >= 0
+
+
+def _parse_spec(path, content):
+    try:
+        data = json.loads(content.decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+    if not isinstance(data, dict) or "bank" not in data:
+        return None
+    # 値の型は集計より先に確かめる（壊れた設定ファイルで一覧の画面ごと落とさない）
+    if not isinstance(data["bank"], str) or not data["bank"]:
+        raise BankError(f"{path}: bank にバンクのファイル名を指定してください")
+    difficulty = data.get("difficulty", {})
+    if not isinstance(difficulty, dict) or not all(_is_count(n) for n in difficulty.values()):
+        raise BankError(f"{path}: difficulty は {{難易度: 問題数}} にしてください")
+    draw = data.get("draw", sum(difficulty.values()))
+    if not _is_count(draw) or draw <= 0:
+        raise BankError(f"{path}: draw に1以上の問題数を指定してください")
+    topics = data.get("topics", [])
+    if not isinstance(topics, list) or not all(isinstance(topic, str) for topic in topics):
+        raise BankError(f"{path}: topics は分野名のリストにしてください")
+    return BankSpec(
+        path=path,
+        content_hash=hashlib.sha256(content).hexdigest(),
+        title=as_lines(data.get("title", "クイズタイトル未設定")),
+        bank=os.path.join(os.path.dirname(path), data["bank"]),
+        draw=draw,
+        topics=tuple(topics),
+        difficulty=tuple(difficulty.items()),
+    )
+
+
+def load_spec(spec_path):
+    # 問題バンクの設定ファイルなら BankSpec、ふつうのクイズなど設定ファイルでなければ None
+    path = os.path.abspath(spec_path)
+    now = time.monotonic()
+    watched = _specs.get(path)
+    if watched is not None and now - watched.checked < RELOAD_CHECK_INTERVAL:
+        return watched.value[2]
+    with _lock:
+        stat = os.stat(path)
+        watched = _specs.get(path)
+        if watched is None or watched.value[:2] != (stat.st_mtime_ns, stat.st_size):
+            with open(path, "rb") as f:
+                watched = _specs[path] = _Watched((stat.st_mtime_ns, stat.st_size, _parse_spec(path, f.read())), now)
+        watched.checked = now
+        return watched.value[2]
+
+
+def is_bank_spec(path):
+    try:
+        return load_spec(path) is not None
+    except (OSError, BankError):
+        return False
+
+
+def allocate(strata, total, rng):
+    # total 問を層の大きさに比例して配る。端数の分は端数を重みにして乱数で選ぶので、
+    # 1層あたり1問に満たない少ない出題でも、受講者全体では層の大きさに比例する
+    available = sum(s.count for s in strata)
+    if total >= available:
+        return {s: s.count for s in strata}
+    quotas = {s: total * s.count / available for s in strata}
+    counts = {s: int(q) for s, q in quotas.items()}
+    remaining = total - sum(counts.values())
+    # 重みつきの非復元抽出（重み w の層に random() ** (1 / w) のキーを付け、大きい順に取る）
+    keys = {s: rng.random() ** (1 / (quotas[s] - counts[s])) for s in strata if quotas[s] > counts[s]}
+    for s in sorted(keys, key=keys.get, reverse=True)[:remaining]:
+        counts[s] += 1
+    return counts
+
+
+def plan(bank, spec, rng):
+    # {層: 問題数}
+    strata = [s for s in bank.strata if not spec.topics or s.topic in spec.topics]
+    if not spec.difficulty:
+        return allocate(strata, spec.draw, rng)
+    counts = {}
+    for difficulty, n in spec.difficulty:
+        counts.update(allocate([s for s in strata if s.difficulty == difficulty], n, rng))
+    return counts
+
+
+def seed_for(user_id, spec, bank):
+    digest = hashlib.sha256(f"{user_id}\0{spec.content_hash}\0{bank.bank_hash}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def draw_records(bank, spec, user_id):
+    # 受講者1人分の ({層: 問題数}, 出題順のレコード番号) を返す
+    rng = random.Random(seed_for(user_id, spec, bank))
+    counts = plan(bank, spec, rng)
+    records = []
+    for stratum in sorted(counts, key=lambda s: s.start):
+        records.extend(rng.sample(range(stratum.start, stratum.start + stratum.count), counts[stratum]))
+    rng.shuffle(records)
+    return counts, records
+
+
+def draw_quiz(spec, user_id, score_correct=0, score_incorrect=0):
+    # 受講者1人分のクイズ（v4 の "questions" 形式の CompiledQuiz）を抽選する
+    bank = get_bank(spec.bank)
+    _, records = draw_records(bank, spec, user_id)
+    if not records:
+        raise BankError(f"{spec.path}: 条件に合う問題がバンクにありません")
+    questions = [
+        {key: value for key, value in bank.read(record).items() if key not in BANK_KEYS}
+        for record in records
+    ]
+    # 抽選した問題が同じなら同じハッシュ（チェックポイントの照合に使う）
+    content_hash = hashlib.sha256(
+        f"{spec.content_hash}\0{bank.bank_hash}\0{','.join(map(str, records))}".encode("utf-8")
+    ).hexdigest()
+    quiz_data = {"title": list(spec.title), "questions": questions}
+    return compile_quiz(quiz_data, spec.path, bank.mtime_ns, content_hash, score_correct, score_incorrect)
+
+
+_engines = collections.OrderedDict()   # (設定ファイル, 設定とバンクの内容, ルール, 研修ID) -> QuizEngine
+_engines_lock = threading.Lock()
+
+
+def load_bank_engine(spec_path, user_id, rules):
+    # 受講者ごとの遷移表。最近使った ENGINE_CACHE_SIZE 人分だけ持ち、外れたら抽選し直す（同じ問題になる）
+    spec = load_spec(spec_path)
+    bank = get_bank(spec.bank)
+    # 設定かバンクが変わればキーも変わるので、古い遷移表は使われないまま押し出される
+    key = (spec.path, spec.content_hash, bank.bank_hash, rules, user_id)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is not None:
+            _engines.move_to_end(key)
+            return engine
+    engine = QuizEngine(draw_quiz(spec, user_id, rules.score_correct, rules.score_incorrect), rules)
+    with _engines_lock:
+        _engines[key] = engine
+        _engines.move_to_end(key)
+        while len(_engines) > ENGINE_CACHE_SIZE:
+            _engines.popitem(last=False)
+    return engine
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="問題バンクの索引づくりと抽選の確認")
+    commands = parser.add_subparsers(dest="command", required=True)
+    index_parser = commands.add_parser("index", help="バンクを検証して索引を作る")
+    index_parser.add_argument("banks", nargs="+")
+    draw_parser = commands.add_parser("draw", help="受講者1人分の抽選結果を表示する")
+    draw_parser.add_argument("spec")
+    draw_parser.add_argument("--user", default="")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "index":
+            for bank_path in args.banks:
+                out_path = build_index(bank_path)
+                bank = BankIndex(bank_path)
+                total = sum(s.count for s in bank.strata)
+                print(f"{bank_path}: {total}問、{len(bank.strata)}層 → {out_path}")
+                for s in bank.strata:
+                    print(f"  {s.topic or '-'} / {s.difficulty or '-'}: {s.count}問")
+            return 0
+        spec = load_spec(args.spec)
+        if spec is None:
+            print(f"{args.spec}: 問題バンクの設定ファイルではありません", file=sys.stderr)
+            return 1
+        counts, _ = draw_records(get_bank(spec.bank), spec, args.user)
+        for stratum in sorted(counts, key=lambda s: s.start):
+            if counts[stratum]:
+                print(f"{stratum.topic or '-'} / {stratum.difficulty or '-'}: {counts[stratum]}問（{stratum.count}問中）")
+        quiz = draw_quiz(spec, args.user)
+        for i, q in enumerate(quiz.questions, 1):
+            print(f"問{i}: {''.join(q.question_text)[:60]}")
+        return 0
+    except BankError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    except OSError as e:
+        print(f"問題バンクを読めません: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
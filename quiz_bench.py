@@ -0,0 +1,396 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import quiz_loader
+from loadtest_quiz import percentile
+from quiz_app import APPS
+from quiz_compiler import compile_file
+from quiz_engine import SHAPE_RULES, _compile_steps, load_engine
+from quiz_grading import grade_masks, grade_one, np
+from quiz_rank import get_rank, get_rank_emoji
+from result_store import CsvResultSink, ResultRecord, get_writer, save_result
+
+# 再実行1回の中で時間がどこにかかっているかを測るマイクロベンチマーク（標準ライブラリだけで動く）。
+# 負荷試験（loadtest_quiz.py）が画面の操作ごとの応答時間を見るのに対し、こちらは部品ごとの1回あたりの時間を見る。
+#
+#   python quiz_bench.py --json before.json
+#   （変更する）
+#   python quiz_bench.py --json after.json --compare before.json
+#   python quiz_bench.py --filter grade/ --quick
+#
+# 計測するもの:
+#   load/*      load_quiz_data（形式ごと。キャッシュ済みの再実行時と、JSON / .quizc からの初回読み込み）
+#   grade/*     選択肢の多い問題の採点（選択肢 → ビットマスク、QuizEngine.answer、回答用紙の一括採点）
+#   rank/*      get_rank / get_rank_emoji と、遷移表に引いておいたランク（QuizEngine.rank）
+#   steps/*     v2 のエンディング・ゲームオーバーのステージを探す遷移表の組み立てと、現在のステップの参照
+#   save/*      save_result（キューに積むだけ）と、行数の違う CSV への追記（ライタースレッドの書き込み）
+# クイズは合成したもの（ステージ数・問題数・選択肢の数を指定）を一時ディレクトリに書いて使う。
+# 結果ファイルや索引も一時ディレクトリに書くので、本番のファイルには触れない。
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SHAPES = ("list", "stages", "questions")
+CHOICE_COUNTS = (4, 16, 62)
+STAGE_COUNTS = (8, 100, 1000)
+CSV_ROWS = (0, 10000, 100000)
+SHEETS = 1000
+TARGET_BATCH_SECONDS = 0.01     # 1回の計測でこの時間を超えるまでまとめて呼ぶ（短い処理の時計の粒度を均す）
+
+# 形式ごとの採点の既定値（実際のクイズファイルと同じ）
+SCORES = {"list": (0, -20), "stages": (0, -20), "questions": (20, 0)}
+
+
+def make_question(rng, number, choices, shape):
+    correct = set(rng.sample(range(choices), rng.randint(1, choices)))
+    score_correct, score_incorrect = SCORES[shape]
+    return {
+        "section_title": f"第{number + 1}問",
+        "question_text": [f"問{number + 1}：正しいものをすべて選んでください。"],
+        "choices": [{"text": f"選択肢{number + 1}-{i + 1}", "is_correct": i in correct} for i in range(choices)],
+        "answer_type": "multiple",
+        "score_correct": score_correct,
+        "score_incorrect": score_incorrect,
+        "feedback_correct": ["正解です。"],
+        "feedback_incorrect": ["不正解です。"],
+    }
+
+
+def make_quiz(shape, stages=8, per_stage=5, choices=4, seed=0):
+    # 形式ごとの JSON と同じ構造のクイズを作る（stages 形式はスタート・エンディング・ゲームオーバーのステージつき）
+    rng = random.Random(seed)
+    number = 0
+    question_stages = []
+    for s in range(stages):
+        questions = []
+        for _ in range(per_stage):
+            questions.append(make_question(rng, number, choices, shape))
+            number += 1
+        question_stages.append({
+            "section_title": [f"【ステージ{s + 1}】"],
+            "section_story": [f"ステージ{s + 1}の状況説明。"],
+            "questions": questions,
+        })
+    if shape == "list":
+        return question_stages
+    if shape == "questions":
+        return {"title": ["ベンチマーク用クイズ"], "questions": [q for stage in question_stages for q in stage["questions"]]}
+    return {
+        "title": ["ベンチマーク用クイズ", "合成したステージ"],
+        "stages": [
+            {"section_title": ["【プロローグ】"], "section_story": ["はじまり。"], "questions": []},
+            *question_stages,
+            {"section_title": ["【エンディング】"], "section_story": ["クリア。"], "questions": []},
+            {"section_title": ["【ゲームオーバー】"], "section_story": ["失敗。"], "questions": []},
+        ],
+    }
+
+
+def write_quiz(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    return path
+
+
+def make_record(rng, questions=5, choices=4):
+    answers = [", ".join(f"選択肢{q + 1}-{i + 1}" for i in range(choices) if rng.random() < 0.5) for q in range(questions)]
+    return ResultRecord("2026-01-01 09:00:00", rng.choice((0, 20, 40, 60, 80, 100)), tuple(answers),
+                        f"U{rng.randrange(100000):05d}", "quiz_data_v4.json", "0" * 64)
+
+
+def fill_csv(path, rows, seed=0):
+    rng = random.Random(seed)
+    sink = CsvResultSink(path)
+    for start in range(0, rows, 5000):
+        sink.write([make_record(rng) for _ in range(min(5000, rows - start))], False)
+    return sink
+
+
+def measure(fn, min_time, max_repeats=200):
+    # fn を1回の計測が TARGET_BATCH_SECONDS を超える回数ずつ呼び、合計 min_time 秒になるまで繰り返す。
+    # 1回あたりの秒数のリストと、まとめて呼んだ回数を返す
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= TARGET_BATCH_SECONDS or number >= 1 << 20:
+            break
+        number *= 2 if elapsed * 10 > TARGET_BATCH_SECONDS else 10
+    samples = [elapsed / number]
+    deadline = time.perf_counter() + min_time
+    while len(samples) < max_repeats and (time.perf_counter() < deadline or len(samples) < 5):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return samples, number
+
+
+def _us(seconds):
+    return round(seconds * 1e6, 3)
+
+
+def summarize(samples, number):
+    return {
+        "calls": len(samples) * number,
+        "batch": number,
+        "min_us": _us(min(samples)),
+        "median_us": _us(percentile(samples, 50)),
+        "p95_us": _us(percentile(samples, 95)),
+        "max_us": _us(max(samples)),
+    }
+
+
+class Suite:
+    def __init__(self, work_dir, quick=False):
+        self.work_dir = work_dir
+        self.quick = quick
+        self.cases = []     # (名前, パラメーター, 準備の関数) 準備の関数は計測する関数を返す
+
+    def add(self, name, params=None):
+        def register(setup):
+            self.cases.append((name, params or {}, setup))
+            return setup
+        return register
+
+    def path(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def quiz(self, shape, stages=8, per_stage=5, choices=4, seed=0, suffix=""):
+        # 合成したクイズを一度だけ書く（書き直すと監視スレッドが更新として読み直すため）
+        path = self.path(f"{shape}_{stages}x{per_stage}_{choices}_{seed}{suffix}.json")
+        if not os.path.exists(path):
+            write_quiz(path, make_quiz(shape, stages, per_stage, choices, seed))
+        return path
+
+
+def build_suite(work_dir, quick=False):
+    suite = Suite(work_dir, quick)
+    stage_counts = STAGE_COUNTS[:2] if quick else STAGE_COUNTS
+    csv_rows = CSV_ROWS[:2] if quick else CSV_ROWS
+
+    # load_quiz_data: 再実行ごとの呼び出し（キャッシュ済み）と、キャッシュを捨てた後の初回読み込み
+    for shape in SHAPES:
+        app = APPS[shape]
+        for stages in stage_counts:
+            params = {"shape": shape, "stages": stages, "per_stage": 5, "choices": 4}
+
+            def setup_warm(app=app, shape=shape, stages=stages):
+                path = suite.quiz(shape, stages)
+                app.load_quiz_data(path)
+                return lambda: app.load_quiz_data(path)
+
+            def setup_cold(app=app, shape=shape, stages=stages):
+                path = suite.quiz(shape, stages)
+
+                def run():
+                    quiz_loader.clear_cache()
+                    app.load_quiz_data(path)
+                return run
+
+            def setup_artifact(app=app, shape=shape, stages=stages):
+                # 隣に .quizc を置いた別のファイル（JSON の解析を省く経路）
+                artifact_path = suite.quiz(shape, stages, suffix="_quizc")
+                compile_file(artifact_path)
+
+                def run():
+                    quiz_loader.clear_cache()
+                    app.load_quiz_data(artifact_path)
+                return run
+
+            suite.add(f"load/{shape}/{stages}stages/warm", params)(setup_warm)
+            suite.add(f"load/{shape}/{stages}stages/cold-json", params)(setup_cold)
+            suite.add(f"load/{shape}/{stages}stages/cold-quizc", params)(setup_artifact)
+
+    # 採点: 選択肢の多い問題
+    rules = SHAPE_RULES["questions"]
+    for choices in CHOICE_COUNTS:
+        params = {"choices": choices, "questions": 50}
+
+        def load_grade_engine(choices=choices):
+            return load_engine(suite.quiz("questions", stages=10, choices=choices, seed=choices), rules)
+
+        def setup_mask(load=load_grade_engine):
+            q = load().quiz.questions[0]
+            selected = list(q.choices[::2])
+            return lambda: q.mask(selected)
+
+        def setup_answer(load=load_grade_engine):
+            engine = load()
+            mask = engine.quiz.questions[0].correct_mask
+
+            def run():
+                engine.answer(engine.new_session(), mask)
+            return run
+
+        def setup_sheet(load=load_grade_engine):
+            engine = load()
+            rng = random.Random(1)
+            masks = [rng.getrandbits(len(q.choices)) for q in engine.quiz.questions]
+            return lambda: grade_one(engine, masks)
+
+        def setup_batch(load=load_grade_engine):
+            engine = load()
+            rng = random.Random(2)
+            rows = [[rng.getrandbits(len(q.choices)) for q in engine.quiz.questions] for _ in range(SHEETS)]
+            return lambda: grade_masks(engine, rows)
+
+        suite.add(f"grade/{choices}choices/mask", params)(setup_mask)
+        suite.add(f"grade/{choices}choices/answer", params)(setup_answer)
+        suite.add(f"grade/{choices}choices/sheet", params)(setup_sheet)
+        suite.add(f"grade/{choices}choices/batch{SHEETS}", dict(params, sheets=SHEETS, numpy=np is not None))(setup_batch)
+
+    # ランク: 0〜100点を一巡する
+    scores = list(range(0, 101))
+
+    @suite.add("rank/get_rank", {"scores": len(scores)})
+    def setup_get_rank():
+        return lambda: [get_rank(score) for score in scores]
+
+    @suite.add("rank/get_rank_emoji", {"scores": len(scores)})
+    def setup_get_rank_emoji():
+        ranks = [get_rank(score) for score in scores]
+        return lambda: [get_rank_emoji(rank) for rank in ranks]
+
+    @suite.add("rank/engine.rank", {"scores": len(scores)})
+    def setup_engine_rank():
+        engine = load_engine(suite.quiz("questions", stages=1), rules)
+        return lambda: [engine.rank(score) for score in scores]
+
+    # v2: エンディング・ゲームオーバーのステージを探して遷移表を組み立てる（読み込みのたび）と、
+    # 再実行ごとの現在のステップの参照
+    stage_rules = SHAPE_RULES["stages"]
+    for stages in stage_counts:
+        params = {"stages": stages, "per_stage": 5}
+
+        def setup_compile(stages=stages):
+            engine = load_engine(suite.quiz("stages", stages), stage_rules)
+            return lambda: _compile_steps(engine.quiz, stage_rules)
+
+        def setup_current(stages=stages):
+            engine = load_engine(suite.quiz("stages", stages), stage_rules)
+            session = engine.new_session()
+            session.step = len(engine.steps) - 2    # エンディング
+
+            def run():
+                engine.current(session)
+                engine.finished(session)
+            return run
+
+        suite.add(f"steps/{stages}stages/compile", params)(setup_compile)
+        suite.add(f"steps/{stages}stages/current", params)(setup_current)
+
+    # save_result: 画面のスレッドはキューに積むだけ。書き込みはライタースレッドが CSV に追記する
+    @suite.add("save/save_result", {})
+    def setup_save_result():
+        rng = random.Random(3)
+        record = make_record(rng)
+        get_writer()
+        return lambda: save_result(record.score, record.answers, record.user_id, quiz=record.quiz, quiz_hash=record.quiz_hash)
+
+    for rows in csv_rows:
+        params = {"rows": rows}
+
+        def setup_append(rows=rows):
+            path = suite.path(f"append_{rows}.csv")
+            if os.path.exists(path):
+                os.remove(path)
+            sink = fill_csv(path, rows)
+            record = make_record(random.Random(4))
+            return lambda: sink.write([record], False)
+
+        suite.add(f"save/csv/{rows}rows/append", params)(setup_append)
+    return suite
+
+
+def run_suite(suite, min_time, pattern=""):
+    results = {}
+    for name, params, setup in suite.cases:
+        if pattern and pattern not in name:
+            continue
+        fn = setup()
+        samples, number = measure(fn, min_time)
+        results[name] = dict(summarize(samples, number), params=params)
+        row = results[name]
+        print(f"{name:<44}{row['median_us']:>14.3f}{row['p95_us']:>14.3f}{row['calls']:>10}", flush=True)
+    return results
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def compare(results, baseline):
+    # 中央値の比（今回 / 基準）。1より大きければ遅くなっている
+    print(f"{'ベンチマーク':<40}{'基準':>14}{'今回':>14}{'比':>8}  (µs, 中央値)")
+    for name, row in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<44}{'-':>14}{row['median_us']:>14.3f}{'新規':>8}")
+            continue
+        ratio = row["median_us"] / base["median_us"] if base["median_us"] else float("inf")
+        print(f"{name:<44}{base['median_us']:>14.3f}{row['median_us']:>14.3f}{ratio:>8.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="クイズアプリの部品ごとのマイクロベンチマーク")
+    parser.add_argument("--filter", default="", help="名前にこの文字列を含むベンチマークだけを実行する")
+    parser.add_argument("--min-time", type=float, default=0.2, help="ベンチマークごとに計測する秒数")
+    parser.add_argument("--quick", action="store_true", help="大きいサイズ（1000ステージ、10万行）を省く")
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    parser.add_argument("--compare", help="比べる基準の結果（以前の --json の出力）")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="quiz_bench_")
+    # 結果・操作ログ・索引・版の保存先を一時ディレクトリに向ける
+    os.environ["QUIZ_RESULT_PATH"] = os.path.join(work_dir, "quiz_result.csv")
+    os.environ["QUIZ_EVENT_DIR"] = os.path.join(work_dir, "quiz_events")
+    os.environ["QUIZ_CHECKPOINT_PATH"] = os.path.join(work_dir, "quiz_sessions.db")
+    os.environ["QUIZ_HISTORY_PATH"] = os.path.join(work_dir, "quiz_history.db")
+    os.environ["QUIZ_OUTBOX_PATH"] = os.path.join(work_dir, "quiz_outbox.db")
+    quiz_loader.VERSION_DIR = os.path.join(work_dir, "quiz_versions")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    print(f"{'ベンチマーク':<40}{'中央値':>11}{'p95':>14}{'呼び出し':>6}  (µs)")
+    try:
+        results = run_suite(build_suite(work_dir, args.quick), args.min_time, args.filter)
+    finally:
+        get_writer().close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np is not None,
+        "min_time_s": args.min_time,
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if baseline is not None:
+        print()
+        compare(results, baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
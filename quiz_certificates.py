@@ -0,0 +1,343 @@
+import argparse
+import atexit
+import functools
+import hashlib
+import os
+import queue
+import re
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+from quiz_bank import load_spec
+from quiz_engine import SHAPE_RULES
+from quiz_loader import load_quiz
+from quiz_rank import get_rank, get_rank_emoji
+from result_store import bounded_map, make_sink
+
+# マスター認定の修了証（PNG / PDF）を作る。
+# 受講画面では結果を保存したときにジョブをキューに積むだけで、描画と書き出しはワーカースレッドで行う。
+# 一括モードは結果ファイルの合格行すべてについて、プロセスプールで並列に作る（作成済みのものは飛ばす）。
+# 合格は、ランクを使う形式で満点がちょうど 100点のクイズ（v4、5問を抽選する問題バンクなど）の 100点。
+# v1 / v2 の形式や、抽選する問題数が違う問題バンクの結果からは、--min-score を指定しない限り作らない。
+#
+#   python quiz_certificates.py --quiz quiz_data_v4.json              # 結果ファイルの 100点の行すべて
+#   python quiz_certificates.py --quiz quiz_data_v4.json --format pdf --workers 4
+#   python quiz_certificates.py --min-score 80                        # どのクイズでも 80点以上なら作る
+#
+#   QUIZ_CERT_DIR        書き出すディレクトリ（既定: certificates）
+#   QUIZ_CERT_FORMAT     png（既定） / pdf
+#   QUIZ_CERT_FONT       日本語を含むフォントファイル（既定: よくある場所から探す）
+#   QUIZ_CERT_WORKERS    受講画面から使うワーカースレッドの数（既定: 1）
+#   QUIZ_CERTIFICATES=0  受講画面からは作らない
+
+ENABLED = os.environ.get("QUIZ_CERTIFICATES", "1") != "0"
+CERT_DIR = "certificates"
+FORMATS = {"png": "PNG", "pdf": "PDF"}
+PASSING_SCORE = 100
+BATCH_SIZE = 16             # 一括作成で1つのプロセスにまとめて渡す件数
+PAGE_SIZE = (1754, 1240)    # A4 横、150dpi
+DPI = 150
+GOLD = (255, 215, 0)
+INK = (34, 34, 34)
+# 日本語のグリフがあるフォントの候補（packages.txt の fonts-noto-cjk、IPA フォント、macOS、Windows）
+FONT_CANDIDATES = (
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/opentype/noto/NotoSerifCJK-Regular.ttc",
+    "/usr/share/fonts/opentype/ipafont-gothic/ipag.ttf",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc",
+    "C:/Windows/Fonts/msgothic.ttc",
+)
+
+
+@dataclass(frozen=True, slots=True)
+class Certificate:
+    user_id: str
+    score: int
+    rank: str
+    emoji: str
+    timestamp: str      # 結果のタイムスタンプ（"YYYY-MM-DD HH:MM:SS"）
+    title: str
+    key: str            # 結果の行の内容のハッシュ。同じ秒の別の結果と修了証のファイル名を分ける
+
+
+def full_marks(quiz_file):
+    # ランクを使う形式のクイズの満点（ランクを使わない形式や読めないファイルなら None）。
+    # 問題バンクは受講者ごとに抽選するので、抽選する問題数から決める
+    try:
+        spec = load_spec(quiz_file)
+        if spec is not None:
+            rules = SHAPE_RULES["questions"]
+            return rules.initial_score + spec.draw * rules.score_correct
+        rules = SHAPE_RULES[load_quiz(quiz_file).shape]
+        if not rules.ranks:
+            return None
+        quiz = load_quiz(quiz_file, rules.score_correct, rules.score_incorrect)
+    except (OSError, ValueError):
+        return None
+    return rules.initial_score + sum(max(q.score_correct, 0) for q in quiz.questions)
+
+
+def is_passing(record):
+    # マスター認定の合格（満点が 100点のクイズの 100点）か
+    return record.score >= PASSING_SCORE and full_marks(record.quiz) == PASSING_SCORE
+
+
+def certificate_for(record, title):
+    rank = get_rank(record.score)
+    key = hashlib.sha256("\0".join(
+        (record.user_id, record.timestamp, record.quiz, record.quiz_hash, str(record.score), *record.answers)
+    ).encode("utf-8")).hexdigest()[:8]
+    return Certificate(record.user_id, record.score, rank, get_rank_emoji(rank), record.timestamp, title, key)
+
+
+def certificate_path(cert, directory=CERT_DIR, fmt="png"):
+    # 同じ結果からは同じファイル名になるので、画面と一括モードで二重に作らない。
+    # タイムスタンプは秒までなので、同じ秒の別の結果（別のクイズなど）は結果の内容のハッシュで分ける
+    safe_id = re.sub(r"[^\w-]", "_", cert.user_id) or "_"
+    stamp = re.sub(r"\D", "", cert.timestamp)
+    return os.path.join(directory, f"{safe_id}-{stamp}-{cert.key}.{fmt}")
+
+
+@functools.lru_cache(maxsize=None)
+def find_font():
+    path = os.environ.get("QUIZ_CERT_FONT")
+    if path:
+        return path
+    for candidate in FONT_CANDIDATES:
+        if os.path.exists(candidate):
+            return candidate
+    # 日本語は豆腐（□）になるが、修了証が作れないよりはよい
+    print("修了証用の日本語フォントが見つかりません。QUIZ_CERT_FONT を設定してください")
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _font(size):
+    path = find_font()
+    return ImageFont.truetype(path, size) if path else ImageFont.load_default(size)
+
+
+def _centered(draw, y, text, size, fill=INK):
+    font = _font(size)
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    draw.text(((PAGE_SIZE[0] - (right - left)) / 2 - left, y), text, font=font, fill=fill)
+    return y + (bottom - top)
+
+
+def render(cert):
+    image = Image.new("RGB", PAGE_SIZE, "white")
+    draw = ImageDraw.Draw(image)
+    width, height = PAGE_SIZE
+    draw.rectangle((40, 40, width - 41, height - 41), outline=GOLD, width=24)
+    draw.rectangle((84, 84, width - 85, height - 85), outline=INK, width=3)
+
+    y = _centered(draw, 170, "修了証", 120) + 60
+    if cert.title:
+        y = _centered(draw, y, cert.title, 48) + 90
+    y = _centered(draw, y, f"研修ID：{cert.user_id}", 64) + 60
+    # 絵文字はカラー絵文字のフォントがないと描けないので、ランク名だけを書く
+    y = _centered(draw, y, f"最終スコア：{cert.score}点　ランク：{cert.rank}", 56) + 80
+    if cert.rank == "マスター":
+        message = "あなたは全問正解し、マスターに認定されたことをここに証します。"
+    else:
+        message = "あなたは本研修を修了したことをここに証します。"
+    y = _centered(draw, y, message, 40) + 120
+    date = cert.timestamp[:10].split("-")
+    if len(date) == 3:
+        _centered(draw, y, f"{int(date[0])}年{int(date[1])}月{int(date[2])}日", 44)
+    return image
+
+
+def write_certificate(cert, directory=CERT_DIR, fmt="png"):
+    # 作成済みなら何もしない。書き終えてから置き換えるので、途中のファイルは見えない
+    path = certificate_path(cert, directory, fmt)
+    if os.path.exists(path):
+        return path, False
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    render(cert).save(tmp_path, FORMATS[fmt], resolution=DPI)
+    os.replace(tmp_path, path)
+    return path, True
+
+
+_STOP = object()
+
+
+class CertificateWorker:
+    # ジョブキューとワーカースレッド。描画中もスクリプトスレッドは待たない
+    def __init__(self, directory=CERT_DIR, fmt="png", workers=1, max_queue=1000):
+        if fmt not in FORMATS:
+            raise ValueError(f"未知の修了証の形式です: {fmt}")
+        self.directory = directory
+        self.fmt = fmt
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = [
+            threading.Thread(target=self._run, name=f"certificate-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, cert):
+        # キューが一杯なら積まずに False を返す（一括モードで後から作れる）
+        try:
+            self._queue.put_nowait(cert)
+            return True
+        except queue.Full:
+            print(f"修了証のキューが一杯です: {cert.user_id}")
+            return False
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            cert = self._queue.get()
+            try:
+                if cert is _STOP:
+                    return
+                write_certificate(cert, self.directory, self.fmt)
+            except Exception as e:
+                print(f"修了証の作成に失敗しました（{cert.user_id}）: {e}")
+            finally:
+                self._queue.task_done()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_worker():
+    global _worker
+    if _worker is None:
+        with _worker_lock:
+            if _worker is None:
+                _worker = CertificateWorker(
+                    os.environ.get("QUIZ_CERT_DIR", CERT_DIR),
+                    fmt=os.environ.get("QUIZ_CERT_FORMAT", "png"),
+                    workers=int(os.environ.get("QUIZ_CERT_WORKERS", "1")),
+                )
+                # 終了時はキューに残ったものを作り終えてから止める
+                atexit.register(_worker.close)
+    return _worker
+
+
+def request_certificate(record, title=""):
+    # 受講画面から呼ぶ。save_result が返したレコードを渡す（合格でなければ何もしない）
+    if not ENABLED or Image is None or not is_passing(record):
+        return False
+    return get_worker().submit(certificate_for(record, title))
+
+
+def _write_one(args):
+    cert, directory, fmt = args
+    try:
+        return write_certificate(cert, directory, fmt)[1], ""
+    except Exception as e:
+        return False, f"{cert.user_id} {cert.timestamp}: {e}"
+
+
+def _write_batch(batch):
+    return [_write_one(args) for args in batch]
+
+
+def _batches(jobs, size):
+    batch = []
+    for job in jobs:
+        batch.append(job)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def passing_certificates(records, quiz_name="", min_score=None, title=""):
+    # min_score を指定しなければ is_passing の合格、指定すればどのクイズでもその点数以上
+    marks = {}     # クイズファイル -> 満点（結果の行ごとに読み直さない）
+    for record in records:
+        if quiz_name and os.path.basename(record.quiz) != quiz_name:
+            continue
+        if min_score is not None:
+            if record.score < min_score:
+                continue
+        elif record.score < PASSING_SCORE:
+            continue
+        else:
+            if record.quiz not in marks:
+                marks[record.quiz] = full_marks(record.quiz)
+            if marks[record.quiz] != PASSING_SCORE:
+                continue
+        yield certificate_for(record, title)
+
+
+def bulk(records, directory=CERT_DIR, fmt="png", workers=None, quiz_name="", min_score=None, title=""):
+    # 合格した結果すべての修了証を作り、{"written", "existing", "errors"} を返す
+    jobs = ((cert, directory, fmt) for cert in passing_certificates(records, quiz_name, min_score, title))
+    summary = {"written": 0, "existing": 0, "errors": []}
+    if workers == 1:
+        results = map(_write_one, jobs)
+        executor = None
+    else:
+        # 処理中のまとまりはプロセス数の2倍までにする（結果を全部読んでから始めない）
+        workers = workers or os.cpu_count() or 1
+        executor = ProcessPoolExecutor(max_workers=workers)
+        batches = bounded_map(executor, _write_batch, _batches(jobs, BATCH_SIZE), 2 * workers)
+        results = (result for batch in batches for result in batch)
+    try:
+        for written, error in results:
+            if error:
+                summary["errors"].append(error)
+            elif written:
+                summary["written"] += 1
+            else:
+                summary["existing"] += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="結果ファイルの合格者全員の修了証を作る")
+    parser.add_argument("--quiz", default="", help="このクイズファイルの結果だけを対象にする")
+    parser.add_argument("--title", default="", help="修了証に書く研修名（既定: クイズのタイトル）")
+    parser.add_argument("--min-score", type=int, help="この点数以上ならどのクイズでも作る（既定: 満点が 100点のクイズの 100点）")
+    parser.add_argument("--format", choices=sorted(FORMATS), default=os.environ.get("QUIZ_CERT_FORMAT", "png"))
+    parser.add_argument("--output", default=os.environ.get("QUIZ_CERT_DIR", CERT_DIR))
+    parser.add_argument("--workers", type=int, help="プロセス数（既定: CPU 数、1 ならこのプロセスで処理）")
+    args = parser.parse_args(argv)
+    if Image is None:
+        print("修了証を作るには Pillow が必要です（pip install pillow）", file=sys.stderr)
+        return 1
+
+    title = args.title
+    if not title and args.quiz:
+        quiz_title = load_quiz(args.quiz).title
+        title = quiz_title[0] if quiz_title else ""
+    summary = bulk(
+        make_sink().iter_records(), args.output, args.format, args.workers,
+        os.path.basename(args.quiz), args.min_score, title,
+    )
+    print(f"作成 {summary['written']}件、作成済み {summary['existing']}件、失敗 {len(summary['errors'])}件")
+    for error in summary["errors"][:20]:
+        print(f"  {error}", file=sys.stderr)
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
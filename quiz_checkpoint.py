@@ -0,0 +1,122 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# 受講中の進行状況（ステップ番号・スコア・回答のビットマスク・結果保存済みか）を 研修ID × クイズ ごとに
+# SQLite に残すチェックポイント。回答・遷移のたびに上書きするので、接続が切れても、メモリから追い出されても、
+# プロセスを再起動しても、同じ 研修ID で開き直せば続きから再開できる。
+# 1行の UPSERT（WAL、synchronous=NORMAL で fsync しない）なので、画面の操作ごとに書いても負担は小さい。
+#
+#   QUIZ_CHECKPOINTS=0          チェックポイントを使わない（セッションは st.session_state にだけ置く）
+#   QUIZ_CHECKPOINT_PATH        保存先（既定: quiz_sessions.db）
+
+ENABLED = os.environ.get("QUIZ_CHECKPOINTS", "1") != "0"
+CHECKPOINT_DB = "quiz_sessions.db"
+
+
+class CheckpointStore:
+    def __init__(self, path=CHECKPOINT_DB):
+        self.path = path
+        self._conn = None
+        # Streamlit のスクリプトスレッドから並行して呼ばれるので、1つの接続をロックで守る
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                "user_id TEXT NOT NULL, "
+                "quiz TEXT NOT NULL, "
+                "quiz_hash TEXT NOT NULL, "
+                "session_id TEXT NOT NULL, "
+                "step INTEGER NOT NULL, "
+                "score INTEGER NOT NULL, "
+                "answers TEXT NOT NULL, "
+                "result_saved INTEGER NOT NULL, "
+                "updated REAL NOT NULL, "
+                "PRIMARY KEY (user_id, quiz))"
+            )
+        return self._conn
+
+    def save(self, user_id, quiz, quiz_hash, session):
+        row = (
+            user_id, quiz, quiz_hash, session.id, session.step, session.score,
+            json.dumps(session.answers), int(session.result_saved), time.time(),
+        )
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    conn.execute(
+                        "INSERT INTO checkpoints "
+                        "(user_id, quiz, quiz_hash, session_id, step, score, answers, result_saved, updated) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (user_id, quiz) DO UPDATE SET "
+                        "quiz_hash = excluded.quiz_hash, session_id = excluded.session_id, step = excluded.step, "
+                        "score = excluded.score, answers = excluded.answers, "
+                        "result_saved = excluded.result_saved, updated = excluded.updated",
+                        row,
+                    )
+        except sqlite3.Error as e:
+            # 保存できなくても受講は続けられる（再開できなくなるだけ）
+            print(f"進行状況を保存できませんでした: {e}")
+
+    def load(self, user_id, quiz):
+        # {"quiz_hash", "session_id", "step", "score", "answers", "result_saved"} か None を返す
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    "SELECT quiz_hash, session_id, step, score, answers, result_saved "
+                    "FROM checkpoints WHERE user_id = ? AND quiz = ?",
+                    (user_id, quiz),
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"進行状況を読み込めませんでした: {e}")
+            return None
+        if row is None:
+            return None
+        quiz_hash, session_id, step, score, answers, result_saved = row
+        return {
+            "quiz_hash": quiz_hash,
+            "session_id": session_id,
+            "step": step,
+            "score": score,
+            "answers": json.loads(answers),
+            "result_saved": bool(result_saved),
+        }
+
+    def quiz_hashes(self):
+        # チェックポイントが参照しているクイズの版（内容ハッシュ）の集合。読めなければ None
+        try:
+            with self._lock:
+                rows = self._connect().execute("SELECT DISTINCT quiz_hash FROM checkpoints").fetchall()
+        except sqlite3.Error as e:
+            print(f"進行状況を読み込めませんでした: {e}")
+            return None
+        return {quiz_hash for (quiz_hash,) in rows}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if not ENABLED:
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = CheckpointStore(os.environ.get("QUIZ_CHECKPOINT_PATH", CHECKPOINT_DB))
+    return _store
@@ -0,0 +1,204 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from quiz_loader import ARTIFACT_EXT, artifact_bytes, artifact_path, compile_quiz, read_artifact
+
+# クイズJSONを検証し、正規化済みの構造（CompiledQuiz）をコンパイル済みファイル（.quizc）に書き出す。
+# 書式の誤りは受講中ではなくここで見つける。アプリは JSON の隣にある .quizc を読み、JSON の解析を省く。
+#
+#   python quiz_compiler.py quiz_data.json quiz_data_v2.json quiz_data_v4.json
+#   python quiz_compiler.py --check quiz_data_v4.json      # 検証だけ
+#
+# 配点が書かれていない問題は None のまま保存し、読み込むアプリの既定値（QuizRules）で埋める。
+
+TEXT_KEYS = ("title", "section_title", "section_story", "question_text", "feedback_correct", "feedback_incorrect")
+STAGE_KEYS = {"section_title", "section_story", "questions"}
+QUESTION_KEYS = {
+    "section_title", "section_story", "question_text", "choices", "answer_type",
+    "score_correct", "score_incorrect", "feedback_correct", "feedback_incorrect",
+}
+CHOICE_KEYS = {"text", "is_correct"}
+ANSWER_TYPES = ("multiple", "single")
+
+
+class QuizValidationError(ValueError):
+    def __init__(self, path, errors):
+        super().__init__(f"{path}: {len(errors)}件の誤りがあります")
+        self.path = path
+        self.errors = errors
+
+
+def _is_text(value):
+    return isinstance(value, str) or (isinstance(value, list) and all(isinstance(line, str) for line in value))
+
+
+def _check_text(obj, key, where, errors):
+    if key in obj and not _is_text(obj[key]):
+        errors.append(f"{where}.{key}: 文字列か文字列のリストにしてください")
+
+
+def _check_unknown(obj, allowed, where, warnings):
+    for key in obj:
+        if key not in allowed:
+            warnings.append(f"{where}.{key}: 使われない項目です（綴りを確認してください）")
+
+
+def _validate_question(question, where, errors, warnings):
+    if not isinstance(question, dict):
+        errors.append(f"{where}: 問題はオブジェクトにしてください")
+        return
+    _check_unknown(question, QUESTION_KEYS, where, warnings)
+    for key in TEXT_KEYS[1:]:
+        _check_text(question, key, where, errors)
+    if not question.get("question_text"):
+        errors.append(f"{where}.question_text: 問題文がありません")
+    for key in ("score_correct", "score_incorrect"):
+        value = question.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+            errors.append(f"{where}.{key}: 整数にしてください")
+    answer_type = question.get("answer_type", "multiple")
+    if answer_type not in ANSWER_TYPES:
+        errors.append(f"{where}.answer_type: {' / '.join(ANSWER_TYPES)} のいずれかにしてください")
+
+    choices = question.get("choices")
+    if not isinstance(choices, list) or not choices:
+        errors.append(f"{where}.choices: 選択肢のリストがありません")
+        return
+    texts = set()
+    correct = 0
+    for i, choice in enumerate(choices):
+        at = f"{where}.choices[{i}]"
+        if not isinstance(choice, dict):
+            errors.append(f"{at}: 選択肢はオブジェクトにしてください")
+            continue
+        _check_unknown(choice, CHOICE_KEYS, at, warnings)
+        text = choice.get("text")
+        if not isinstance(text, str) or not text:
+            errors.append(f"{at}.text: 選択肢の文言がありません")
+        elif text in texts:
+            # 回答は選択肢の文言で記録するので、同じ文言があると区別できない
+            errors.append(f"{at}.text: 同じ選択肢がすでにあります（{text}）")
+        else:
+            texts.add(text)
+        if not isinstance(choice.get("is_correct", False), bool):
+            errors.append(f"{at}.is_correct: true / false にしてください")
+        elif choice.get("is_correct"):
+            correct += 1
+    if correct == 0:
+        errors.append(f"{where}.choices: 正解の選択肢がありません（誰も正解できません）")
+    elif answer_type == "single" and correct > 1:
+        errors.append(f"{where}.choices: single の問題に正解が{correct}個あります")
+
+
+def validate_quiz(quiz_data):
+    # (誤りのリスト, 警告のリスト) を返す。誤りがあればコンパイルしない
+    errors = []
+    warnings = []
+    if isinstance(quiz_data, list):
+        stages = [(f"[{i}]", stage) for i, stage in enumerate(quiz_data)]
+    elif isinstance(quiz_data, dict):
+        _check_text(quiz_data, "title", "$", errors)
+        if "stages" in quiz_data:
+            _check_unknown(quiz_data, {"title", "stages"}, "$", warnings)
+            if not isinstance(quiz_data["stages"], list):
+                errors.append("$.stages: ステージのリストにしてください")
+                return errors, warnings
+            stages = [(f"stages[{i}]", stage) for i, stage in enumerate(quiz_data["stages"])]
+        elif "questions" in quiz_data:
+            _check_unknown(quiz_data, {"title", "questions"}, "$", warnings)
+            stages = [("$", {"questions": quiz_data["questions"]})]
+        else:
+            errors.append("$: stages か questions が必要です")
+            return errors, warnings
+    else:
+        errors.append("$: ステージのリストか、stages / questions を持つオブジェクトにしてください")
+        return errors, warnings
+
+    total = 0
+    for where, stage in stages:
+        if not isinstance(stage, dict):
+            errors.append(f"{where}: ステージはオブジェクトにしてください")
+            continue
+        _check_unknown(stage, STAGE_KEYS, where, warnings)
+        _check_text(stage, "section_title", where, errors)
+        _check_text(stage, "section_story", where, errors)
+        questions = stage.get("questions", [])
+        if not isinstance(questions, list):
+            errors.append(f"{where}.questions: 問題のリストにしてください")
+            continue
+        for j, question in enumerate(questions):
+            _validate_question(question, f"{where}.questions[{j}]", errors, warnings)
+        total += len(questions)
+    if total == 0:
+        errors.append("$: 問題が1問もありません")
+    return errors, warnings
+
+
+def compile_file(json_path, out_path=None):
+    # JSON を検証してコンパイル済みファイルを書き、(出力先, 警告のリスト) を返す
+    with open(json_path, "rb") as f:
+        content = f.read()
+    try:
+        quiz_data = json.loads(content.decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise QuizValidationError(json_path, [f"JSON として読めません: {e}"])
+    errors, warnings = validate_quiz(quiz_data)
+    if errors:
+        raise QuizValidationError(json_path, errors)
+
+    content_hash = hashlib.sha256(content).hexdigest()
+    # パスと mtime は読み込む側で入れる。配点の既定値も読み込む側（アプリ）で埋める
+    quiz = compile_quiz(quiz_data, content_hash=content_hash, score_correct=None, score_incorrect=None)
+    data = artifact_bytes(quiz, content_hash)
+    # 書き出したものがそのまま読めることを確かめてから置き換える
+    read_artifact(data)
+
+    out_path = out_path or artifact_path(json_path)
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, out_path)
+    return out_path, warnings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=f"クイズJSONを検証し、コンパイル済みファイル（{ARTIFACT_EXT}）を作る")
+    parser.add_argument("json_files", nargs="+")
+    parser.add_argument("--check", action="store_true", help="検証だけ行い、ファイルは書かない")
+    parser.add_argument("-o", "--output", help="出力先（JSON を1つだけ指定したとき）")
+    args = parser.parse_args(argv)
+    if args.output and len(args.json_files) > 1:
+        parser.error("-o は JSON を1つだけ指定したときに使えます")
+
+    failed = False
+    for json_path in args.json_files:
+        try:
+            if args.check:
+                with open(json_path, "r", encoding="utf-8") as f:
+                    errors, warnings = validate_quiz(json.load(f))
+                if errors:
+                    raise QuizValidationError(json_path, errors)
+                out_path = None
+            else:
+                out_path, warnings = compile_file(json_path, args.output)
+        except QuizValidationError as e:
+            failed = True
+            print(f"{e}", file=sys.stderr)
+            for error in e.errors:
+                print(f"  誤り: {error}", file=sys.stderr)
+            continue
+        except (OSError, ValueError) as e:
+            failed = True
+            print(f"{json_path}: {e}", file=sys.stderr)
+            continue
+        for warning in warnings:
+            print(f"{json_path}: 警告: {warning}", file=sys.stderr)
+        print(f"{json_path}: OK" + (f" → {out_path}" if out_path else ""))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,251 @@
+import threading
+import weakref
+from dataclasses import dataclass
+
+from quiz_loader import add_eviction_listener, load_quiz, load_version
+from quiz_metrics import instrument
+from quiz_rank import get_rank, get_rank_emoji
+from quiz_session import QuizSession
+
+# クイズの進行を表す遷移表。
+# 読み込んだクイズ（リスト形式 / ステージ形式 / 問題リスト形式）を一度だけ画面（ステップ）の並びに変換し、
+# 各アプリはセッションが指すステップを描画するだけにする。ボタン操作は表を1回引くだけで済む。
+
+INTRO = "intro"            # 問題のないステージ（スタートボタン）
+QUESTION = "question"
+ENDING = "ending"          # エンディングのステージ
+GAME_OVER = "game_over"    # ゲームオーバー（ステージがあればそのステージ）
+FINISH = "finish"          # エンディングのステージがないときの終了画面
+
+ENDING_MARK = "エンディング"
+GAME_OVER_MARK = "ゲームオーバー"
+
+
+@dataclass(frozen=True, slots=True)
+class QuizRules:
+    initial_score: int = 0
+    score_correct: int = 0          # 問題に書かれていないときの既定値
+    score_incorrect: int = 0
+    game_over_score: object = None  # このスコア以下でゲームオーバー（None ならなし）
+    stage_screens: bool = False     # ステージの導入・エンディング画面を使うか
+    ranks: bool = False             # ランク表示を使うか
+
+
+# クイズの形式（リスト / stages / questions）ごとの採点ルール。
+# 各形式のアプリの画面と、画面を使わない一括採点（quiz_grading.py）で同じものを使う。
+SHAPE_RULES = {
+    "list": QuizRules(initial_score=100, game_over_score=0),
+    "stages": QuizRules(initial_score=100, score_incorrect=-20, game_over_score=0, stage_screens=True),
+    "questions": QuizRules(initial_score=0, score_correct=20, ranks=True),
+}
+
+
+@dataclass(frozen=True, slots=True)
+class Step:
+    kind: str
+    stage: int              # ステージ番号（なければ -1）
+    question: int           # 問題の通し番号（問題でなければ -1）
+    next: int               # 次のステップ番号（終端は自分自身）
+    first_in_stage: bool = False
+
+
+class QuizEngine:
+    def __init__(self, quiz, rules):
+        self.quiz = quiz
+        self.rules = rules
+        self.steps, self.game_over_step = _compile_steps(quiz, rules)
+        self.rank_table = _compile_ranks(quiz, rules) if rules.ranks else {}
+
+    def new_session(self):
+        # セッションは開始したときの遷移表を持ち続ける（途中でクイズが更新されても問題番号がずれない）
+        session = QuizSession(score=self.rules.initial_score)
+        session.engine = self
+        return session
+
+    def version(self, content_hash):
+        # 同じクイズ・ルールの別の版（チェックポイントから古い版のセッションを再開するとき）
+        if content_hash == self.quiz.content_hash:
+            return self
+        return load_engine_version(self, content_hash)
+
+    def current(self, session):
+        return self.steps[session.step]
+
+    def question(self, step):
+        return self.quiz.questions[step.question]
+
+    def stage(self, step):
+        return self.quiz.stages[step.stage] if step.stage >= 0 else None
+
+    def answered(self, session):
+        step = self.steps[session.step]
+        return step.kind == QUESTION and len(session.answers) > step.question
+
+    def selected(self, session):
+        # 現在の問題で選んだ選択肢（未回答なら空）
+        if not self.answered(session):
+            return ()
+        step = self.steps[session.step]
+        return self.question(step).selected(session.answers[step.question])
+
+    def last_correct(self, session):
+        step = self.steps[session.step]
+        return self.question(step).is_correct_mask(session.answers[step.question])
+
+    def score_before(self, session):
+        # 現在の問題に回答する前のスコア
+        if not self.answered(session):
+            return session.score
+        q = self.question(self.steps[session.step])
+        return session.score - (q.score_correct if self.last_correct(session) else q.score_incorrect)
+
+    @instrument("answer_grading")
+    def answer(self, session, mask):
+        step = self.steps[session.step]
+        if step.kind != QUESTION or self.answered(session):
+            return None
+        q = self.question(step)
+        correct = q.is_correct_mask(mask)
+        session.score += q.score_correct if correct else q.score_incorrect
+        session.answers.append(mask)
+        if self.game_over_step is not None and session.score <= self.rules.game_over_score:
+            session.step = self.game_over_step
+        return correct
+
+    def advance(self, session):
+        session.step = self.steps[session.step].next
+
+    def on_question(self, session):
+        return self.steps[session.step].kind == QUESTION
+
+    def finished(self, session):
+        return self.steps[session.step].kind in (ENDING, GAME_OVER, FINISH)
+
+    def answer_texts(self, session):
+        # 結果ファイルに書く形（選んだ選択肢を ", " でつないだもの）
+        return [", ".join(q.selected(mask)) for q, mask in zip(self.quiz.questions, session.answers)]
+
+    def rank(self, score):
+        entry = self.rank_table.get(score)
+        if entry is None:
+            rank = get_rank(score)
+            entry = (rank, get_rank_emoji(rank))
+        return entry
+
+
+def _stage_kind(stage):
+    title = "".join(stage.section_title)
+    if GAME_OVER_MARK in title:
+        return GAME_OVER
+    if ENDING_MARK in title:
+        return ENDING
+    return INTRO if not stage.questions else QUESTION
+
+
+def _compile_steps(quiz, rules):
+    # (kind, stage, question, first_in_stage) を並べてから next をつなぐ
+    linear = []
+    game_over = None
+    if rules.stage_screens:
+        ending_stage = None
+        game_over_stage = None
+        kinds = [_stage_kind(stage) for stage in quiz.stages]
+        for i, kind in enumerate(kinds):
+            # 同じ印のステージが複数あれば最後のものを使う
+            if kind == ENDING:
+                ending_stage = i
+            elif kind == GAME_OVER:
+                game_over_stage = i
+        terminal = False
+        for i, (stage, kind) in enumerate(zip(quiz.stages, kinds)):
+            if kind == QUESTION:
+                for j in range(len(stage.questions)):
+                    linear.append((QUESTION, i, stage.first_question + j, j == 0))
+            elif kind == INTRO:
+                linear.append((INTRO, i, -1, False))
+            else:
+                # エンディング・ゲームオーバーのステージに着いたらそこで終わり
+                linear.append((kind, i, -1, False))
+                terminal = True
+                break
+        if not terminal:
+            linear.append((ENDING, ending_stage, -1, False) if ending_stage is not None else (FINISH, -1, -1, False))
+        if rules.game_over_score is not None and game_over_stage is not None:
+            game_over = (GAME_OVER, game_over_stage, -1, False)
+    else:
+        for j in range(len(quiz.questions)):
+            linear.append((QUESTION, -1, j, False))
+        linear.append((FINISH, -1, -1, False))
+        if rules.game_over_score is not None:
+            game_over = (GAME_OVER, -1, -1, False)
+
+    steps = []
+    last = len(linear) - 1
+    for i, (kind, stage, question, first) in enumerate(linear):
+        steps.append(Step(kind, stage, question, i if i == last else i + 1, first))
+    game_over_step = None
+    if game_over is not None:
+        game_over_step = len(steps)
+        steps.append(Step(game_over[0], game_over[1], game_over[2], game_over_step))
+    return tuple(steps), game_over_step
+
+
+def _compile_ranks(quiz, rules):
+    # 到達しうるスコアの範囲についてランクを前もって引いておく
+    low = high = rules.initial_score
+    for q in quiz.questions:
+        low += min(q.score_correct, q.score_incorrect, 0)
+        high += max(q.score_correct, q.score_incorrect, 0)
+    table = {}
+    for score in range(low, high + 1):
+        rank = get_rank(score)
+        table[score] = (rank, get_rank_emoji(rank))
+    return table
+
+
+_lock = threading.Lock()
+_engines = {}
+# 版ごとの遷移表。セッションから参照されている間だけ残り、参照がなくなれば捨てられる
+_versions = weakref.WeakValueDictionary()     # (クイズのパス, ルール, 内容ハッシュ) -> QuizEngine
+
+
+def _drop_engines(quiz):
+    # クイズがキャッシュから捨てられたら、その遷移表も一緒に捨てる
+    with _lock:
+        for key in [key for key, engine in _engines.items() if engine.quiz is quiz]:
+            del _engines[key]
+
+
+add_eviction_listener(_drop_engines)
+
+
+@instrument("quiz_load")
+def load_engine(json_path, rules):
+    # クイズファイルが変わったときだけ遷移表を作り直す
+    quiz = load_quiz(json_path, rules.score_correct, rules.score_incorrect)
+    key = (json_path, rules)
+    engine = _engines.get(key)
+    if engine is None or engine.quiz is not quiz:
+        with _lock:
+            engine = _engines.get(key)
+            if engine is None or engine.quiz is not quiz:
+                engine = _engines[key] = QuizEngine(quiz, rules)
+                _versions[(quiz.path, rules, quiz.content_hash)] = engine
+    return engine
+
+
+def load_engine_version(engine, content_hash):
+    # engine と同じクイズ・ルールの、内容ハッシュが content_hash の版（残っていなければ None）
+    key = (engine.quiz.path, engine.rules, content_hash)
+    version = _versions.get(key)
+    if version is not None:
+        return version
+    quiz = load_version(engine.quiz.path, content_hash, engine.rules.score_correct, engine.rules.score_incorrect)
+    if quiz is None:
+        return None
+    with _lock:
+        version = _versions.get(key)
+        if version is None:
+            version = QuizEngine(quiz, engine.rules)
+            _versions[key] = version
+    return version
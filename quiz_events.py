@@ -0,0 +1,265 @@
+import argparse
+import atexit
+import datetime
+import glob
+import gzip
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+
+from result_store import DURABILITY_GROUP, ResultWriter
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 受講中の操作（開始・再開・回答・画面の遷移・終了）を1行1件の JSONL に追記する操作ログ。
+# 途中でやめた受講者や回答にかかった時間も残る。save_result と同じくライタースレッドに積むだけで、
+# キューが一杯なら待たずに捨てる（件数は ResultWriter.dropped に数える）ので、クリックの応答は遅くならない。
+#
+# プロセスごとに events-<開始日時>-<pid>-<連番>.jsonl.active に書き、大きさ・経過時間・日付の変わり目で
+# .jsonl に閉じて次のファイルに移る。前日までのファイルは compact で日ごとの gzip にまとめる。
+#
+#   QUIZ_EVENTS=0               操作ログを取らない
+#   QUIZ_EVENT_DIR              書き出すディレクトリ（既定: quiz_events）
+#   QUIZ_EVENT_MAX_BYTES        1ファイルの上限（既定: 16MiB）
+#   QUIZ_EVENT_MAX_AGE          1ファイルに書く時間の上限（秒、既定: 3600）
+#   QUIZ_EVENT_FSYNC=1          バッチごとに fsync する（既定はしない。行単位で OS には渡している）
+#
+#   python quiz_events.py compact          # 前日までのファイルを archive/events-YYYY-MM-DD.jsonl.gz に追記
+#   python quiz_events.py cat --day 2026-10-18
+
+ENABLED = os.environ.get("QUIZ_EVENTS", "1") != "0"
+EVENT_DIR = "quiz_events"
+ARCHIVE_DIR = "archive"
+MAX_BYTES = 16 * 1024 * 1024
+MAX_AGE = 3600.0
+ACTIVE_SUFFIX = ".active"
+SEGMENT_NAME = re.compile(r"events-(\d{8})-(\d{6})-(\d+)-(\d+)\.jsonl(\.active)?")
+
+START = "start"
+RESUME = "resume"         # 接続し直したときなど、チェックポイントから続きを読み込んだ
+ANSWER = "answer"
+TRANSITION = "transition"
+FINISH = "finish"
+THROTTLED = "throttled"   # 回数の制限で捨てた回答・遷移（採点も画面の遷移もしていない）
+
+
+class EventLogSink:
+    # ResultWriter のシンク。レコードは dict で、JSON への変換もライタースレッドで行う
+    def __init__(self, directory=EVENT_DIR, max_bytes=MAX_BYTES, max_age=MAX_AGE, fsync=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync = fsync
+        self._file = None
+        self._path = None
+        self._day = None
+        self._opened = 0.0
+        self._size = 0
+        self._seq = 0       # 同じ秒のうちに切り替えても名前が重ならないように
+
+    def _open(self, now):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = now.strftime("%Y%m%d-%H%M%S")
+        self._seq += 1
+        self._path = os.path.join(self.directory, f"events-{stamp}-{os.getpid()}-{self._seq}.jsonl{ACTIVE_SUFFIX}")
+        # 行バッファ: 1件ごとに OS へ渡すので、プロセスが落ちても書き終えた行は残る
+        self._file = open(self._path, "a", encoding="utf-8", buffering=1)
+        self._day = now.date()
+        self._opened = time.monotonic()
+        self._size = self._file.tell()
+
+    def _needs_rotation(self, now):
+        return (
+            self._size >= self.max_bytes
+            or time.monotonic() - self._opened >= self.max_age
+            or now.date() != self._day
+        )
+
+    def write(self, records, sync):
+        for record in records:
+            now = datetime.datetime.now()
+            if self._file is not None and self._needs_rotation(now):
+                self.close()
+            if self._file is None:
+                self._open(now)
+            line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+            self._file.write(line)
+            self._size += len(line.encode("utf-8"))
+        if sync and self.fsync and self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        # 書き終えたファイルは .active を外し、compact の対象にする
+        if self._file is None:
+            return
+        self._file.close()
+        os.replace(self._path, self._path[:-len(ACTIVE_SUFFIX)])
+        self._file = None
+        self._path = None
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def get_event_log():
+    global _log
+    if not ENABLED:
+        return None
+    if _log is None:
+        with _log_lock:
+            if _log is None:
+                sink = EventLogSink(
+                    os.environ.get("QUIZ_EVENT_DIR", EVENT_DIR),
+                    max_bytes=int(os.environ.get("QUIZ_EVENT_MAX_BYTES", MAX_BYTES)),
+                    max_age=float(os.environ.get("QUIZ_EVENT_MAX_AGE", MAX_AGE)),
+                    fsync=os.environ.get("QUIZ_EVENT_FSYNC", "") not in ("", "0"),
+                )
+                _log = ResultWriter(sink, durability=DURABILITY_GROUP, batch_size=1024, flush_interval=0.5, name="event")
+                atexit.register(_log.close)
+    return _log
+
+
+def log_event(event, engine, session, **fields):
+    # 画面側から呼ぶ。dict を作ってキューに積むだけ
+    log = get_event_log()
+    if log is None or not session.id:
+        return
+    record = {
+        "ts": datetime.datetime.now().isoformat(timespec="milliseconds"),
+        "event": event,
+        "session": session.id,
+        "user_id": session.user_id,
+        "quiz": engine.quiz.path,
+        "quiz_hash": engine.quiz.content_hash,
+        "step": session.step,
+        "score": session.score,
+    }
+    record.update(fields)
+    log.submit(record, block=False)
+
+
+def _segment_day(name):
+    match = SEGMENT_NAME.fullmatch(name)
+    if match is None:
+        return None
+    return datetime.datetime.strptime(match.group(1), "%Y%m%d").date()
+
+
+def _segment_order(path):
+    # 開始日時、pid、連番（数値）の順。名前の文字列順だと連番 10 が 2 より前になる
+    match = SEGMENT_NAME.fullmatch(os.path.basename(path))
+    return (match.group(1), match.group(2), int(match.group(3)), int(match.group(4))) if match else ("", "", 0, 0)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def closed_segments(directory, before):
+    # before より前の日付のファイル。.active でも書いていたプロセスがもういなければ対象にする
+    segments = {}
+    for path in sorted(glob.glob(os.path.join(directory, "events-*.jsonl*")), key=_segment_order):
+        name = os.path.basename(path)
+        match = SEGMENT_NAME.fullmatch(name)
+        if match is None:
+            continue
+        day = _segment_day(name)
+        if day >= before:
+            continue
+        if match.group(5) and _pid_alive(int(match.group(3))):
+            continue
+        segments.setdefault(day, []).append(path)
+    return segments
+
+
+def archive_path(directory, day):
+    return os.path.join(directory, ARCHIVE_DIR, f"events-{day.isoformat()}.jsonl.gz")
+
+
+def _append_archive(path, segments):
+    # gzip のメンバーを1つ追記する（gzip は複数のメンバーを続けて読める）。途中で失敗したら元の長さに戻す
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as raw:
+        if fcntl is not None:
+            fcntl.flock(raw.fileno(), fcntl.LOCK_EX)
+        start = raw.seek(0, os.SEEK_END)
+        try:
+            with gzip.GzipFile(fileobj=raw, mode="ab") as out:
+                for segment in segments:
+                    with open(segment, "rb") as f:
+                        shutil.copyfileobj(f, out)
+            raw.flush()
+            os.fsync(raw.fileno())
+        except BaseException:
+            raw.truncate(start)
+            raise
+
+
+def compact(directory=EVENT_DIR, before=None):
+    # 前日までのファイルを日ごとのアーカイブにまとめて消す。{日付: ファイル数} を返す
+    before = before or datetime.date.today()
+    done = {}
+    for day, segments in sorted(closed_segments(directory, before).items()):
+        _append_archive(archive_path(directory, day), segments)
+        for segment in segments:
+            os.remove(segment)
+        done[day.isoformat()] = len(segments)
+    return done
+
+
+def iter_events(directory=EVENT_DIR, day=None):
+    # アーカイブ、まだまとめていないファイルの順に読む。書きかけの最後の行などは飛ばす
+    pattern = day.isoformat() if day else "*"
+    paths = sorted(glob.glob(os.path.join(directory, ARCHIVE_DIR, f"events-{pattern}.jsonl.gz")))
+    segments = sorted(glob.glob(os.path.join(directory, "events-*.jsonl*")), key=_segment_order)
+    paths += [p for p in segments if day is None or _segment_day(os.path.basename(p)) == day]
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="操作ログの圧縮と表示")
+    parser.add_argument("--dir", default=os.environ.get("QUIZ_EVENT_DIR", EVENT_DIR))
+    commands = parser.add_subparsers(dest="command", required=True)
+    compact_parser = commands.add_parser("compact", help="前日までのファイルを日ごとの gzip にまとめる")
+    compact_parser.add_argument("--before", type=datetime.date.fromisoformat, help="この日より前を対象にする（既定: 今日）")
+    cat_parser = commands.add_parser("cat", help="操作ログを JSONL で書き出す")
+    cat_parser.add_argument("--day", type=datetime.date.fromisoformat)
+    args = parser.parse_args(argv)
+
+    if args.command == "compact":
+        try:
+            done = compact(args.dir, args.before)
+        except OSError as e:
+            print(f"操作ログをまとめられませんでした: {e}", file=sys.stderr)
+            return 1
+        for day, count in done.items():
+            print(f"{day}: {count}ファイルを {archive_path(args.dir, datetime.date.fromisoformat(day))} にまとめました")
+        return 0
+    for event in iter_events(args.dir, args.day):
+        print(json.dumps(event, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
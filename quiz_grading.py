@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from quiz_engine import INTRO, QUESTION, SHAPE_RULES, load_engine
+from quiz_loader import load_quiz, quiz_path, split_answer
+
+# 受講画面と同じ採点ルールで、回答用紙をまとめて採点する（Streamlit の画面は使わない）。
+# 回答は問題の通し番号順に、選んだ選択肢の文言のリスト / ", " で連結した文字列 / ビットマスクで渡す。
+# NumPy があれば回答用紙 × 問題のビットマスク行列で一括採点し、なければ1枚ずつ QuizEngine を進める。
+#
+#   python quiz_grading.py --port 8765
+#   curl -X POST localhost:8765/grade -d '{"quiz": "quiz_data_v2.json", "sheets": [{"id": "A001", "answers": [["端末"]]}]}'
+#
+# QUIZ_GRADING_TOKEN を設定すると、Authorization: Bearer <トークン> のないリクエストを断る。
+
+DEFAULT_PORT = 8765
+MAX_BODY_BYTES = 32 * 1024 * 1024
+MAX_VECTOR_CHOICES = 62     # int64 のビットマスクに収まる選択肢の数
+
+
+class SheetError(ValueError):
+    pass
+
+
+def rules_for(quiz):
+    # quiz_app.py と同じく、クイズの形式に対応するアプリの採点ルールを使う
+    return SHAPE_RULES[quiz.shape]
+
+
+def load_grader(quiz_file, rules=None):
+    if rules is None:
+        rules = rules_for(load_quiz(quiz_file))
+    return load_engine(quiz_file, rules)
+
+
+def answer_mask(question, answer):
+    if answer is None or answer == "":
+        return 0
+    if isinstance(answer, bool):
+        raise SheetError("回答に true / false は使えません")
+    if isinstance(answer, int):
+        if answer < 0 or answer >> len(question.choices):
+            raise SheetError(f"ビットマスク {answer} が選択肢の数を超えています")
+        return answer
+    selected = split_answer(answer, question.choices) if isinstance(answer, str) else list(answer)
+    unknown = [text for text in selected if text not in question.choices]
+    if unknown:
+        raise SheetError(f"選択肢にない回答です: {', '.join(map(str, unknown))}")
+    return question.mask(selected)
+
+
+def sheet_masks(engine, answers):
+    # 回答用紙の回答を問題ごとのビットマスクに変換する（足りない分は未回答）
+    questions = engine.quiz.questions
+    if not isinstance(answers, list):
+        raise SheetError("answers はリストにしてください")
+    if len(answers) > len(questions):
+        raise SheetError(f"回答が問題数（{len(questions)}）より多くあります")
+    masks = [0] * len(questions)
+    for i, answer in enumerate(answers):
+        try:
+            masks[i] = answer_mask(questions[i], answer)
+        except SheetError as e:
+            raise SheetError(f"問{i+1}: {e}")
+    return masks
+
+
+def _result(engine, score, correct, game_over):
+    result = {"score": score, "correct": correct, "answered": len(correct), "game_over": game_over}
+    if engine.rules.ranks:
+        result["rank"], result["emoji"] = engine.rank(score)
+    return result
+
+
+def grade_one(engine, masks):
+    # 画面の操作と同じ順に QuizEngine を進める（基準になる実装）
+    session = engine.new_session()
+    correct = []
+    while True:
+        step = engine.current(session)
+        if step.kind == INTRO:
+            engine.advance(session)
+        elif step.kind == QUESTION:
+            correct.append(engine.answer(session, masks[step.question]))
+            if not engine.on_question(session):
+                break
+            engine.advance(session)
+        else:
+            break
+    return _result(engine, session.score, correct, engine.game_over_step is not None and session.step == engine.game_over_step)
+
+
+def question_order(engine):
+    # 受講者が回答する順の問題の通し番号（エンディングより後のステージの問題は含まない）
+    return [step.question for step in engine.steps if step.kind == QUESTION]
+
+
+def grade_masks(engine, rows):
+    # rows: 回答用紙ごとの問題別ビットマスク。結果を同じ順で返す
+    order = question_order(engine)
+    questions = [engine.quiz.questions[i] for i in order]
+    if np is None or not rows or not order or max(len(q.choices) for q in questions) > MAX_VECTOR_CHOICES:
+        return [grade_one(engine, masks) for masks in rows]
+
+    masks = np.array(rows, dtype=np.int64)[:, order]
+    correct_masks = np.array([q.correct_mask for q in questions], dtype=np.int64)
+    correct = (masks == correct_masks) & (masks != 0)
+    deltas = np.where(
+        correct,
+        np.array([q.score_correct for q in questions], dtype=np.int64),
+        np.array([q.score_incorrect for q in questions], dtype=np.int64),
+    )
+    scores = engine.rules.initial_score + np.cumsum(deltas, axis=1)
+
+    n = len(rows)
+    last = np.full(n, len(order) - 1)
+    game_over = np.zeros(n, dtype=bool)
+    if engine.game_over_step is not None:
+        # スコアが閾値以下になった問題でゲームオーバーになり、その後の問題には進まない
+        over = scores <= engine.rules.game_over_score
+        game_over = over.any(axis=1)
+        last = np.where(game_over, over.argmax(axis=1), last)
+    final = scores[np.arange(n), last]
+
+    # 結果の組み立ては Python のオブジェクトに一度に変換してから行う
+    return [
+        _result(engine, score, flags[:end + 1], over)
+        for score, flags, end, over in zip(final.tolist(), correct.tolist(), last.tolist(), game_over.tolist())
+    ]
+
+
+def grade_sheets(engine, sheets):
+    # sheets: [{"id": ..., "answers": [...]}, ...]。読めない回答用紙は error を付けて返す
+    rows = []
+    positions = []
+    results = [None] * len(sheets)
+    for k, sheet in enumerate(sheets):
+        sheet_id = sheet.get("id") if isinstance(sheet, dict) else None
+        try:
+            if not isinstance(sheet, dict):
+                raise SheetError("回答用紙はオブジェクトにしてください")
+            rows.append(sheet_masks(engine, sheet.get("answers", [])))
+            positions.append(k)
+        except SheetError as e:
+            results[k] = {"id": sheet_id, "error": str(e)}
+    for k, result in zip(positions, grade_masks(engine, rows)):
+        results[k] = {"id": sheets[k].get("id"), **result}
+    return results
+
+
+def grade_request(payload):
+    quiz_file = payload.get("quiz")
+    if not isinstance(quiz_file, str) or not quiz_file:
+        raise SheetError("quiz にクイズファイル名を指定してください")
+    path = quiz_path(quiz_file)
+    if path is None:
+        raise SheetError(f"クイズが見つかりません: {quiz_file}")
+    sheets = payload.get("sheets")
+    if not isinstance(sheets, list):
+        raise SheetError("sheets はリストにしてください")
+    engine = load_grader(path)
+    results = grade_sheets(engine, sheets)
+    graded = [r for r in results if "error" not in r]
+    return {
+        "quiz": path,
+        "content_hash": engine.quiz.content_hash,
+        "count": len(results),
+        "errors": len(results) - len(graded),
+        "mean_score": sum(r["score"] for r in graded) / len(graded) if graded else None,
+        "results": results,
+    }
+
+
+class _GradingHandler(BaseHTTPRequestHandler):
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        token = os.environ.get("QUIZ_GRADING_TOKEN")
+        return not token or self.headers.get("Authorization") == f"Bearer {token}"
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "vectorized": np is not None})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/grade":
+            self._send_json(404, {"error": "not found"})
+            return
+        if not self._authorized():
+            self._send_json(401, {"error": "unauthorized"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            self._send_json(413, {"error": f"リクエストが大きすぎます（上限 {MAX_BODY_BYTES} バイト）"})
+            return
+        try:
+            payload = json.loads(self.rfile.read(length).decode("utf-8"))
+            if not isinstance(payload, dict):
+                raise SheetError("リクエストはオブジェクトにしてください")
+            self._send_json(200, grade_request(payload))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            self._send_json(400, {"error": f"JSON として読めません: {e}"})
+        except SheetError as e:
+            self._send_json(400, {"error": str(e)})
+        except (OSError, ValueError) as e:
+            self._send_json(500, {"error": f"クイズを読み込めません: {e}"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=DEFAULT_PORT):
+    server = ThreadingHTTPServer((host, port), _GradingHandler)
+    print(f"採点APIを http://{host}:{port}/grade で待ち受けています")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="回答用紙の一括採点API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+    serve(args.host, args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
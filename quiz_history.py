@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import threading
+
+import streamlit as st
+
+from quiz_rank import get_rank, get_rank_emoji
+from result_store import add_result_listener, make_sink
+
+# 研修IDごとの受験履歴（?admin=1&history=<研修ID> で開く。管理者用画面と同じく admin=1 のときだけ）。
+# 結果ファイルを毎回先頭から読む代わりに、研修ID → 行の位置（CSV ならバイト位置、SQLite なら id）の索引を
+# SQLite に持ち、その位置の行だけを読む。索引は結果を書き込んだ直後（ライタースレッドのリスナー）と
+# 表示の前に、前回どこまで読んだか（チェックポイント）以降の追記分だけを足す。
+#
+#   QUIZ_HISTORY=0          索引を作らない（履歴画面も使えない）
+#   QUIZ_HISTORY_PATH       索引の保存先（既定: quiz_history.db）
+
+ENABLED = os.environ.get("QUIZ_HISTORY", "1") != "0"
+HISTORY_DB = "quiz_history.db"
+
+
+class HistoryIndex:
+    def __init__(self, sink, path=HISTORY_DB):
+        self.sink = sink
+        self.path = path
+        self._conn = None
+        # ライタースレッドとスクリプトスレッドから呼ばれるので、1つの接続をロックで守る
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            # 自動コミットにして、追記分の反映は BEGIN IMMEDIATE でプロセス間でも1つずつ行う
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10.0, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS attempts ("
+                "user_id TEXT NOT NULL, "
+                "pos INTEGER NOT NULL, "
+                "PRIMARY KEY (user_id, pos)) WITHOUT ROWID"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "id INTEGER PRIMARY KEY CHECK (id = 0), "
+                "source TEXT NOT NULL, "
+                "checkpoint INTEGER NOT NULL)"
+            )
+        return self._conn
+
+    def _catch_up(self, conn):
+        # チェックポイント以降に追記された行を索引に足す。足した件数を返す
+        row = conn.execute("SELECT source, checkpoint FROM state WHERE id = 0").fetchone()
+        checkpoint = row[1] if row is not None and row[0] == self.sink.path else 0
+        if row is None or row[0] != self.sink.path:
+            # 別の結果ファイルの索引なので作り直す
+            conn.execute("DELETE FROM attempts")
+        added = 0
+        while True:
+            rows, next_checkpoint = self.sink.read_rows_since(checkpoint)
+            if next_checkpoint < checkpoint:
+                # 結果ファイルが作り直された
+                conn.execute("DELETE FROM attempts")
+            if next_checkpoint == checkpoint and not rows:
+                break
+            conn.executemany(
+                "INSERT OR IGNORE INTO attempts (user_id, pos) VALUES (?, ?)",
+                [(record.user_id, pos) for pos, record in rows],
+            )
+            added += len(rows)
+            checkpoint = next_checkpoint
+        conn.execute(
+            "INSERT OR REPLACE INTO state (id, source, checkpoint) VALUES (0, ?, ?)",
+            (self.sink.path, checkpoint),
+        )
+        return added
+
+    def refresh(self):
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    added = self._catch_up(conn)
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+            return added
+        except (sqlite3.Error, OSError) as e:
+            print(f"受験履歴の索引を更新できませんでした: {e}")
+            return 0
+
+    def on_written(self, records):
+        # ResultWriter のリスナー。書き込んだ直後に追記分を索引に足す
+        self.refresh()
+
+    def attempts(self, user_id):
+        # 研修IDの受験結果を古い順に返す
+        self.refresh()
+        with self._lock:
+            positions = [pos for pos, in self._connect().execute(
+                "SELECT pos FROM attempts WHERE user_id = ? ORDER BY pos", (user_id,)
+            )]
+        # 索引を作った後に結果ファイルが書き換えられていても、別の人の行は出さない
+        return [record for record in self.sink.read_at(positions) if record.user_id == user_id]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_history():
+    global _index
+    if not ENABLED:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = HistoryIndex(make_sink(), os.environ.get("QUIZ_HISTORY_PATH", HISTORY_DB))
+    return _index
+
+
+def _on_written(records):
+    index = get_history()
+    if index is not None:
+        index.on_written(records)
+
+
+# 受講画面がこのモジュールを読み込んでいれば、結果を保存するたびに索引も進める
+add_result_listener(_on_written)
+
+
+def show_history(user_id):
+    st.header(f"受験履歴：{user_id}")
+    index = get_history()
+    if index is None:
+        st.info("受験履歴は無効になっています。")
+        return
+    records = index.attempts(user_id)
+    if not records:
+        st.info("この研修IDの受験結果はまだありません。")
+        return
+
+    best = max(record.score for record in records)
+    col_attempts, col_best, col_last = st.columns(3)
+    col_attempts.metric("受験回数", len(records))
+    col_best.metric("最高スコア", f"{best}点")
+    col_last.metric("前回のスコア", f"{records[-1].score}点")
+
+    rows = []
+    for i, record in enumerate(records):
+        rank = get_rank(record.score)
+        rows.append({
+            "回": i + 1,
+            "タイムスタンプ": record.timestamp,
+            "クイズ": os.path.basename(record.quiz) or "（クイズ情報なし）",
+            "スコア": record.score,
+            "ランク": f"{get_rank_emoji(rank)} {rank}",
+        })
+    st.dataframe(rows, hide_index=True)
+
+    # 新しい受験から順に、設問ごとの回答を表示する
+    for i, record in reversed(list(enumerate(records))):
+        with st.expander(f"{i + 1}回目（{record.timestamp}）の回答"):
+            st.dataframe(
+                [{"設問": f"問{n + 1}", "回答": answer or "（未選択）"} for n, answer in enumerate(record.answers)],
+                hide_index=True,
+            )
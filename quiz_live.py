@@ -0,0 +1,268 @@
+import collections
+import os
+import threading
+import time
+
+import streamlit as st
+
+# 研修中の受講者の様子をその場で見る講師用のモニター（?admin=live）。
+# 回答・遷移のたびに quiz_session.py からプロセス内の表を O(1) で更新する
+# （問題ごとの人数、スコアごとの人数、最近の回答のリングバッファ）。
+# 画面は数秒ごとにこの表の集計を写すだけで、結果ファイルも操作ログも読まない。
+# 集計はこのプロセスの受講者だけ（複数のプロセスで配信しているときはプロセスごと）。
+#
+#   QUIZ_LIVE=0             モニター用の集計をしない
+#   QUIZ_LIVE_REFRESH       画面の更新間隔（秒、既定: 3）
+#   QUIZ_LIVE_STUCK         同じ問題にこの秒数とどまっている受講者を「止まっている」とする（既定: 120）
+#   QUIZ_LIVE_IDLE          この秒数操作のない受講者は集計から外す（既定: 1800）
+
+ENABLED = os.environ.get("QUIZ_LIVE", "1") != "0"
+REFRESH_SECONDS = float(os.environ.get("QUIZ_LIVE_REFRESH", "3"))
+STUCK_SECONDS = float(os.environ.get("QUIZ_LIVE_STUCK", "120"))
+IDLE_SECONDS = float(os.environ.get("QUIZ_LIVE_IDLE", "1800"))
+RING_SIZE = 500
+MAX_STUCK_ROWS = 20
+
+WAITING = "waiting"     # スタート前や、ステージの間の案内画面
+DONE = "done"           # エンディング・ゲームオーバー・終了画面
+POSITION_LABELS = {WAITING: "スタート・案内", DONE: "終了"}
+
+
+class _Learner:
+    __slots__ = ("user_id", "position", "score", "since", "updated", "wrong")
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.position = None
+        self.score = None
+        self.since = 0.0        # 今の位置に来た時刻（time.monotonic）
+        self.updated = 0.0
+        self.wrong = 0          # この挑戦で間違えた数
+
+
+class _Cohort:
+    def __init__(self, ring_size):
+        self.learners = {}                              # 受講者のキー → _Learner
+        self.occupancy = collections.Counter()          # 位置（問題番号 / WAITING / DONE） → 人数
+        self.scores = collections.Counter()             # スコア → 人数
+        self.recent = collections.deque(maxlen=ring_size)
+        self.answers = 0
+
+
+def _move(counter, old, new):
+    if old is not None:
+        counter[old] -= 1
+        if not counter[old]:
+            del counter[old]
+    counter[new] += 1
+
+
+class LiveMonitor:
+    def __init__(self, ring_size=RING_SIZE, idle=IDLE_SECONDS):
+        self.ring_size = ring_size
+        self.idle = idle
+        self._cohorts = {}      # クイズのパス → _Cohort
+        self._lock = threading.Lock()
+
+    def _cohort(self, quiz):
+        cohort = self._cohorts.get(quiz)
+        if cohort is None:
+            cohort = self._cohorts[quiz] = _Cohort(self.ring_size)
+        return cohort
+
+    def update(self, quiz, key, user_id, position, score, restart=False):
+        # 受講者の位置とスコアを入れ替える。restart なら再挑戦なので間違えた数を戻す
+        now = time.monotonic()
+        with self._lock:
+            cohort = self._cohort(quiz)
+            learner = cohort.learners.get(key)
+            if learner is None:
+                learner = cohort.learners[key] = _Learner(user_id)
+            if learner.position != position:
+                _move(cohort.occupancy, learner.position, position)
+                learner.position = position
+                learner.since = now
+            if learner.score != score:
+                _move(cohort.scores, learner.score, score)
+                learner.score = score
+            if restart:
+                learner.wrong = 0
+            learner.updated = now
+
+    def answer(self, quiz, key, user_id, question, correct, elapsed_ms):
+        with self._lock:
+            cohort = self._cohort(quiz)
+            cohort.recent.append((time.time(), user_id, question, correct, elapsed_ms))
+            cohort.answers += 1
+            learner = cohort.learners.get(key)
+            if learner is not None and not correct:
+                learner.wrong += 1
+
+    def _drop_idle(self, cohort, now):
+        for key in [key for key, learner in cohort.learners.items() if now - learner.updated > self.idle]:
+            learner = cohort.learners.pop(key)
+            cohort.occupancy[learner.position] -= 1
+            if not cohort.occupancy[learner.position]:
+                del cohort.occupancy[learner.position]
+            cohort.scores[learner.score] -= 1
+            if not cohort.scores[learner.score]:
+                del cohort.scores[learner.score]
+
+    def quizzes(self):
+        with self._lock:
+            return sorted(self._cohorts)
+
+    def snapshot(self, quiz, stuck_seconds=STUCK_SECONDS):
+        # 画面に出す集計の写し。ロックを持つのは写す間だけ
+        now = time.monotonic()
+        with self._lock:
+            cohort = self._cohorts.get(quiz)
+            if cohort is None:
+                return None
+            self._drop_idle(cohort, now)
+            stuck = sorted(
+                (
+                    (now - learner.since, learner.user_id, learner.position, learner.wrong)
+                    for learner in cohort.learners.values()
+                    if isinstance(learner.position, int) and now - learner.since >= stuck_seconds
+                ),
+                reverse=True,
+            )[:MAX_STUCK_ROWS]
+            return {
+                "learners": len(cohort.learners),
+                "answers": cohort.answers,
+                "occupancy": dict(cohort.occupancy),
+                "scores": dict(cohort.scores),
+                "recent": list(cohort.recent),
+                "stuck": stuck,
+            }
+
+
+_monitor = LiveMonitor()
+
+
+def get_monitor():
+    return _monitor
+
+
+def _position(engine, session):
+    if engine.on_question(session):
+        return engine.current(session).question
+    return DONE if engine.finished(session) else WAITING
+
+
+def _learner_key(session):
+    # 再挑戦で受講IDが変わっても同じ人として数える
+    return session.user_id or session.id
+
+
+def track(engine, session, restart=False):
+    # quiz_session.py から、セッションを始めた・再開した・進めたときに呼ぶ
+    if not ENABLED or not session.id:
+        return
+    _monitor.update(
+        engine.quiz.path, _learner_key(session), session.user_id,
+        _position(engine, session), session.score, restart,
+    )
+
+
+def track_answer(engine, session, question, correct, elapsed_ms):
+    if not ENABLED or not session.id:
+        return
+    _monitor.answer(engine.quiz.path, _learner_key(session), session.user_id, question, correct, elapsed_ms)
+
+
+def position_label(position):
+    if isinstance(position, int):
+        return f"問{position + 1}"
+    return POSITION_LABELS.get(position, position)
+
+
+def _position_order(position):
+    # スタート前、問題の順、終了の順に並べる
+    if isinstance(position, int):
+        return 1, position
+    return (0, 0) if position == WAITING else (2, 0)
+
+
+def show_live_monitor():
+    st.header("ライブモニター")
+    if not ENABLED:
+        st.info("ライブモニターは無効になっています（QUIZ_LIVE=0）。")
+        return
+    quizzes = _monitor.quizzes()
+    if not quizzes:
+        st.info("このプロセスにはまだ受講者がいません。")
+        return
+    quiz = st.selectbox("クイズ", quizzes, format_func=os.path.basename)
+    _show_cohort(quiz)
+
+
+@st.fragment(run_every=REFRESH_SECONDS)
+def _show_cohort(quiz):
+    # 数秒ごとにこの部分だけを再実行する。読むのはメモリ上の集計だけ
+    snapshot = _monitor.snapshot(quiz)
+    if snapshot is None:
+        st.info("受講者がいません。")
+        return
+    occupancy = snapshot["occupancy"]
+    scores = snapshot["scores"]
+    learners = snapshot["learners"]
+    col_learners, col_done, col_mean, col_answers = st.columns(4)
+    col_learners.metric("受講者", learners)
+    col_done.metric("終了", occupancy.get(DONE, 0))
+    mean = sum(score * n for score, n in scores.items()) / learners if learners else 0
+    col_mean.metric("平均スコア", f"{mean:.1f}点")
+    col_answers.metric("回答数", snapshot["answers"])
+
+    st.subheader("問題ごとの人数")
+    positions = sorted(occupancy, key=_position_order)
+    st.bar_chart(
+        {"位置": [position_label(p) for p in positions], "人数": [occupancy[p] for p in positions]},
+        x="位置", y="人数", sort=False,
+    )
+
+    st.subheader("スコア分布")
+    ordered = sorted(scores)
+    st.bar_chart({"スコア": ordered, "人数": [scores[s] for s in ordered]}, x="スコア", y="人数")
+
+    st.subheader(f"{STUCK_SECONDS:.0f}秒以上同じ問題にいる受講者")
+    if snapshot["stuck"]:
+        st.dataframe(
+            [
+                {"研修ID": user_id, "問題": position_label(position), "経過": f"{seconds / 60:.1f}分", "不正解": wrong}
+                for seconds, user_id, position, wrong in snapshot["stuck"]
+            ],
+            hide_index=True,
+        )
+    else:
+        st.markdown("いません。")
+
+    st.subheader("最近の回答")
+    recent = snapshot["recent"]
+    by_question = {}
+    for _, _, question, correct, _ in recent:
+        stats = by_question.setdefault(question, [0, 0])
+        stats[0] += 1
+        stats[1] += bool(correct)
+    if by_question:
+        st.dataframe(
+            [
+                {"問題": position_label(q), "回答": n, "正答率": f"{c / n:.0%}"}
+                for q, (n, c) in sorted(by_question.items())
+            ],
+            hide_index=True,
+        )
+    st.dataframe(
+        [
+            {
+                "時刻": time.strftime("%H:%M:%S", time.localtime(ts)),
+                "研修ID": user_id,
+                "問題": position_label(question),
+                "結果": "✅" if correct else "❌",
+                "回答時間": f"{elapsed_ms / 1000:.1f}秒",
+            }
+            for ts, user_id, question, correct, elapsed_ms in reversed(recent[-20:])
+        ],
+        hide_index=True,
+    )
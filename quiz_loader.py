@@ -0,0 +1,512 @@
+import hashlib
+import io
+import json
+import os
+import pickle
+import re
+import struct
+import threading
+import time
+from dataclasses import dataclass, replace
+
+# クイズJSONをプロセス内で一度だけ解析し、不変の構造に変換して全セッションで共有する。
+# 再実行（チェックボックスのクリック）ごとのファイル読み込みをなくすためのローダー。
+#
+# 読み込んだファイルはバックグラウンドの監視スレッドが見張り、変更されたら裏でコンパイルして
+# 新しい版に差し替える（読めない JSON なら古い版のまま）。画面側の load_quiz はファイルに触れない。
+# 受講中のセッションは開始したときの版を持ち続ける（quiz_engine.py / quiz_session.py）。
+#   QUIZ_WATCH=0          監視スレッドを使わず、load_quiz の中で mtime を確かめる
+#   QUIZ_VERSION_DIR      受講に使った版の JSON を内容ハッシュの名前で残す場所（既定: quiz_versions）
+#                         残すのはチェックポイントを書く受講のセッションから keep_version を呼んだときだけで、
+#                         load_quiz だけ（一括採点・再採点・コンパイラーなど）ではファイルを作らない
+#   QUIZ_VERSION_KEEP_DAYS 差し替えられてからこの日数が過ぎ、どのチェックポイントも参照していない版を消す
+#                         （既定: 30。0 で消さない）
+
+# mtime を確認する間隔（秒）。この間隔内の呼び出しはファイルI/Oを一切行わない。
+RELOAD_CHECK_INTERVAL = 2.0
+WATCH = os.environ.get("QUIZ_WATCH", "1") != "0"
+# 書き込み途中のファイルを読まないよう、最後の変更からこの秒数が経つまで待つ
+WATCH_SETTLE_SECONDS = 0.5
+VERSION_DIR = os.environ.get("QUIZ_VERSION_DIR", "quiz_versions")
+VERSION_KEEP_SECONDS = float(os.environ.get("QUIZ_VERSION_KEEP_DAYS", 30)) * 86400
+
+# 1プロセスで多数のクイズを配信するときのキャッシュの上限。
+# 件数か元ファイルの合計サイズを超えたら最も長く使われていないものから、
+# 一定時間使われなかったものはその時点で捨てる（次に使われたら読み直す）。
+CACHE_MAX_ENTRIES = int(os.environ.get("QUIZ_CACHE_SIZE", 64))
+CACHE_MAX_BYTES = int(os.environ.get("QUIZ_CACHE_BYTES", 64 * 1024 * 1024))
+CACHE_IDLE_SECONDS = float(os.environ.get("QUIZ_CACHE_IDLE", 3600))
+
+# ?quiz=<ファイル名> や一括採点の "quiz" で指定できるクイズファイルの置き場所
+QUIZ_DIR = os.environ.get("QUIZ_DIR", ".")
+QUIZ_NAME = re.compile(r"[\w.-]+")
+
+# quiz_compiler.py が書き出すコンパイル済みファイル。
+# ヘッダー（マジック + 形式バージョン + 元JSONの sha256）のあとに CompiledQuiz の pickle が続く。
+# JSON の隣に同名の .quizc があり、バージョンと内容ハッシュが一致すれば JSON の解析と正規化を省く。
+ARTIFACT_EXT = ".quizc"
+ARTIFACT_MAGIC = b"QUIZC\0"
+ARTIFACT_VERSION = 1    # Question / Stage / CompiledQuiz の項目を変えたら上げる
+ARTIFACT_HEADER = struct.Struct(f">{len(ARTIFACT_MAGIC)}sH32s")
+
+
+@dataclass(frozen=True, slots=True)
+class Question:
+    section_title: tuple
+    section_story: tuple
+    question_text: tuple
+    choices: tuple          # 選択肢テキスト（表示順）
+    correct: frozenset      # 正解の選択肢テキスト
+    correct_list: tuple     # 正解の選択肢テキスト（表示順）
+    correct_mask: int       # 正解の選択肢番号のビットマスク
+    answer_type: str
+    score_correct: int
+    score_incorrect: int
+    feedback_correct: tuple
+    feedback_incorrect: tuple
+
+    def is_correct(self, selected):
+        return bool(selected) and set(selected) == self.correct
+
+    def is_correct_mask(self, mask):
+        return mask != 0 and mask == self.correct_mask
+
+    def mask(self, selected):
+        # 選んだ選択肢テキストをビットマスクにする（ビット i が choices[i]）
+        selected = set(selected)
+        return sum(1 << i for i, text in enumerate(self.choices) if text in selected)
+
+    def selected(self, mask):
+        return tuple(text for i, text in enumerate(self.choices) if mask >> i & 1)
+
+
+@dataclass(frozen=True, slots=True)
+class Stage:
+    section_title: tuple
+    section_story: tuple
+    questions: tuple
+    first_question: int     # このステージ最初の問題の通し番号
+
+
+@dataclass(frozen=True, slots=True)
+class CompiledQuiz:
+    path: str
+    mtime_ns: int
+    content_hash: str
+    shape: str              # "list" / "stages" / "questions"
+    title: tuple
+    stages: tuple
+    questions: tuple        # 全ステージの問題を順に並べたもの
+
+
+def as_lines(x):
+    # str または list のテキストを行のタプルに正規化する
+    if isinstance(x, list):
+        return tuple(str(line) for line in x)
+    if x is None or x == "":
+        return ()
+    return (str(x),)
+
+
+def split_answer(answer, choices):
+    # ", " で連結された回答を選択肢に戻す（選択肢の中に ", " があっても分割しすぎない）
+    if not answer:
+        return []
+    selected = []
+    current = None
+    for token in answer.split(", "):
+        current = token if current is None else current + ", " + token
+        if current in choices:
+            selected.append(current)
+            current = None
+    if current is not None:
+        selected.append(current)
+    return selected
+
+
+def quiz_path(name):
+    # ?quiz= の値をクイズディレクトリ内のファイルに変換する（ディレクトリの外は指せない。なければ None）
+    if not name or not QUIZ_NAME.fullmatch(name) or name.startswith("."):
+        return None
+    if not name.endswith(".json"):
+        name += ".json"
+    path = os.path.join(QUIZ_DIR, name) if QUIZ_DIR != "." else name
+    return path if os.path.isfile(path) else None
+
+
+def _compile_question(question, stage_title, stage_story, number, defaults):
+    choices = question.get("choices", [])
+    texts = tuple(c["text"] for c in choices)
+    correct_list = tuple(c["text"] for c in choices if c.get("is_correct"))
+    if "section_title" in question:
+        section_title = as_lines(question["section_title"])
+    elif stage_title:
+        section_title = stage_title
+    else:
+        section_title = (f"第{number}問",)
+    return Question(
+        section_title=section_title,
+        section_story=as_lines(question.get("section_story", "")) or stage_story,
+        question_text=as_lines(question.get("question_text", "")),
+        choices=texts,
+        correct=frozenset(correct_list),
+        correct_list=correct_list,
+        correct_mask=sum(1 << i for i, c in enumerate(choices) if c.get("is_correct")),
+        answer_type=question.get("answer_type", "multiple"),
+        score_correct=question.get("score_correct", defaults[0]),
+        score_incorrect=question.get("score_incorrect", defaults[1]),
+        feedback_correct=as_lines(question.get("feedback_correct", "")),
+        feedback_incorrect=as_lines(question.get("feedback_incorrect", "")),
+    )
+
+
+def compile_quiz(quiz_data, path="", mtime_ns=0, content_hash="", score_correct=0, score_incorrect=0):
+    # 3種類の形式（ステージのリスト / {"title", "stages"} / {"title", "questions"}）を共通の構造にする
+    defaults = (score_correct, score_incorrect)
+    if isinstance(quiz_data, list):
+        shape = "list"
+        title = ()
+        raw_stages = quiz_data
+    elif "stages" in quiz_data:
+        shape = "stages"
+        title = as_lines(quiz_data.get("title", "クイズタイトル未設定"))
+        raw_stages = quiz_data.get("stages", [])
+    else:
+        shape = "questions"
+        title = as_lines(quiz_data.get("title", "クイズタイトル未設定"))
+        raw_stages = [{"questions": quiz_data.get("questions", [])}]
+
+    stages = []
+    flat = []
+    for stage in raw_stages:
+        stage_title = as_lines(stage.get("section_title", ""))
+        stage_story = as_lines(stage.get("section_story", ""))
+        first_question = len(flat)
+        questions = []
+        for question in stage.get("questions", []):
+            q = _compile_question(question, stage_title, stage_story, len(flat) + 1, defaults)
+            questions.append(q)
+            flat.append(q)
+        stages.append(Stage(stage_title, stage_story, tuple(questions), first_question))
+
+    return CompiledQuiz(
+        path=path,
+        mtime_ns=mtime_ns,
+        content_hash=content_hash,
+        shape=shape,
+        title=title,
+        stages=tuple(stages),
+        questions=tuple(flat),
+    )
+
+
+def apply_score_defaults(quiz, score_correct, score_incorrect):
+    # コンパイル済みファイルでは未指定の配点が None になっているので、アプリの既定値で埋める
+    def fill(q):
+        if q.score_correct is not None and q.score_incorrect is not None:
+            return q
+        return replace(
+            q,
+            score_correct=score_correct if q.score_correct is None else q.score_correct,
+            score_incorrect=score_incorrect if q.score_incorrect is None else q.score_incorrect,
+        )
+
+    questions = tuple(fill(q) for q in quiz.questions)
+    if all(a is b for a, b in zip(questions, quiz.questions)):
+        return quiz
+    stages = tuple(
+        replace(stage, questions=questions[stage.first_question:stage.first_question + len(stage.questions)])
+        for stage in quiz.stages
+    )
+    return replace(quiz, stages=stages, questions=questions)
+
+
+class _ArtifactUnpickler(pickle.Unpickler):
+    # コンパイル済みファイルから復元してよいのはクイズの構造だけ
+    ALLOWED = {"Question": Question, "Stage": Stage, "CompiledQuiz": CompiledQuiz}
+
+    def find_class(self, module, name):
+        if module == __name__ and name in self.ALLOWED:
+            return self.ALLOWED[name]
+        raise pickle.UnpicklingError(f"{module}.{name} はコンパイル済みクイズに含められません")
+
+
+def read_artifact_header(data):
+    # (バージョン, 元JSONの sha256) を返す。コンパイル済みファイルでなければ ValueError
+    if len(data) < ARTIFACT_HEADER.size:
+        raise ValueError("コンパイル済みクイズのヘッダーが不完全です")
+    magic, version, source_hash = ARTIFACT_HEADER.unpack_from(data)
+    if magic != ARTIFACT_MAGIC:
+        raise ValueError("コンパイル済みクイズではありません")
+    return version, source_hash.hex()
+
+
+def read_artifact(data):
+    version, source_hash = read_artifact_header(data)
+    if version != ARTIFACT_VERSION:
+        raise ValueError(f"コンパイル済みクイズの形式が古いか新しすぎます（{version}、対応は {ARTIFACT_VERSION}）")
+    quiz = _ArtifactUnpickler(io.BytesIO(data[ARTIFACT_HEADER.size:])).load()
+    return replace(quiz, content_hash=source_hash)
+
+
+def artifact_bytes(quiz, source_hash):
+    header = ARTIFACT_HEADER.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, bytes.fromhex(source_hash))
+    return header + pickle.dumps(quiz, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def artifact_path(json_path):
+    return os.path.splitext(json_path)[0] + ARTIFACT_EXT
+
+
+def _load_sibling_artifact(path, content_hash):
+    # JSON と同じ内容からコンパイルされたファイルがあればそれを使う（なければ None）
+    try:
+        with open(artifact_path(path), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    try:
+        version, source_hash = read_artifact_header(data)
+        if version != ARTIFACT_VERSION or source_hash != content_hash:
+            return None
+        return read_artifact(data)
+    except (ValueError, pickle.UnpicklingError) as e:
+        print(f"コンパイル済みクイズを読めません（JSON を使います）: {e}")
+        return None
+
+
+class _Entry:
+    __slots__ = ("quiz", "size", "checked", "used", "failed")
+
+    def __init__(self, quiz, size, checked, used=None):
+        self.quiz = quiz
+        self.size = size
+        self.checked = checked
+        self.used = checked if used is None else used   # 最後に使われた時刻（LRU の順番）
+        self.failed = None      # コンパイルに失敗した mtime（同じ失敗を何度も表示しない）
+
+
+_lock = threading.Lock()
+_entries = {}    # (絶対パス, 既定値) -> _Entry
+_eviction_listeners = []
+
+
+def add_eviction_listener(listener):
+    # listener(quiz) はキャッシュから捨てたクイズごとに呼ばれる（ロックを持ったまま呼ぶので軽い処理にする）
+    _eviction_listeners.append(listener)
+
+
+def _evict(now):
+    # _lock を持った状態で呼ぶ
+    evicted = [key for key, entry in _entries.items() if now - entry.used > CACHE_IDLE_SECONDS]
+    for key in evicted:
+        _discard(key)
+    total = sum(entry.size for entry in _entries.values())
+    while len(_entries) > 1 and (len(_entries) > CACHE_MAX_ENTRIES or total > CACHE_MAX_BYTES):
+        key = min(_entries, key=lambda k: _entries[k].used)
+        total -= _entries[key].size
+        _discard(key)
+
+
+def _discard(key):
+    entry = _entries.pop(key)
+    for listener in _eviction_listeners:
+        try:
+            listener(entry.quiz)
+        except Exception as e:
+            print(f"クイズキャッシュのリスナーでエラーが発生しました: {e}")
+
+
+def _version_path(content_hash):
+    return os.path.join(VERSION_DIR, f"{content_hash}.json")
+
+
+_kept = {}          # クイズのパス -> このプロセスで最後に版を残した内容ハッシュ
+_kept_lock = threading.Lock()
+
+
+def keep_version(quiz, referenced):
+    # 受講のセッションがチェックポイントを書くときに呼ぶ。版ごとの JSON を残し、
+    # チェックポイントから古い版のセッションを再開できるようにする（同じ版は一度だけ）。
+    # referenced() はチェックポイントが参照している内容ハッシュの集合を返す（読めなければ None）
+    with _kept_lock:
+        previous = _kept.get(quiz.path)
+    if previous == quiz.content_hash:
+        return
+    path = _version_path(quiz.content_hash)
+    if os.path.exists(path):
+        with _kept_lock:
+            _kept[quiz.path] = quiz.content_hash
+        return
+    try:
+        with open(quiz.path, "rb") as f:
+            content = f.read()
+    except OSError as e:
+        print(f"クイズの版を保存できませんでした: {e}")
+        return
+    if hashlib.sha256(content).hexdigest() != quiz.content_hash:
+        # 読み込んだ後にファイルが書き換えられた（コンパイル済みファイルを直接使っているときも）
+        return
+    try:
+        os.makedirs(VERSION_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"クイズの版を保存できませんでした: {e}")
+        return
+    with _kept_lock:
+        _kept[quiz.path] = quiz.content_hash
+    if previous is not None:
+        # 差し替えられた版は、ここから保持期間を数える（残していない版なら何もしない）
+        try:
+            os.utime(_version_path(previous))
+        except OSError:
+            pass
+    prune_versions(referenced(), keep={quiz.content_hash})
+
+
+def prune_versions(referenced, keep=()):
+    # referenced（チェックポイントが参照している版）にもキャッシュにもない版のうち、保持期間を過ぎたものを消す。
+    # 新しい版を残したときにだけ呼ぶ（版が変わらない限りディレクトリを見ない）
+    if VERSION_KEEP_SECONDS <= 0 or referenced is None:
+        # 参照を確かめられないときは何も消さない
+        return
+    keep = set(keep) | referenced
+    keep.update(entry.quiz.content_hash for entry in list(_entries.values()))
+    cutoff = time.time() - VERSION_KEEP_SECONDS
+    try:
+        names = os.listdir(VERSION_DIR)
+    except OSError:
+        return
+    for name in names:
+        content_hash, ext = os.path.splitext(name)
+        if ext != ".json" or content_hash in keep:
+            continue
+        path = os.path.join(VERSION_DIR, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+        except OSError as e:
+            print(f"古いクイズの版を削除できませんでした: {e}")
+
+
+def load_version(json_path, content_hash, score_correct=0, score_incorrect=0):
+    # 以前に読み込んだ版を内容ハッシュで読み直す（キャッシュには入れない）。残っていなければ None
+    try:
+        with open(_version_path(content_hash), "rb") as f:
+            content = f.read()
+    except OSError:
+        return None
+    quiz_data = json.loads(content.decode("utf-8"))
+    return compile_quiz(quiz_data, os.path.abspath(json_path), 0, content_hash, score_correct, score_incorrect)
+
+
+def _read_and_compile(path, stat, defaults, previous):
+    with open(path, "rb") as f:
+        content = f.read()
+    if path.endswith(ARTIFACT_EXT):
+        # コンパイル済みファイルを直接指定されたとき
+        quiz = read_artifact(content)
+        if previous is not None and previous.content_hash == quiz.content_hash:
+            return replace(previous, mtime_ns=stat.st_mtime_ns)
+        return apply_score_defaults(replace(quiz, path=path, mtime_ns=stat.st_mtime_ns), *defaults)
+    content_hash = hashlib.sha256(content).hexdigest()
+    if previous is not None and previous.content_hash == content_hash:
+        # 内容が同じなら解析し直さず、mtime だけ差し替える
+        return replace(previous, mtime_ns=stat.st_mtime_ns)
+    quiz = _load_sibling_artifact(path, content_hash)
+    if quiz is not None:
+        quiz = apply_score_defaults(replace(quiz, path=path, mtime_ns=stat.st_mtime_ns), *defaults)
+    else:
+        quiz_data = json.loads(content.decode("utf-8"))
+        quiz = compile_quiz(quiz_data, path, stat.st_mtime_ns, content_hash, *defaults)
+    return quiz
+
+
+def load_quiz(json_path, score_correct=0, score_incorrect=0):
+    # パス + mtime + 内容ハッシュでキャッシュし、変更がない限り同じオブジェクトを返す
+    path = os.path.abspath(json_path)
+    defaults = (score_correct, score_incorrect)
+    key = (path, defaults)
+    now = time.monotonic()
+    entry = _entries.get(key)
+    # 監視スレッドがあれば、変更は差し替えで反映されるのでここでは確かめない
+    if entry is not None and (WATCH or now - entry.checked < RELOAD_CHECK_INTERVAL):
+        entry.used = now
+        return entry.quiz
+
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and (WATCH or now - entry.checked < RELOAD_CHECK_INTERVAL):
+            entry.used = now
+            return entry.quiz
+        stat = os.stat(path)
+        if entry is not None and entry.quiz.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+            entry.checked = entry.used = now
+        else:
+            quiz = _read_and_compile(path, stat, defaults, entry.quiz if entry is not None else None)
+            entry = _entries[key] = _Entry(quiz, stat.st_size, now)
+        # 使われていないクイズの掃除は、ファイルを確認するついでに行う
+        _evict(now)
+        if WATCH:
+            _start_watcher()
+        return entry.quiz
+
+
+def _changed(key, entry):
+    # 差し替えるべき新しい版を返す（変わっていない、書き込み中、読めないときは None）
+    path, defaults = key
+    try:
+        stat = os.stat(path)
+    except OSError:
+        # 消されたり置き換えの途中だったりするときは、今の版を使い続ける
+        return None
+    if entry.quiz.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+        return None
+    if time.time() - stat.st_mtime < WATCH_SETTLE_SECONDS:
+        return None
+    try:
+        quiz = _read_and_compile(path, stat, defaults, entry.quiz)
+    except Exception as e:
+        # 編集中の壊れた JSON などで受講を止めない
+        if entry.failed != stat.st_mtime_ns:
+            print(f"クイズを更新できません（前の版を使い続けます）: {path}: {e}")
+            entry.failed = stat.st_mtime_ns
+        return None
+    return _Entry(quiz, stat.st_size, time.monotonic(), used=entry.used)
+
+
+def _watch():
+    while True:
+        time.sleep(RELOAD_CHECK_INTERVAL)
+        # コンパイルはロックの外で行い、差し替えだけをロックの中で行う
+        for key, entry in list(_entries.items()):
+            new = _changed(key, entry)
+            if new is None:
+                continue
+            with _lock:
+                if _entries.get(key) is entry:
+                    _entries[key] = new
+                    if new.quiz is not entry.quiz:
+                        print(f"クイズを更新しました: {key[0]} ({new.quiz.content_hash[:12]})")
+        with _lock:
+            _evict(time.monotonic())
+
+
+_watcher = None
+
+
+def _start_watcher():
+    # _lock を持った状態で呼ぶ
+    global _watcher
+    if _watcher is None:
+        _watcher = threading.Thread(target=_watch, name="quiz-watcher", daemon=True)
+        _watcher.start()
+
+
+def clear_cache():
+    with _lock:
+        for key in list(_entries):
+            _discard(key)
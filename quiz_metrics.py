@@ -0,0 +1,240 @@
+import atexit
+import bisect
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import streamlit as st
+
+# 再実行の主な区間（クイズ読み込み、セッション初期化、問題の描画、採点、save_result、st.rerun による遷移）の
+# 所要時間をプロセス内のヒストグラムに集める。環境変数 QUIZ_METRICS=1 のときだけ有効で、
+# 無効なら instrument() は関数をそのまま返し、timed() は何もしないコンテキストを返す。
+#
+#   QUIZ_METRICS=1                   計測を有効にする
+#   QUIZ_METRICS_PORT=9464           /metrics（Prometheus テキスト）と /metrics.json を配信する（0 なら配信しない）
+#   QUIZ_METRICS_DUMP=metrics.json   QUIZ_METRICS_DUMP_INTERVAL 秒（既定 60）ごとに JSON を書き出す
+
+ENABLED = os.environ.get("QUIZ_METRICS", "") not in ("", "0")
+DEFAULT_PORT = 9464
+DEFAULT_DUMP_INTERVAL = 60.0
+# バケットの上限（秒）。Prometheus の le と同じく「この値以下」の件数を数える
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RERUN_KEY = "_metrics_rerun_started"
+
+
+class Histogram:
+    __slots__ = ("name", "counts", "sum", "count", "_lock")
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0] * (len(BUCKETS) + 1)    # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = []
+        running = 0
+        for n in counts:
+            running += n
+            cumulative.append(running)
+        return {"count": count, "sum": total, "buckets": cumulative}
+
+
+_lock = threading.Lock()
+_histograms = {}
+
+
+def get_histogram(name):
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _lock:
+            histogram = _histograms.setdefault(name, Histogram(name))
+    return histogram
+
+
+def observe(name, seconds):
+    if ENABLED:
+        get_histogram(name).observe(seconds)
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        # st.rerun() / st.stop() の例外で抜けたときも計る
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+_NULL = nullcontext()
+
+
+def timed(name):
+    if not ENABLED:
+        return _NULL
+    _start_exporters()
+    return _Timer(get_histogram(name))
+
+
+def instrument(name):
+    # 関数全体を計るデコレーター。無効なら関数をそのまま返すので呼び出しの負担はない
+    def decorate(func):
+        if not ENABLED:
+            return func
+        histogram = get_histogram(name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            _start_exporters()
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def rerun_started():
+    # st.rerun() を呼ぶ直前の時刻を残し、次の実行が始まったところで rerun_finished() が差を記録する
+    if ENABLED:
+        st.session_state[RERUN_KEY] = time.perf_counter()
+
+
+def rerun_finished():
+    if ENABLED:
+        started = st.session_state.pop(RERUN_KEY, None)
+        if started is not None:
+            observe("rerun_transition", time.perf_counter() - started)
+
+
+def snapshot():
+    with _lock:
+        histograms = list(_histograms.values())
+    phases = {}
+    for histogram in sorted(histograms, key=lambda h: h.name):
+        data = histogram.snapshot()
+        phases[histogram.name] = {
+            "count": data["count"],
+            "sum_s": round(data["sum"], 6),
+            "mean_ms": round(data["sum"] / data["count"] * 1000, 3) if data["count"] else None,
+            "buckets": {_le(i): n for i, n in enumerate(data["buckets"])},
+        }
+    return {
+        "generated": datetime.datetime.now().isoformat(timespec="seconds"),
+        "pid": os.getpid(),
+        "phases": phases,
+    }
+
+
+def _le(i):
+    return "+Inf" if i == len(BUCKETS) else repr(BUCKETS[i])
+
+
+def prometheus_text():
+    with _lock:
+        histograms = list(_histograms.values())
+    lines = [
+        "# HELP quiz_phase_seconds Time spent in each phase of a quiz app rerun.",
+        "# TYPE quiz_phase_seconds histogram",
+    ]
+    for histogram in sorted(histograms, key=lambda h: h.name):
+        data = histogram.snapshot()
+        label = f'phase="{histogram.name}"'
+        for i, n in enumerate(data["buckets"]):
+            lines.append(f'quiz_phase_seconds_bucket{{{label},le="{_le(i)}"}} {n}')
+        lines.append(f"quiz_phase_seconds_sum{{{label}}} {data['sum']:.6f}")
+        lines.append(f"quiz_phase_seconds_count{{{label}}} {data['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def dump_json(path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(snapshot(), f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = prometheus_text().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body = json.dumps(snapshot(), ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _serve(port):
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+    except OSError as e:
+        # 同じマシンで複数のプロセスを動かしたときなど。計測は続ける
+        print(f"メトリクスの配信を開始できませんでした（ポート {port}）: {e}")
+        return
+    threading.Thread(target=server.serve_forever, name="quiz-metrics-http", daemon=True).start()
+
+
+def _dump_periodically(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            dump_json(path)
+        except OSError as e:
+            print(f"メトリクスの書き出しに失敗しました: {e}")
+
+
+_started = False
+
+
+def _start_exporters():
+    # 最初に計測したときに一度だけ、配信用と書き出し用のスレッドを立てる
+    global _started
+    if _started:
+        return
+    with _lock:
+        if _started:
+            return
+        _started = True
+    port = int(os.environ.get("QUIZ_METRICS_PORT", DEFAULT_PORT))
+    if port:
+        _serve(port)
+    path = os.environ.get("QUIZ_METRICS_DUMP")
+    if path:
+        interval = float(os.environ.get("QUIZ_METRICS_DUMP_INTERVAL", DEFAULT_DUMP_INTERVAL))
+        threading.Thread(target=_dump_periodically, args=(path, interval), name="quiz-metrics-dump", daemon=True).start()
+        atexit.register(dump_json, path)
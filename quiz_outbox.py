@@ -0,0 +1,461 @@
+import argparse
+import atexit
+import contextlib
+import http.client
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode, urlsplit
+
+from quiz_rank import get_rank
+
+# 受講結果を LMS やアンケートのシステムに Webhook で送るアウトボックス。
+# 終了画面では save_result と同じところで SQLite の表に1行ずつ書くだけで、送信は配送スレッドが行う。
+# 送り先が止まっていても遅くても、終了画面の応答時間は変わらない。送れなかったものは表に残り、
+# 間隔を伸ばしながら（指数バックオフ）送り直す。プロセスを再起動しても、表に残っていれば送られる。
+#
+# 配送スレッドは送り先ごとに最大 QUIZ_WEBHOOK_BATCH 件を JSON の配列で1回の POST にまとめ、
+# 送り先のホストごとに keep-alive の接続を使い回す。複数のプロセスで同じ表を使っても、
+# 取り出した行には期限つきの予約（リース）をかけるので二重には送らない（期限切れの後は送り直す）。
+#
+#   QUIZ_WEBHOOKS           送り先（"lms=https://lms.example/hook,survey=http://localhost:8765/"）。空なら何もしない
+#   QUIZ_OUTBOX_PATH        アウトボックスの保存先（既定: quiz_outbox.db）
+#   QUIZ_WEBHOOK_BATCH      1回の POST にまとめる件数（既定: 50）
+#   QUIZ_WEBHOOK_TIMEOUT    接続・応答のタイムアウト（秒、既定: 5）
+#   QUIZ_WEBHOOK_MAX_ATTEMPTS  この回数失敗したら送るのをやめる（既定: 20）
+#   QUIZ_SURVEY_URL         終了画面のアンケートのリンク先（研修ID とスコアをクエリに付ける）
+#
+#   python quiz_outbox.py status           # 送信待ち・送信をやめたものの件数
+#   python quiz_outbox.py drain            # 今送れるものをこのプロセスで送る
+#   python quiz_outbox.py retry            # 送信をやめたものを送信待ちに戻す
+#   python quiz_outbox.py stub --port 8765 --fail-rate 0.3   # 動作確認用の受け口
+
+OUTBOX_DB = "quiz_outbox.db"
+BATCH_SIZE = 50
+TIMEOUT = 5.0
+MAX_ATTEMPTS = 20
+BACKOFF_BASE = 2.0          # 1回目の失敗の後に待つ秒数。失敗するたびに倍にする
+BACKOFF_MAX = 600.0
+LEASE_SECONDS = 60.0        # 取り出した行を他のプロセスが取らない時間（送信のタイムアウトより長くする）
+POLL_INTERVAL = 5.0         # 他のプロセスが書いた行を見に行く間隔
+MAX_IDLE_CONNECTIONS = 4    # ホストごとに残しておく接続の数
+RESULT_EVENT = "quiz.result"
+SURVEY_URL = os.environ.get("QUIZ_SURVEY_URL", "")
+
+
+def parse_targets(text):
+    # "名前=URL,名前=URL" を {名前: URL} にする
+    targets = {}
+    for item in text.split(","):
+        name, sep, url = item.strip().partition("=")
+        if not sep or not name or not url:
+            continue
+        if urlsplit(url).scheme not in ("http", "https"):
+            print(f"Webhook の URL が正しくありません（http / https のみ）: {url}")
+            continue
+        targets[name.strip()] = url.strip()
+    return targets
+
+
+def result_payload(record, title=""):
+    return {
+        "event": RESULT_EVENT,
+        "user_id": record.user_id,
+        "score": record.score,
+        "rank": get_rank(record.score),
+        "timestamp": record.timestamp,
+        "quiz": os.path.basename(record.quiz),
+        "quiz_hash": record.quiz_hash,
+        "title": title,
+        "answers": list(record.answers),
+    }
+
+
+def survey_link(base_url, user_id, score):
+    # アンケートに研修ID とスコアを引き継ぐ
+    separator = "&" if "?" in base_url else "?"
+    return base_url + separator + urlencode({"user_id": user_id, "score": score})
+
+
+class ConnectionPool:
+    # (scheme, host, port) ごとに keep-alive の接続を残しておき、次の送信で使い回す
+    def __init__(self, timeout=TIMEOUT, max_idle=MAX_IDLE_CONNECTIONS):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _key(self, url):
+        parts = urlsplit(url)
+        return parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80)
+
+    def _get(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return cls(host, port, timeout=self.timeout), False
+
+    def _put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def post(self, url, body, headers):
+        # (ステータス, 応答ヘッダー) を返す。使い回した接続が相手に切られていたら、新しい接続で1回だけやり直す
+        key = self._key(url)
+        parts = urlsplit(url)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        while True:
+            conn, reused = self._get(key)
+            try:
+                conn.request("POST", path, body=body, headers=headers)
+                response = conn.getresponse()
+                # 読み切らないと接続を使い回せない
+                response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._put(key, conn)
+            return response.status, response.headers
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+class Outbox:
+    def __init__(self, path=OUTBOX_DB):
+        self.path = path
+        self._conn = None
+        # スクリプトスレッドと配送スレッドから呼ばれるので、1つの接続をロックで守る
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "target TEXT NOT NULL, "
+                "payload TEXT NOT NULL, "
+                "created REAL NOT NULL, "
+                "due REAL NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "last_error TEXT NOT NULL DEFAULT '', "
+                "dead INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (dead, due)")
+        return self._conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # ロックを持ったまま BEGIN IMMEDIATE で書き込みを始める（ほかのプロセスとも1つずつになる）
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def add(self, targets, payload):
+        # 送り先ごとに1行ずつ書く。書けなければ False（受講は止めない）
+        now = time.time()
+        text = json.dumps(payload, ensure_ascii=False)
+        try:
+            with self._transaction() as conn:
+                conn.executemany(
+                    "INSERT INTO outbox (target, payload, created, due) VALUES (?, ?, ?, ?)",
+                    [(target, text, now, now) for target in targets],
+                )
+            return True
+        except sqlite3.Error as e:
+            print(f"通知をアウトボックスに書けませんでした: {e}")
+            return False
+
+    def claim(self, targets, limit, lease=LEASE_SECONDS):
+        # 送る時刻になった行を取り出し、lease 秒のあいだ他から取られないようにする。[(id, 送り先, payload, 失敗回数)]
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                f"SELECT id, target, payload, attempts FROM outbox "
+                f"WHERE dead = 0 AND due <= ? AND target IN ({', '.join('?' * len(targets))}) "
+                "ORDER BY due, id LIMIT ?",
+                (now, *targets, limit),
+            ).fetchall()
+            conn.executemany("UPDATE outbox SET due = ? WHERE id = ?", [(now + lease, row[0]) for row in rows])
+        return rows
+
+    def delivered(self, ids):
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in ids])
+
+    def failed(self, rows, error, delay, permanent=False, max_attempts=MAX_ATTEMPTS):
+        # 失敗した行の次の送信時刻を決める。送り直しても無駄なもの、回数を使い切ったものは dead にする
+        now = time.time()
+        updates = []
+        for row_id, _, _, attempts in rows:
+            attempts += 1
+            dead = int(permanent or attempts >= max_attempts)
+            updates.append((attempts, now + delay(attempts), error[:500], dead, row_id))
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE outbox SET attempts = ?, due = ?, last_error = ?, dead = ? WHERE id = ?", updates
+            )
+
+    def next_due(self, targets):
+        with self._lock:
+            row = self._connect().execute(
+                f"SELECT MIN(due) FROM outbox WHERE dead = 0 AND target IN ({', '.join('?' * len(targets))})",
+                tuple(targets),
+            ).fetchone()
+        return row[0]
+
+    def status(self):
+        with self._lock:
+            return self._connect().execute(
+                "SELECT target, dead, COUNT(*), MIN(created), MAX(attempts), MAX(last_error) "
+                "FROM outbox GROUP BY target, dead ORDER BY target, dead"
+            ).fetchall()
+
+    def revive(self):
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE outbox SET dead = 0, attempts = 0, due = ? WHERE dead = 1", (time.time(),)
+            ).rowcount
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def backoff(attempts):
+    # 2, 4, 8 … 秒（上限 BACKOFF_MAX）。同時に失敗した行がそろって送り直さないよう揺らす
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+
+def _retry_after(headers):
+    try:
+        return float(headers.get("Retry-After", ""))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class Dispatcher:
+    # アウトボックスから取り出して送る配送スレッド
+    def __init__(self, outbox, targets, batch_size=BATCH_SIZE, timeout=TIMEOUT, max_attempts=MAX_ATTEMPTS):
+        self.outbox = outbox
+        self.targets = targets
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.pool = ConnectionPool(timeout)
+        self.sent = 0
+        self.failures = 0
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="outbox-dispatcher", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def close(self, timeout=2.0):
+        # 送り終えていないものは表に残り、次に起動したときに送られる
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.pool.close()
+
+    def _send(self, target, rows):
+        url = self.targets[target]
+        body = ("[" + ",".join(payload for _, _, payload, _ in rows) + "]").encode("utf-8")
+        headers = {
+            "Content-Type": "application/json; charset=utf-8",
+            "X-Outbox-Ids": ",".join(str(row[0]) for row in rows),    # 受け側での重複排除用
+        }
+        try:
+            status, response_headers = self.pool.post(url, body, headers)
+        except (OSError, http.client.HTTPException) as e:
+            self.failures += len(rows)
+            self.outbox.failed(rows, f"{type(e).__name__}: {e}", backoff, max_attempts=self.max_attempts)
+            return
+        if 200 <= status < 300:
+            self.outbox.delivered([row[0] for row in rows])
+            self.sent += len(rows)
+            return
+        self.failures += len(rows)
+        # 408 / 429 / 5xx は送り直す。それ以外の 4xx は何度送っても同じなのでやめる
+        permanent = 400 <= status < 500 and status not in (408, 429)
+        wait = _retry_after(response_headers)
+        self.outbox.failed(
+            rows, f"HTTP {status}", lambda attempts: max(wait, backoff(attempts)), permanent, self.max_attempts
+        )
+
+    def drain_once(self):
+        # 今送れるものを送り、取り出した件数を返す
+        rows = self.outbox.claim(list(self.targets), self.batch_size * len(self.targets))
+        by_target = {}
+        for row in rows:
+            by_target.setdefault(row[1], []).append(row)
+        for target, target_rows in by_target.items():
+            for i in range(0, len(target_rows), self.batch_size):
+                self._send(target, target_rows[i:i + self.batch_size])
+        return len(rows)
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                if self.drain_once():
+                    continue
+                next_due = self.outbox.next_due(list(self.targets))
+            except Exception as e:
+                # 配送スレッドは止めない（次の周回でやり直す）
+                print(f"通知の送信中にエラーが発生しました: {e}")
+                next_due = None
+            wait = POLL_INTERVAL if next_due is None else min(POLL_INTERVAL, max(0.0, next_due - time.time()))
+            self._wake.wait(wait)
+            self._wake.clear()
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    # 送り先が設定されていなければ None
+    global _dispatcher
+    if _dispatcher is None:
+        targets = parse_targets(os.environ.get("QUIZ_WEBHOOKS", ""))
+        if not targets:
+            return None
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = Dispatcher(
+                    Outbox(os.environ.get("QUIZ_OUTBOX_PATH", OUTBOX_DB)),
+                    targets,
+                    batch_size=int(os.environ.get("QUIZ_WEBHOOK_BATCH", BATCH_SIZE)),
+                    timeout=float(os.environ.get("QUIZ_WEBHOOK_TIMEOUT", TIMEOUT)),
+                    max_attempts=int(os.environ.get("QUIZ_WEBHOOK_MAX_ATTEMPTS", MAX_ATTEMPTS)),
+                )
+                _dispatcher.start()
+                atexit.register(_dispatcher.close)
+    return _dispatcher
+
+
+def notify_result(record, title=""):
+    # 終了画面から save_result の直後に呼ぶ。表に書いて配送スレッドを起こすだけ
+    dispatcher = get_dispatcher()
+    if dispatcher is None:
+        return False
+    if not dispatcher.outbox.add(list(dispatcher.targets), result_payload(record, title)):
+        return False
+    dispatcher.wake()
+    return True
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # 動作確認用の受け口。fail_rate の割合で 503 を返す
+    protocol_version = "HTTP/1.1"
+    fail_rate = 0.0
+    received = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if random.random() < self.fail_rate:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        items = json.loads(body)
+        type(self).received += len(items)
+        print(f"{self.path}: {len(items)}件（累計 {type(self).received}件）ids={self.headers.get('X-Outbox-Ids')}")
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="受講結果の通知（アウトボックス）の確認と送信")
+    parser.add_argument("--db", default=os.environ.get("QUIZ_OUTBOX_PATH", OUTBOX_DB))
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="送り先ごとの送信待ち・送信をやめた件数")
+    commands.add_parser("drain", help="QUIZ_WEBHOOKS の送り先に、今送れるものを送る")
+    commands.add_parser("retry", help="送信をやめたものを送信待ちに戻す")
+    stub_parser = commands.add_parser("stub", help="動作確認用の受け口を起動する")
+    stub_parser.add_argument("--port", type=int, default=8765)
+    stub_parser.add_argument("--fail-rate", type=float, default=0.0, help="503 を返す割合")
+    args = parser.parse_args(argv)
+
+    if args.command == "stub":
+        _StubHandler.fail_rate = args.fail_rate
+        server = ThreadingHTTPServer(("127.0.0.1", args.port), _StubHandler)
+        print(f"http://127.0.0.1:{args.port}/ で待ち受けています")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    outbox = Outbox(args.db)
+    if args.command == "status":
+        rows = outbox.status()
+        if not rows:
+            print("送信待ちはありません")
+        for target, dead, count, oldest, attempts, error in rows:
+            state = "送信をやめたもの" if dead else "送信待ち"
+            since = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(oldest))
+            print(f"{target}: {state} {count}件（最古 {since}、最大失敗回数 {attempts}）{error}")
+        return 0
+    if args.command == "retry":
+        print(f"{outbox.revive()}件を送信待ちに戻しました")
+        return 0
+
+    targets = parse_targets(os.environ.get("QUIZ_WEBHOOKS", ""))
+    if not targets:
+        print("QUIZ_WEBHOOKS に送り先を設定してください", file=sys.stderr)
+        return 1
+    dispatcher = Dispatcher(outbox, targets)
+    while dispatcher.drain_once():
+        pass
+    dispatcher.pool.close()
+    print(f"送信 {dispatcher.sent}件、失敗 {dispatcher.failures}件")
+    return 0 if not dispatcher.failures else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
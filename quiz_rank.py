@@ -0,0 +1,33 @@
+# スコアからランクを決める（v4 のレベルアップ方式）
+
+def get_rank(score):
+    if score == 100:
+        return "マスター"
+    elif score >= 80:
+        return "上級者"
+    elif score >= 60:
+        return "中級者"
+    elif score >= 40:
+        return "初級者"
+    elif score >= 20:
+        return "初心者"
+    else:
+        return "入門者"
+
+def get_rank_emoji(rank):
+    if rank == "マスター":
+        return "🏆"
+    elif rank == "上級者":
+        return "🥈"
+    elif rank == "中級者":
+        return "🥉"
+    elif rank == "初級者":
+        return "🌱"
+    elif rank == "初心者":
+        return "🔰"
+    else:  # 入門者
+        return "🚩"
+
+
+# 低い順
+RANKS = ("入門者", "初心者", "初級者", "中級者", "上級者", "マスター")
@@ -0,0 +1,289 @@
+import collections
+import os
+import threading
+import time
+import uuid
+
+import streamlit as st
+from streamlit.errors import StreamlitAPIException
+
+from quiz_checkpoint import get_store
+from quiz_events import ANSWER, FINISH, RESUME, START, THROTTLED, TRANSITION, log_event
+from quiz_live import track, track_answer
+from quiz_loader import keep_version
+from quiz_metrics import instrument, rerun_finished, rerun_started
+
+# 受講者1人分の進行状況。持つのはステップ番号とスコアと回答のビットマスクだけで、
+# 解説や正解、画面の並びは共有の QuizEngine（quiz_engine.py）から引く。
+# 画面からの回答と遷移は submit_answer() / advance() を通し、操作ログ（quiz_events.py）と
+# チェックポイント（quiz_checkpoint.py）に残し、ライブモニター（quiz_live.py）の集計を進める。
+#
+# 研修ID があれば、セッションは st.session_state ではなくプロセス全体の表（研修ID × クイズ）に置く。
+# 接続が切れて Streamlit のセッションが作り直されても同じ進行状況に戻り、
+# QUIZ_SESSION_IDLE 秒（既定 1800）操作のないものは表から外す（続きはチェックポイントから読み直す）。
+#
+# 回答・次へのボタンには遷移のたびに変わるトークン（transition_token）をキーに入れ、押されたときに
+# submit_answer() / advance() に渡す。遅い回線での連打や、同じ 研修ID の別のタブからの古い画面の操作は、
+# トークンが今のものと違うので採点も再実行もせずに捨てる。あわせてセッションごとに遷移の回数を
+# トークンバケットで制限する（QUIZ_TRANSITION_BURST 回まで続けて、その後は1秒に QUIZ_TRANSITION_RATE 回）。
+# 制限で捨てた操作は操作ログに throttled として残し、画面には少し待つよう短く表示する。
+#   QUIZ_TRANSITION_RATE=0    回数の制限をしない
+
+SESSION_KEY = "quiz"
+IDLE_SECONDS = float(os.environ.get("QUIZ_SESSION_IDLE", "1800"))
+SWEEP_INTERVAL = 60.0
+TRANSITION_BURST = float(os.environ.get("QUIZ_TRANSITION_BURST", "5"))
+TRANSITION_RATE = float(os.environ.get("QUIZ_TRANSITION_RATE", "2"))
+THROTTLE_MESSAGE = "操作が続いたため、今の操作は受け付けませんでした。少し待ってからもう一度押してください。"
+
+
+class QuizSession:
+    __slots__ = (
+        "step", "score", "answers", "result_saved", "id", "user_id", "step_started", "used", "engine",
+        "allowance", "allowance_at",
+    )
+
+    def __init__(self, score=0):
+        self.step = 0             # QuizEngine.steps の番号
+        self.score = score
+        self.answers = []         # 問題ごとの選択肢ビットマスク
+        self.result_saved = False
+        self.id = ""              # 操作ログの受講ID（一括採点など画面のないセッションは空で、ログに残さない）
+        self.user_id = ""
+        self.step_started = 0.0   # 今のステップに入った時刻（time.monotonic）
+        self.used = 0.0           # 最後に画面から使われた時刻（time.monotonic）
+        self.engine = None        # 開始したときの版の QuizEngine（QuizEngine.new_session が入れる）
+        self.allowance = 0.0      # 今すぐ受け付けられる遷移の回数（トークンバケット）
+        self.allowance_at = 0.0   # allowance を計算した時刻（time.monotonic）
+
+
+def session_key(engine):
+    # 1つのプロセス（ブラウザのタブ）で ?quiz= を切り替えても進行状況が混ざらないよう、クイズごとに分ける
+    return f"{SESSION_KEY}:{engine.quiz.path}"
+
+
+_sessions = {}      # (研修ID, クイズのパス) → QuizSession
+_sessions_lock = threading.Lock()
+_last_sweep = 0.0
+
+
+def _registry_key(engine, user_id):
+    # チェックポイントを使わない（または 研修ID がない）ときは None で、st.session_state に置く
+    if user_id and get_store() is not None:
+        return (user_id, engine.quiz.path)
+    return None
+
+
+def _sweep(now):
+    # 一定時間操作のないセッションを表から外す。進行状況は操作のたびにチェックポイントへ書いてある
+    global _last_sweep
+    if now - _last_sweep < SWEEP_INTERVAL:
+        return
+    with _sessions_lock:
+        _last_sweep = now
+        for key in [key for key, session in _sessions.items() if now - session.used > IDLE_SECONDS]:
+            del _sessions[key]
+
+
+def _checkpoint(engine, session):
+    store = get_store()
+    if store is not None and session.user_id:
+        # チェックポイントから再開できるよう、参照する版の JSON を残す（版ごとに一度だけ）
+        keep_version(engine.quiz, store.quiz_hashes)
+        store.save(session.user_id, engine.quiz.path, engine.quiz.content_hash, session)
+
+
+def _start_session(engine, user_id, previous=""):
+    session = engine.new_session()
+    session.id = uuid.uuid4().hex
+    session.user_id = user_id
+    session.step_started = time.monotonic()
+    if previous:
+        log_event(START, engine, session, previous=previous)
+    else:
+        log_event(START, engine, session)
+    # 終わったクイズのチェックポイントが残っていれば、ここで新しい挑戦に置き換える
+    _checkpoint(engine, session)
+    track(engine, session, restart=True)
+    return session
+
+
+def _restore_session(engine, user_id):
+    saved = get_store().load(user_id, engine.quiz.path)
+    if saved is None:
+        return None
+    # 受講中にクイズが更新されていたら、開始したときの版で続ける（その版が残っていなければ最初から）
+    engine = engine.version(saved["quiz_hash"])
+    if engine is None:
+        return None
+    if not 0 <= saved["step"] < len(engine.steps) or len(saved["answers"]) > len(engine.quiz.questions):
+        return None
+    session = engine.new_session()
+    session.id = saved["session_id"]
+    session.user_id = user_id
+    session.step = saved["step"]
+    session.score = saved["score"]
+    session.answers = saved["answers"]
+    session.result_saved = saved["result_saved"]
+    session.step_started = time.monotonic()
+    log_event(RESUME, engine, session)
+    track(engine, session)
+    return session
+
+
+@instrument("session_init")
+def get_session(engine, user_id=""):
+    rerun_finished()
+    key = _registry_key(engine, user_id)
+    if key is None:
+        key = session_key(engine)
+        session = st.session_state.get(key)
+        if session is None:
+            session = st.session_state[key] = _start_session(engine, user_id)
+        return session
+
+    now = time.monotonic()
+    _sweep(now)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _restore_session(engine, user_id) or _start_session(engine, user_id)
+                _sessions[key] = session
+    session.used = now
+    return session
+
+
+def reset_session(engine, user_id=""):
+    # 再挑戦。前のセッションの受講IDを previous に残す
+    key = _registry_key(engine, user_id)
+    if key is None:
+        key = session_key(engine)
+        old = st.session_state.get(key)
+        st.session_state[key] = _start_session(engine, old.user_id if old else user_id, old.id if old else "")
+        return
+    old = _sessions.get(key)
+    session = _start_session(engine, user_id, old.id if old else "")
+    session.used = time.monotonic()
+    with _sessions_lock:
+        _sessions[key] = session
+
+
+def mark_result_saved(engine, session):
+    # save_result の後に呼ぶ。再開したセッションが同じ結果をもう一度保存しないようにする
+    session.result_saved = True
+    _checkpoint(engine, session)
+
+
+_transition_lock = threading.Lock()
+dropped = collections.Counter()     # 捨てた操作の数（"stale": 古い画面から / "throttled": 回数の制限）
+
+
+def transition_token(session):
+    # 回答・遷移のたびに変わる（ステップ番号と回答数は戻らないので、同じ受講の中で同じ値にはならない）。
+    # チェックポイントから再開しても同じ値になるので、再開の前に表示した画面の操作も受け付けられる
+    return f"{session.id[:8]}.{session.step}.{len(session.answers)}"
+
+
+def _rejected(session, token):
+    # _transition_lock を持って呼ぶ。受け付けるなら None、捨てるなら理由（"stale" / "throttled"）
+    if token is not None and token != transition_token(session):
+        dropped["stale"] += 1
+        return "stale"
+    if TRANSITION_RATE <= 0:
+        return None
+    now = time.monotonic()
+    allowance = min(TRANSITION_BURST, session.allowance + (now - session.allowance_at) * TRANSITION_RATE)
+    session.allowance_at = now
+    if allowance < 1:
+        session.allowance = allowance
+        dropped["throttled"] += 1
+        return "throttled"
+    session.allowance = allowance - 1
+    return None
+
+
+def _dropped(engine, session, reason, action):
+    # 古い画面からの操作は黙って捨てる。回数の制限で捨てたときは操作ログに残し、画面に知らせる
+    if reason != "throttled":
+        return
+    log_event(THROTTLED, engine, session, action=action)
+    try:
+        st.toast(THROTTLE_MESSAGE)
+    except StreamlitAPIException:
+        pass
+
+
+def _log_transition(engine, session, before):
+    after = engine.current(session)
+    if after is before:
+        return
+    session.step_started = time.monotonic()
+    log_event(TRANSITION, engine, session, src=before.kind, dst=after.kind)
+    if engine.finished(session):
+        log_event(FINISH, engine, session, kind=after.kind, answered=len(session.answers))
+
+
+def submit_answer(engine, session, mask, token=None):
+    # 回答を採点し、選んだ選択肢と回答までの時間を記録する（ゲームオーバーになればその遷移も）。
+    # 採点しなかった（捨てた操作か、回答済み）ときは None
+    with _transition_lock:
+        reason = _rejected(session, token)
+        if reason is None:
+            step = engine.current(session)
+            correct = engine.answer(session, mask)
+    if reason is not None:
+        _dropped(engine, session, reason, "answer")
+        return None
+    if correct is not None:
+        q = engine.question(step)
+        elapsed_ms = round((time.monotonic() - session.step_started) * 1000)
+        log_event(
+            ANSWER, engine, session,
+            question=step.question,
+            selected=list(q.selected(mask)),
+            mask=mask,
+            correct=correct,
+            elapsed_ms=elapsed_ms,
+        )
+        track_answer(engine, session, step.question, correct, elapsed_ms)
+        _log_transition(engine, session, step)
+        _checkpoint(engine, session)
+        track(engine, session)
+    return correct
+
+
+def advance(engine, session, token=None):
+    # 次のステップへ進める。捨てた操作なら False
+    with _transition_lock:
+        reason = _rejected(session, token)
+        if reason is None:
+            before = engine.current(session)
+            engine.advance(session)
+    if reason is not None:
+        _dropped(engine, session, reason, "next")
+        return False
+    _log_transition(engine, session, before)
+    _checkpoint(engine, session)
+    track(engine, session)
+    return True
+
+
+def rerun_page():
+    # 遷移のあとにページ全体を再実行する。次の実行が始まるまでを rerun_transition として計る
+    rerun_started()
+    st.rerun()
+
+
+def rerun_after_transition(engine, session):
+    # 問題パネル（st.fragment）の中から呼ぶ。
+    # 次も問題ならパネルだけを、エンディングなど画面の種類が変わるならページ全体を再実行する
+    rerun_started()
+    if engine.on_question(session):
+        try:
+            st.rerun(scope="fragment")
+        except StreamlitAPIException:
+            # ページ全体の実行中にボタンが押された扱いになったときは、全体を再実行する
+            pass
+    st.rerun()
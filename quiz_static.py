@@ -0,0 +1,655 @@
+import argparse
+import collections
+import functools
+import json
+import os
+import shutil
+import sys
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from quiz_bank import is_bank_spec
+from quiz_certificates import request_certificate
+from quiz_grading import SheetError, grade_one, load_grader, question_order, sheet_masks
+from quiz_outbox import SURVEY_URL, notify_result
+from result_store import save_result
+
+# 大人数で同時に受講するときのための静的書き出し。
+# クイズを遷移表ごと HTML に埋め込み、進行と採点をブラウザの JavaScript で行う（画面は各アプリと同じ流れ）。
+# 静的ファイルの配信だけで受講でき、Python 側は最後に1回送られてくる結果を受け取るだけになる。
+# 受け口は送られた回答をこちらの QuizEngine で採点し直してから save_result で保存する（ブラウザのスコアは信用しない）。
+# 途中の進行状況はブラウザの localStorage に残るので、再読み込みしても続きから受講できる。
+#
+#   python quiz_static.py export quiz_data.json quiz_data_v2.json quiz_data_v4.json --output site
+#   python quiz_static.py serve --static site --port 8600     # site/ の配信と POST /results の受け口
+#   http://localhost:8600/quiz_data_v4/?user_id=A001
+#
+# 別のサーバーで配信するときは --ingest に受け口の URL を書き、serve の --allow-origin で配信元を許可する
+# （既定ではどの配信元も許可しない。* は受け付けず、https://quiz.example.com のように配信元ごとに指定する）。
+# 問題バンク（受講者ごとに抽選するクイズ）は書き出せない。
+
+INGEST_PATH = "/results"
+DEFAULT_PORT = 8600
+MANIFEST = "manifest.json"
+MAX_BODY_BYTES = 1024 * 1024
+MAX_USER_ID = 200
+MAX_SEEN_ATTEMPTS = 100000
+MAX_MASK_BITS = 53      # JavaScript の数値で正確に扱えるビットマスクの上限
+BANNER_FILE = "cyber_banner.jpg"
+
+
+def bundle_data(engine, quiz_file, ingest_url, banner="", survey_url=""):
+    # ブラウザに渡すクイズと遷移表。採点に必要なものはすべてここに入れる
+    quiz = engine.quiz
+    for i, q in enumerate(quiz.questions):
+        if len(q.choices) > MAX_MASK_BITS:
+            raise ValueError(f"問{i+1}の選択肢が多すぎます（{MAX_MASK_BITS}個まで）")
+    return {
+        "quiz": os.path.basename(quiz_file),
+        "hash": quiz.content_hash,
+        "shape": quiz.shape,
+        "title": list(quiz.title),
+        "ingest": ingest_url,
+        "banner": banner,
+        "survey_url": survey_url,
+        "initial_score": engine.rules.initial_score,
+        "game_over_score": engine.rules.game_over_score,
+        "game_over_step": engine.game_over_step,
+        "steps": [
+            {"kind": s.kind, "stage": s.stage, "question": s.question, "next": s.next, "first": s.first_in_stage}
+            for s in engine.steps
+        ],
+        "stages": [{"title": list(s.section_title), "story": list(s.section_story)} for s in quiz.stages],
+        "questions": [
+            {
+                "title": list(q.section_title),
+                "story": list(q.section_story),
+                "text": list(q.question_text),
+                "choices": list(q.choices),
+                "correct_mask": q.correct_mask,
+                "correct_list": list(q.correct_list),
+                "score_correct": q.score_correct,
+                "score_incorrect": q.score_incorrect,
+                "feedback_correct": list(q.feedback_correct),
+                "feedback_incorrect": list(q.feedback_incorrect),
+            }
+            for q in quiz.questions
+        ],
+        "ranks": {str(score): list(entry) for score, entry in engine.rank_table.items()},
+    }
+
+
+def render_page(data):
+    # </script> で埋め込みが切れないよう、< をエスケープしておく
+    payload = json.dumps(data, ensure_ascii=False, separators=(",", ":")).replace("<", "\\u003c")
+    title = data["title"][0] if data["title"] else data["quiz"]
+    return PAGE.replace("__TITLE__", _escape(title)).replace("__DATA__", payload)
+
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+def export(quiz_files, output, ingest_url=INGEST_PATH, banner=BANNER_FILE, survey_url=SURVEY_URL):
+    # クイズごとに <output>/<名前>/index.html を書き、一覧の index.html と受け口用の manifest.json を置く。{名前: パス} を返す
+    os.makedirs(output, exist_ok=True)
+    exported = {}
+    for quiz_file in quiz_files:
+        if is_bank_spec(quiz_file):
+            raise ValueError(f"問題バンクは書き出せません: {quiz_file}")
+        engine = load_grader(quiz_file)
+        name = os.path.splitext(os.path.basename(quiz_file))[0]
+        directory = os.path.join(output, name)
+        os.makedirs(directory, exist_ok=True)
+        banner_name = ""
+        # バナーは v4（問題リスト形式）の画面と同じく、questions 形式のクイズだけに付ける
+        if banner and engine.quiz.shape == "questions" and os.path.exists(banner):
+            banner_name = "banner" + os.path.splitext(banner)[1]
+            shutil.copyfile(banner, os.path.join(directory, banner_name))
+        page = render_page(bundle_data(engine, quiz_file, ingest_url, banner_name, survey_url))
+        _write_text(os.path.join(directory, "index.html"), page)
+        exported[name] = quiz_file
+    links = "".join(f'<li><a href="{_escape(name)}/">{_escape(name)}</a></li>' for name in sorted(exported))
+    _write_text(os.path.join(output, "index.html"), INDEX_PAGE.replace("__LINKS__", links))
+    manifest_path = os.path.join(output, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    manifest.update(exported)
+    _write_text(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=2))
+    return exported
+
+
+def _write_text(path, text):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class IngestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Ingest:
+    # 書き出したページから送られた結果を採点し直して保存する
+    def __init__(self, quiz_files):
+        self.quizzes = {os.path.basename(path): path for path in quiz_files}
+        self._seen = collections.OrderedDict()     # 受講ごとのID → 返した結果（送り直されても二重に保存しない）
+        self._lock = threading.Lock()
+
+    def record(self, payload):
+        if not isinstance(payload, dict):
+            raise IngestError(400, "JSON のオブジェクトを送ってください")
+        user_id = payload.get("user_id")
+        attempt = payload.get("attempt")
+        quiz_file = self.quizzes.get(payload.get("quiz"))
+        if not isinstance(user_id, str) or not user_id or len(user_id) > MAX_USER_ID:
+            raise IngestError(400, "研修IDが正しくありません")
+        if not isinstance(attempt, str) or not attempt or len(attempt) > 64:
+            raise IngestError(400, "attempt が正しくありません")
+        if quiz_file is None:
+            raise IngestError(404, f"受け付けていないクイズです: {payload.get('quiz')}")
+
+        with self._lock:
+            if attempt in self._seen:
+                return self._seen[attempt]
+        engine = load_grader(quiz_file)
+        # ページを書き出した後にクイズが直されていても、ページの版で採点する
+        engine = engine.version(payload.get("hash") or engine.quiz.content_hash)
+        if engine is None:
+            raise IngestError(409, "この版のクイズが見つかりません")
+        try:
+            masks = sheet_masks(engine, payload.get("answers"))
+        except SheetError as e:
+            raise IngestError(400, str(e))
+        graded = grade_one(engine, masks)
+        # ブラウザは出題された問題（ゲームオーバーならそこまで）の回答をすべて送る。数が合わなければ受け付けない
+        if len(payload["answers"]) != graded["answered"]:
+            raise IngestError(
+                400, f"回答の数（{len(payload['answers'])}）が出題された問題の数（{graded['answered']}）と合いません"
+            )
+        score = graded["score"]
+        if payload.get("score") != score:
+            print(f"ブラウザのスコア（{payload.get('score')}）と採点し直したスコア（{score}）が違います: {user_id}")
+        questions = engine.quiz.questions
+        answers = [", ".join(questions[i].selected(masks[i])) for i in question_order(engine)[:graded["answered"]]]
+
+        # 同じ受講の送り直しが並行して届いても一度だけ保存するよう、確認から保存までロックを持つ
+        # （save_result と通知はキューに積むだけなので短い）
+        with self._lock:
+            if attempt in self._seen:
+                return self._seen[attempt]
+            record = save_result(score, answers, user_id, quiz=quiz_file, quiz_hash=engine.quiz.content_hash)
+            # v4 の終了画面と同じく、修了証（合格なら）と外部への通知はキューに積むだけ
+            title = engine.quiz.title[0] if engine.quiz.title else ""
+            request_certificate(record, title)
+            notify_result(record, title)
+
+            result = {"score": score, "timestamp": record.timestamp}
+            if "rank" in graded:
+                result["rank"] = graded["rank"]
+            self._seen[attempt] = result
+            while len(self._seen) > MAX_SEEN_ATTEMPTS:
+                self._seen.popitem(last=False)
+        return result
+
+
+class IngestHandler(SimpleHTTPRequestHandler):
+    # GET は書き出したサイトの配信（--static のとき）、POST /results は結果の受け口
+    protocol_version = "HTTP/1.1"
+    ingest = None
+    allow_origins = frozenset()     # 結果を送ってよい別の配信元（同じ配信元からなら不要）
+    serve_static = False
+
+    def end_headers(self):
+        origin = self.headers.get("Origin")
+        if origin and origin in self.allow_origins:
+            self.send_header("Access-Control-Allow-Origin", origin)
+        if self.allow_origins:
+            self.send_header("Vary", "Origin")
+        super().end_headers()
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header("Access-Control-Allow-Methods", "POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Access-Control-Max-Age", "86400")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        if self.path.split("?")[0] != INGEST_PATH:
+            self._send_json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_BODY_BYTES:
+            self._send_json(413, {"error": "リクエストが大きすぎます"})
+            return
+        try:
+            payload = json.loads(self.rfile.read(length))
+            self._send_json(200, self.ingest.record(payload))
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": "JSON を解析できません"})
+        except IngestError as e:
+            self._send_json(e.status, {"error": str(e)})
+        except Exception as e:
+            print(f"結果を受け付けられませんでした: {e}")
+            self._send_json(500, {"error": "結果を保存できませんでした"})
+
+    def do_GET(self):
+        if not self.serve_static:
+            self._send_json(404, {"error": "not found"})
+            return
+        super().do_GET()
+
+    def do_HEAD(self):
+        if not self.serve_static:
+            self._send_json(404, {"error": "not found"})
+            return
+        super().do_HEAD()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(quiz_files, port=DEFAULT_PORT, static_dir=None, allow_origins=(), host="127.0.0.1"):
+    if "*" in allow_origins:
+        raise ValueError("--allow-origin に * は指定できません。配信元を https://quiz.example.com のように指定してください")
+    handler = type("Handler", (IngestHandler,), {
+        "ingest": Ingest(quiz_files),
+        "allow_origins": frozenset(origin.rstrip("/") for origin in allow_origins),
+        "serve_static": static_dir is not None,
+    })
+    if static_dir is not None:
+        handler = functools.partial(handler, directory=static_dir)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="クイズの静的書き出しと結果の受け口")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="クイズを静的な HTML に書き出す")
+    export_parser.add_argument("quiz", nargs="+", help="クイズファイル")
+    export_parser.add_argument("--output", default="site")
+    export_parser.add_argument("--ingest", default=INGEST_PATH, help=f"結果を送る URL（既定: {INGEST_PATH}）")
+    export_parser.add_argument("--banner", default=BANNER_FILE, help="questions 形式のクイズに付けるバナー画像（空なら付けない）")
+    export_parser.add_argument("--survey-url", default=SURVEY_URL, help="終了画面のアンケートのリンク先")
+    serve_parser = commands.add_parser("serve", help="結果の受け口（と書き出したサイトの配信）")
+    serve_parser.add_argument("--quiz", action="append", default=[], help="受け付けるクイズ（既定: --static の manifest.json）")
+    serve_parser.add_argument("--static", help="書き出したサイトのディレクトリ（同じポートで配信する）")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument(
+        "--allow-origin", action="append", default=[],
+        help="結果を送ってよい別の配信元（CORS、繰り返し指定できる。既定はどこも許可しない）",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        try:
+            exported = export(args.quiz, args.output, args.ingest, args.banner, args.survey_url)
+        except (OSError, ValueError) as e:
+            print(f"書き出せませんでした: {e}", file=sys.stderr)
+            return 1
+        for name, path in exported.items():
+            print(f"{path} → {os.path.join(args.output, name, 'index.html')}")
+        return 0
+
+    quiz_files = args.quiz
+    if not quiz_files and args.static:
+        with open(os.path.join(args.static, MANIFEST), encoding="utf-8") as f:
+            quiz_files = list(json.load(f).values())
+    if not quiz_files:
+        parser.error("--quiz か、manifest.json のある --static を指定してください")
+    try:
+        server = make_server(quiz_files, args.port, args.static, args.allow_origin, args.host)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"http://{args.host}:{args.port}{INGEST_PATH} で結果を受け付けます（{', '.join(quiz_files)}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+INDEX_PAGE = """<!DOCTYPE html>
+<html lang="ja"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1">
+<title>クイズ一覧</title></head>
+<body style="font-family:sans-serif;max-width:720px;margin:2em auto;padding:0 1em;">
+<h1>クイズ一覧</h1><ul>__LINKS__</ul>
+</body></html>
+"""
+
+PAGE = """<!DOCTYPE html>
+<html lang="ja">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>__TITLE__</title>
+<style>
+body { font-family: "Source Sans Pro", "Hiragino Sans", "Noto Sans JP", sans-serif; color: #31333f; margin: 0; }
+main { max-width: 730px; margin: 0 auto; padding: 3rem 1rem 6rem; line-height: 1.6; }
+h1 { font-size: 2.5rem; margin: 0 0 1rem; }
+h2 { font-size: 1.9rem; margin: 1.5rem 0 .5rem; }
+h3 { font-size: 1.5rem; margin: 1.2rem 0 .5rem; }
+p { margin: .4rem 0 .8rem; }
+label.choice { display: block; margin: .4rem 0; cursor: pointer; }
+label.choice input { margin-right: .5rem; transform: scale(1.2); }
+button { font: inherit; padding: .4rem .9rem; border: 1px solid #d0d0d8; border-radius: .5rem; background: #fff; cursor: pointer; margin: .5rem 0; }
+button:hover { border-color: #ff4b4b; color: #ff4b4b; }
+input[type=text] { font: inherit; padding: .4rem; width: 100%; box-sizing: border-box; border: 1px solid #d0d0d8; border-radius: .5rem; }
+.box { padding: 1rem; border-radius: .5rem; margin: .8rem 0; }
+.success { background: #dff5e3; color: #177233; }
+.info { background: #e0ecfb; color: #1c4f8c; }
+.warning { background: #fdf6d8; color: #926c05; }
+.error { background: #fde2e2; color: #9d1c1c; }
+.celebrate { padding: 24px; border-radius: 16px; text-align: center; font-size: 2em; }
+img.banner { width: 100%; height: auto; }
+hr { border: none; border-top: 1px solid #e6e6ea; margin: 1.5rem 0; }
+</style>
+</head>
+<body>
+<main id="app"></main>
+<script type="application/json" id="quiz-data">__DATA__</script>
+<script>
+"use strict";
+// 遷移表（quiz_engine.py の QuizEngine と同じ）に従って進め、最後に結果を1回だけ送る
+const DATA = JSON.parse(document.getElementById("quiz-data").textContent);
+const app = document.getElementById("app");
+const params = new URLSearchParams(location.search);
+let userId = params.get("user_id") || "";
+let state = null;
+let selected = new Set();
+let sending = false;
+let retryDelay = 0;
+let retryTimer = null;
+
+function storeKey() { return "quiz:" + DATA.hash + ":" + userId; }
+function newState() {
+  const id = (crypto.randomUUID ? crypto.randomUUID() : String(Math.random()).slice(2) + Date.now()).replace(/-/g, "");
+  return { attempt: id, step: 0, score: DATA.initial_score, answers: [], queued: false, sent: null };
+}
+function loadState() {
+  try { state = JSON.parse(localStorage.getItem(storeKey())); } catch (e) { state = null; }
+  if (!state || typeof state.step !== "number" || state.step >= DATA.steps.length) state = newState();
+}
+function saveState() {
+  try { localStorage.setItem(storeKey(), JSON.stringify(state)); } catch (e) { /* 保存できなくても受講は続ける */ }
+}
+
+function current() { return DATA.steps[state.step]; }
+function question(step) { return DATA.questions[step.question]; }
+function answered() { const s = current(); return s.kind === "question" && state.answers.length > s.question; }
+function finished() { return ["ending", "game_over", "finish"].includes(current().kind); }
+function isCorrect(q, mask) { return mask !== 0 && mask === q.correct_mask; }
+function maskOf(q, chosen) { let m = 0; q.choices.forEach((c, i) => { if (chosen.has(c)) m += 2 ** i; }); return m; }
+function selectedOf(q, mask) { return q.choices.filter((c, i) => Math.floor(mask / 2 ** i) % 2 === 1); }
+function lastCorrect() { const s = current(); return isCorrect(question(s), state.answers[s.question]); }
+
+function answer(mask) {
+  const s = current();
+  if (s.kind !== "question" || answered()) return;
+  const q = question(s);
+  state.score += isCorrect(q, mask) ? q.score_correct : q.score_incorrect;
+  state.answers.push(mask);
+  if (DATA.game_over_step !== null && state.score <= DATA.game_over_score) state.step = DATA.game_over_step;
+  saveState();
+  render();
+}
+function advance() { state.step = current().next; selected = new Set(); saveState(); render(); }
+function restart() { state = newState(); selected = new Set(); saveState(); render(); }
+
+// ランクは到達しうるスコアの分だけ書き出してある（quiz_rank.py と同じ区切り）
+function getRank(score) { return DATA.ranks[String(score)] || ["", ""]; }
+
+// 画面の部品
+function escapeHtml(text) {
+  return String(text).replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;").replace(/"/g, "&quot;");
+}
+function inline(text) { return escapeHtml(text).replace(/\\*\\*(.+?)\\*\\*/g, "<b>$1</b>"); }
+function add(tag, html, cls) {
+  const node = document.createElement(tag);
+  if (html !== undefined) node.innerHTML = html;
+  if (cls) node.className = cls;
+  app.appendChild(node);
+  return node;
+}
+function text(tag, line, cls) { return add(tag, inline(line), cls); }
+function lines(items, tag) { items.forEach(line => text(tag || "p", line)); }
+function box(kind, line) { return text("div", line, "box " + kind); }
+function button(label, onClick) { const b = add("button"); b.textContent = label; b.onclick = onClick; return b; }
+function choices(q) {
+  const done = answered();
+  const chosen = done ? new Set(selectedOf(q, state.answers[current().question])) : selected;
+  q.choices.forEach(choice => {
+    const label = add("label", "", "choice");
+    const input = document.createElement("input");
+    input.type = "checkbox";
+    input.checked = chosen.has(choice);
+    input.disabled = done;
+    input.onchange = () => { if (input.checked) selected.add(choice); else selected.delete(choice); };
+    label.appendChild(input);
+    label.appendChild(document.createTextNode(choice));
+  });
+}
+function answerButton(q, label) { button(label, () => answer(maskOf(q, selected))); }
+
+// 結果の送信。終わった受講は送信待ちの列（localStorage）に積み、古い順に送る。
+// 送れなければ間隔を伸ばしながら送り直す（再挑戦したりページを開き直したりしても送り直す）
+function pendingKey() { return "quiz:pending:" + DATA.hash; }
+function pending() { try { return JSON.parse(localStorage.getItem(pendingKey())) || []; } catch (e) { return []; } }
+function setPending(list) { try { localStorage.setItem(pendingKey(), JSON.stringify(list)); } catch (e) { /* 送信は続ける */ } }
+function unqueue(attempt) { setPending(pending().filter(p => p.attempt !== attempt)); }
+function queueResult() {
+  if (state.queued) return;
+  const list = pending();
+  list.push({ attempt: state.attempt, user_id: userId, quiz: DATA.quiz, hash: DATA.hash, score: state.score, answers: state.answers });
+  setPending(list);
+  state.queued = true;
+  saveState();
+}
+function flush() {
+  if (sending || retryTimer) return;
+  const body = pending()[0];
+  if (!body) return;
+  sending = true;
+  fetch(DATA.ingest, { method: "POST", headers: { "Content-Type": "application/json" }, body: JSON.stringify(body), keepalive: true })
+    .then(response => {
+      if (response.status >= 400 && response.status < 500) return response.json().then(r => { throw { permanent: true, message: r.error }; });
+      if (!response.ok) throw { message: "HTTP " + response.status };
+      return response.json();
+    })
+    .then(result => {
+      retryDelay = 0;
+      unqueue(body.attempt);
+      if (state && state.attempt === body.attempt) { state.sent = result; saveState(); }
+    })
+    .catch(e => {
+      if (e && e.permanent) {
+        // 受け口が受け付けない結果は送り直しても同じなので捨てる
+        unqueue(body.attempt);
+        if (state && state.attempt === body.attempt) { state.sent = { error: e.message }; saveState(); }
+        return;
+      }
+      retryDelay = Math.min(retryDelay ? retryDelay * 2 : 1000, 60000);
+      retryTimer = setTimeout(() => { retryTimer = null; flush(); }, retryDelay * (0.5 + Math.random() / 2));
+    })
+    .finally(() => { sending = false; render(); });
+}
+function resultStatus() {
+  if (!state.sent) { box("info", retryDelay ? "結果を送信できませんでした。自動で送り直します…" : "結果を送信しています…"); return; }
+  if (state.sent.error) { box("error", "結果を保存できませんでした：" + state.sent.error); return; }
+  box("success", "結果を保存しました。");
+}
+
+// v1（リスト形式）: streamlit_quiz.py と同じ画面
+function renderList() {
+  text("h1", "サイバーセキュリティ サバイバルクイズ");
+  const s = current();
+  if (s.kind === "question") {
+    const q = question(s);
+    text("h3", q.title.join(" "));
+    lines(q.story);
+    lines(q.text);
+    choices(q);
+    if (!answered()) {
+      answerButton(q, "回答する（問" + (s.question + 1) + "）");
+    } else {
+      lines(lastCorrect() ? q.feedback_correct : q.feedback_incorrect);
+      box("info", "現在のスコア: " + state.score);
+      button("次へ", advance);
+    }
+    return;
+  }
+  if (s.kind === "game_over") box("warning", "ゲームオーバー！"); else box("success", "クリア！全問終了しました。");
+  box("info", "最終スコア: " + state.score);
+  resultStatus();
+}
+
+// v2（ステージ形式）: streamlit_quiz_v2.py と同じ画面
+function renderStages() {
+  const title = DATA.title;
+  if (title.length > 0) text("h1", title[0]);
+  if (title.length > 1) text("h3", title[1]);
+  title.slice(2).forEach(line => text("p", "**" + line + "**"));
+  const s = current();
+  const score = state.score;
+  if (s.kind === "finish") {
+    box("success", "クリア！全問終了しました。");
+    box("info", "最終スコア: " + score);
+    resultStatus();
+    return;
+  }
+  if (s.kind !== "question") {
+    const stage = DATA.stages[s.stage];
+    lines(stage.title, "h2");
+    lines(stage.story);
+    if (s.kind === "intro") { button("スタート", advance); return; }
+    if (score === 100) {
+      add("div", "🎉 <b>MISSION COMPLETE!</b> 🎉<br>シールドポイント：<b>100</b>", "celebrate").style.cssText = "background:#ffd700;color:#222;";
+      box("success", "パーフェクトクリア！あなたのサイバー衛生力は最高レベルです！");
+      resultStatus();
+      button("終了", restart);
+    } else {
+      add("div", "💥 <b>GAME OVER</b> 💥<br>シールドポイント：<b>" + score + "</b>", "celebrate").style.cssText = "background:#222;color:#fff;";
+      box("warning", "もう一度チャレンジして、サイバー衛生力を高めましょう！");
+      resultStatus();
+      button("再挑戦", restart);
+    }
+    return;
+  }
+  const stage = DATA.stages[s.stage];
+  if (s.first) { lines(stage.title, "h3"); lines(stage.story); }
+  const q = question(s);
+  lines(q.text);
+  choices(q);
+  if (!answered()) { answerButton(q, "回答する"); return; }
+  lines(lastCorrect() ? q.feedback_correct : q.feedback_incorrect);
+  if (score === 100) box("success", "🟢 シールドMAX！ポイント：" + score);
+  else if (score >= 70) box("info", "🔵 まだまだ戦える！ポイント：" + score);
+  else if (score >= 30) box("warning", "🟠 シールドが危ない！ポイント：" + score);
+  else box("error", "🔴 シールドブレイク寸前！ポイント：" + score);
+  button("次へ", advance);
+}
+
+// v4（問題リスト形式、ランクつき）: streamlit_quiz_v4.py と同じ画面
+function renderQuestions() {
+  text("h1", "サイバー衛生レベルアップクイズ");
+  text("p", "入門者からスタートし、正解するごとにレベルアップ！目指せマスター！");
+  if (DATA.banner) add("img", undefined, "banner").src = DATA.banner;
+  const s = current();
+  const score = state.score;
+  if (s.kind === "finish") {
+    const [rank, emoji] = getRank(score);
+    text("p", "**あなたのランク：" + rank + " " + emoji + "**");
+    text("p", "**最終スコア：" + score + "点**");
+    if (score === 100) {
+      add("div", "🎉 <b>おめでとうございます！</b> 🎉<br>🎉 <b>マスター認定です！</b> 🎉<br>サイバー衛生スコア：<b>100</b><br>修了証をお送りします", "celebrate")
+        .style.cssText = "background:#ffd700;color:#222;";
+    } else {
+      box("warning", "再チャレンジして、マスターを目指しましょう！");
+      button("再チャレンジ", restart);
+    }
+    resultStatus();
+    add("hr");
+    text("p", "📋 **事後アンケートにご協力ください**");
+    if (DATA.survey_url) {
+      const link = new URL(DATA.survey_url, location.href);
+      link.searchParams.set("user_id", userId);
+      link.searchParams.set("score", score);
+      const a = add("p").appendChild(document.createElement("a"));
+      a.href = link.href;
+      a.textContent = "アンケートに回答する";
+    } else {
+      text("p", "アンケートページ（ダミー）");
+    }
+    return;
+  }
+  const q = question(s);
+  text("h3", q.title.join(""));
+  lines(q.text);
+  choices(q);
+  if (!answered()) { answerButton(q, "回答する"); return; }
+  add("hr");
+  const correct = lastCorrect();
+  text("p", correct ? "**✅ 正解！**" : "**❌ 不正解**");
+  if (q.correct_list.length) text("p", "正解は「" + q.correct_list.join("」「") + "」です。");
+  add("div", (correct ? q.feedback_correct : q.feedback_incorrect).map(inline).join("<br>")).style.lineHeight = "1.2";
+  add("br");
+  const before = score - (correct ? q.score_correct : q.score_incorrect);
+  const rank = getRank(score)[0];
+  text("p", "スコア：" + score + "点　ランク：" + rank + (rank !== getRank(before)[0] ? " 🎉（ランクアップ）" : ""));
+  button("次へ", advance);
+}
+
+function askUserId() {
+  const input = add("input");
+  input.type = "text";
+  input.placeholder = "研修IDを入力してください";
+  button("はじめる", () => {
+    if (!input.value.trim()) return;
+    userId = input.value.trim();
+    params.set("user_id", userId);
+    history.replaceState(null, "", "?" + params.toString());
+    loadState();
+    render();
+  });
+  box("warning", "研修IDが必要です");
+}
+
+function render() {
+  app.innerHTML = "";
+  if (!userId) {
+    askUserId();
+  } else {
+    if (finished()) queueResult();
+    if (DATA.shape === "list") renderList();
+    else if (DATA.shape === "stages") renderStages();
+    else renderQuestions();
+  }
+  flush();
+}
+
+if (userId) loadState();
+render();
+</script>
+</body>
+</html>
+"""
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+import argparse
+import codecs
+import collections
+import csv
+import io
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+
+from quiz_grading import SheetError, answer_mask, grade_masks, load_grader
+from result_store import (
+    META_SUFFIX, RESULT_FILE, CsvMeta, bounded_map, csv_line, csv_row, parse_csv_row, split_rows, with_meta,
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 正解を直したクイズで quiz_result.csv を採点し直す。
+# 結果ファイルを先頭から一定行数のチャンクごとに読み、プロセスプールで採点して、同じ順で新しいファイルに書く。
+# 同時に処理中のチャンク数に上限があるので、ファイルの大きさに関係なくメモリ使用量は一定。
+#
+#   python regrade_results.py --quiz quiz_data_v2.json
+#   python regrade_results.py --quiz quiz_data_v2.json --only-hash 3fa1 --diff changed.csv
+#
+# 対象は クイズ情報（<結果ファイル>.meta.db）のファイル名が --quiz と同じ行（--include-untagged でクイズ情報のない古い行も）。
+# ほかのクイズの行やヘッダー、読めない行はそのまま書き写す。採点し直した行には新しいクイズの内容ハッシュを記録する
+# （書き出したファイルの隣にも .meta.db を作る）。
+# ゲームオーバーで途中までしか回答していない行は、残りを未回答として QuizEngine で進め直す
+# （直した正解ではゲームオーバーにならなければ、その先の問題は不正解として数える）。
+
+CHUNK_ROWS = 2000
+DIFF_HEADER = ["タイムスタンプ", "研修ID", "旧スコア", "新スコア", "差"]
+MAX_ERROR_SAMPLES = 20
+
+_engine = None
+
+
+def _init_worker(quiz_file):
+    global _engine
+    _engine = load_grader(quiz_file)
+
+
+def _targets(record, options):
+    quiz_name, only_hash, include_untagged = options
+    if not record.quiz:
+        return include_untagged and not only_hash
+    if os.path.basename(record.quiz) != quiz_name:
+        return False
+    return not only_hash or record.quiz_hash.startswith(only_hash)
+
+
+def regrade_rows(rows, options, engine):
+    # (CSV 行, レコード) を採点し直し、行ごとに (状態, 書き出す行, 書き出すレコード, 旧スコア, 新スコア, メッセージ) を返す
+    questions = engine.quiz.questions
+    results = []
+    pending = []    # (results の位置, レコード)
+    masks = []
+    for row, record in rows:
+        if record is None:
+            results.append(("copied", row, None, None, None, ""))
+            continue
+        if not _targets(record, options):
+            results.append(("skipped", row, record, None, None, ""))
+            continue
+        if len(record.answers) > len(questions):
+            message = f"回答数（{len(record.answers)}）が問題数（{len(questions)}）より多くあります"
+            results.append(("error", row, record, None, None, message))
+            continue
+        # ゲームオーバーで終わった行は回答が少ない。残りは未回答として遷移表どおりに進め直す
+        answers = list(record.answers) + [""] * (len(questions) - len(record.answers))
+        try:
+            masks.append([answer_mask(q, answer) for q, answer in zip(questions, answers)])
+        except SheetError as e:
+            results.append(("error", row, record, None, None, str(e)))
+            continue
+        pending.append((len(results), record))
+        results.append(None)
+
+    for (i, record), graded in zip(pending, grade_masks(engine, masks)):
+        new = replace(
+            record,
+            score=graded["score"],
+            quiz=record.quiz or options[0],
+            quiz_hash=engine.quiz.content_hash,
+        )
+        status = "changed" if new.score != record.score else "unchanged"
+        results[i] = (status, csv_row(new), new, record.score, new.score, "")
+    return results
+
+
+def parse_chunk(start, lines, meta):
+    # バイト列の行を (CSV 行, クイズ情報を付けたレコード) にする
+    rows, _ = split_rows(b"".join(lines))
+    parsed = []
+    for pos, line in rows:
+        row = next(csv.reader(io.StringIO(line.decode("utf-8"), newline="")), [])
+        record = parse_csv_row(row)
+        if record is not None:
+            record = with_meta(record, meta.get(start + pos))
+        parsed.append((row, record))
+    return parsed
+
+
+def regrade_chunk(chunk, options, engine=None):
+    # 1チャンク分（先頭の位置, バイト列の行, その範囲のクイズ情報）を採点し直す。
+    # 親プロセスの負担を減らすため、CSV の解析と書き出し、集計までここで行い、
+    # (出力のバイト列, 出力の中の位置とクイズ情報つきのレコード, 差分, 集計) を返す
+    engine = engine or _engine
+    out = io.BytesIO()
+    out_meta = []
+    diff = io.StringIO()
+    diff_writer = csv.writer(diff)
+    summary = Summary()
+    for status, row, record, old, new, message in regrade_rows(parse_chunk(*chunk), options, engine):
+        if record is not None and (record.quiz or record.quiz_hash):
+            out_meta.append((out.tell(), record))
+        out.write(csv_line(row))
+        summary.add(status, old, new, message, row)
+        if status == "changed":
+            diff_writer.writerow([record.timestamp, record.user_id, old, new, new - old])
+    return out.getvalue(), out_meta, diff.getvalue(), summary
+
+
+def _snapshot_size(path):
+    # アプリが追記中の行を読まないよう、開始時点の大きさまでを対象にする（書き込みは行単位で排他されている）
+    with open(path, "rb") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        return os.fstat(f.fileno()).st_size
+
+
+def iter_line_chunks(path, chunk_rows=CHUNK_ROWS):
+    # 開始時点の大きさまでを chunk_rows 行ずつ、(先頭の位置, バイト列の行のリスト) で返す。
+    # 引用符の中の改行で行が分かれないよう、" の数が偶数になったところでだけ区切る
+    end = _snapshot_size(path)
+    chunk = []
+    quotes = 0
+    with open(path, "rb") as f:
+        if f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+            f.seek(0)
+        start = f.tell()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            chunk.append(line)
+            quotes += line.count(b'"')
+            if len(chunk) >= chunk_rows and quotes % 2 == 0:
+                yield start, chunk
+                start = f.tell()
+                chunk = []
+                quotes = 0
+    if chunk:
+        yield start, chunk
+
+
+def with_chunk_meta(chunks, meta):
+    # チャンクの範囲のクイズ情報だけを引いて添える（読む量はチャンクごとに一定）
+    for start, lines in chunks:
+        end = start + sum(len(line) for line in lines)
+        yield start, lines, meta.lookup([start, end - 1], contiguous=True)
+
+
+class Summary:
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.deltas = collections.Counter()
+        self.old_total = 0
+        self.new_total = 0
+        self.errors = []
+
+    def add(self, status, old, new, message, row):
+        self.counts[status] += 1
+        if status in ("changed", "unchanged"):
+            self.deltas[new - old] += 1
+            self.old_total += old
+            self.new_total += new
+        if status == "error" and len(self.errors) < MAX_ERROR_SAMPLES:
+            self.errors.append(f"{row[0] if row else ''} {message}")
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.deltas.update(other.deltas)
+        self.old_total += other.old_total
+        self.new_total += other.new_total
+        self.errors.extend(other.errors[:MAX_ERROR_SAMPLES - len(self.errors)])
+
+    def as_dict(self, quiz_file, content_hash):
+        regraded = self.counts["changed"] + self.counts["unchanged"]
+        return {
+            "quiz": quiz_file,
+            "content_hash": content_hash,
+            "rows": sum(self.counts.values()),
+            "regraded": regraded,
+            "changed": self.counts["changed"],
+            "unchanged": self.counts["unchanged"],
+            "skipped": self.counts["skipped"],
+            "copied": self.counts["copied"],
+            "errors": self.counts["error"],
+            "mean_old_score": round(self.old_total / regraded, 2) if regraded else None,
+            "mean_new_score": round(self.new_total / regraded, 2) if regraded else None,
+            "score_deltas": {str(d): n for d, n in sorted(self.deltas.items())},
+            "error_samples": self.errors,
+        }
+
+
+def regrade(input_path, quiz_file, output_path, diff_path=None, only_hash="", include_untagged=False,
+            workers=None, chunk_rows=CHUNK_ROWS):
+    engine = load_grader(quiz_file)
+    options = (os.path.basename(quiz_file), only_hash, include_untagged)
+    input_meta = CsvMeta(input_path)
+    chunks = with_chunk_meta(iter_line_chunks(input_path, chunk_rows), input_meta)
+    summary = Summary()
+
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    output_meta = CsvMeta(tmp_path)
+    diff_file = open(diff_path, "w", encoding="utf-8-sig", newline="") if diff_path else None
+    try:
+        with open(tmp_path, "wb") as out:
+            out.write(codecs.BOM_UTF8)
+            if diff_file:
+                csv.writer(diff_file).writerow(DIFF_HEADER)
+            if workers == 1:
+                results = (regrade_chunk(chunk, options, engine) for chunk in chunks)
+                executor = None
+            else:
+                workers = workers or os.cpu_count() or 1
+                executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(quiz_file,))
+                results = bounded_map(executor, regrade_chunk, chunks, 2 * workers, options)
+            try:
+                for data, chunk_meta, diff_text, chunk_summary in results:
+                    offset = out.tell()
+                    out.write(data)
+                    output_meta.add([(offset + pos, record) for pos, record in chunk_meta])
+                    if diff_file:
+                        diff_file.write(diff_text)
+                    summary.merge(chunk_summary)
+            finally:
+                if executor is not None:
+                    executor.shutdown(cancel_futures=True)
+        output_meta.close()
+        if os.path.exists(output_meta.path):
+            os.replace(output_meta.path, output_path + META_SUFFIX)
+        elif os.path.exists(output_path + META_SUFFIX):
+            os.remove(output_path + META_SUFFIX)
+        os.replace(tmp_path, output_path)
+    finally:
+        input_meta.close()
+        output_meta.close()
+        if diff_file:
+            diff_file.close()
+        for path in (tmp_path, output_meta.path, output_meta.path + "-wal", output_meta.path + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+    return summary.as_dict(quiz_file, engine.quiz.content_hash)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="結果ファイルを直したクイズで採点し直す")
+    parser.add_argument("--quiz", required=True, help="採点に使うクイズファイル（直した後のもの）")
+    parser.add_argument("--input", default=RESULT_FILE)
+    parser.add_argument("--output", help="書き出すファイル（既定: <入力>.regraded.csv）")
+    parser.add_argument("--diff", help="スコアが変わった行を書き出す CSV")
+    parser.add_argument("--summary", help="集計を書き出す JSON")
+    parser.add_argument("--only-hash", default="", help="このハッシュ（前方一致）で採点された行だけを対象にする")
+    parser.add_argument("--include-untagged", action="store_true", help="クイズ情報のない古い行も対象にする")
+    parser.add_argument("--workers", type=int, help="プロセス数（既定: CPU 数、1 ならこのプロセスで処理）")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    args = parser.parse_args(argv)
+
+    output = args.output or os.path.splitext(args.input)[0] + ".regraded.csv"
+    if os.path.abspath(output) == os.path.abspath(args.input):
+        parser.error("入力ファイルには上書きできません（アプリが追記している可能性があります）")
+    summary = regrade(
+        args.input, args.quiz, output, args.diff, args.only_hash, args.include_untagged,
+        args.workers, args.chunk_rows,
+    )
+    text = json.dumps(summary, ensure_ascii=False, indent=2)
+    print(text)
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(f"{output} に書き出しました。", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,652 @@
+import atexit
+import codecs
+import collections
+import csv
+import datetime
+import io
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, replace
+
+from quiz_metrics import instrument, timed
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# クイズ結果の保存先（シンク）と、書き込みをリクエストスレッドから切り離すライタースレッド。
+# 「終了」画面ではキューに積むだけで、ディスクへの書き込みはバックグラウンドでまとめて行う。
+#
+# 環境変数で設定を切り替える:
+#   QUIZ_RESULT_BACKEND     csv（既定） / sqlite
+#   QUIZ_RESULT_PATH        保存先ファイル（既定: quiz_result.csv / quiz_result.db）
+#   QUIZ_RESULT_DURABILITY  group（既定、バッチごとに fsync） / row（1行ごとに fsync）
+#   QUIZ_RESULT_QUEUE_SIZE  キューの上限（既定: 10000）
+#   QUIZ_RESULT_RETRIES     書き込みに失敗したバッチを間隔を伸ばしながら書き直す回数（既定: 5）
+#   QUIZ_RESULT_SPILL_PATH  書き直しても保存できなかった結果の退避先（既定: 保存先 + .spill.jsonl）
+# 退避した結果は、次に保存先へ書き込めたときに書き戻す。失敗の状況は writer_status / save_error で見られる。
+
+RESULT_FILE = "quiz_result.csv"
+RESULT_DB = "quiz_result.db"
+DURABILITY_ROW = "row"
+DURABILITY_GROUP = "group"
+SPILL_SUFFIX = ".spill.jsonl"
+RETRY_ATTEMPTS = int(os.environ.get("QUIZ_RESULT_RETRIES", "5"))
+RETRY_BASE_SECONDS = 0.5
+RETRY_MAX_SECONDS = 8.0
+
+
+@dataclass(frozen=True, slots=True)
+class ResultRecord:
+    timestamp: str
+    score: int
+    answers: tuple
+    user_id: str
+    quiz: str = ""
+    quiz_hash: str = ""     # 採点に使ったクイズファイルの sha256（再採点でどの正解で採点したかを知るため）
+
+
+def _record_dict(record):
+    # 退避先（JSON Lines）に書く形
+    return {
+        "timestamp": record.timestamp,
+        "score": record.score,
+        "answers": list(record.answers),
+        "user_id": record.user_id,
+        "quiz": record.quiz,
+        "quiz_hash": record.quiz_hash,
+    }
+
+
+def _record_from_dict(data):
+    return ResultRecord(data["timestamp"], data["score"], tuple(data["answers"]), data["user_id"],
+                        data.get("quiz", ""), data.get("quiz_hash", ""))
+
+
+# CSV の列は以前のまま（タイムスタンプ, スコア, 問N の回答..., 研修ID）。
+# 行ごとのクイズ情報（クイズのパスと内容ハッシュ）は、列を足さずに隣の SQLite（<CSV>.meta.db）に
+# 行の先頭のバイト位置をキーにして持つ（CsvMeta）。
+META_SUFFIX = ".meta.db"
+META_CHUNK = 500
+
+
+def csv_header(record):
+    return ["タイムスタンプ", "スコア"] + [f"問{i+1}の回答" for i in range(len(record.answers))] + ["研修ID"]
+
+
+def csv_row(record):
+    return [record.timestamp, record.score] + list(record.answers) + [record.user_id]
+
+
+def csv_line(row):
+    # csv.writer と同じ形の1行分のバイト列
+    out = io.StringIO()
+    csv.writer(out).writerow(row)
+    return out.getvalue().encode("utf-8")
+
+
+def parse_csv_row(row):
+    # ヘッダー行や壊れた行は None を返す
+    if len(row) < 3:
+        return None
+    try:
+        score = int(row[1])
+    except ValueError:
+        return None
+    return ResultRecord(row[0], score, tuple(row[2:-1]), row[-1])
+
+
+def _parse_bytes(data):
+    # CSV の1行分（引用符の中の改行を含むこともある）のバイト列を解析する。先頭の BOM は外す
+    rows = list(csv.reader(io.StringIO(data.decode("utf-8-sig"), newline="")))
+    return parse_csv_row(rows[0]) if len(rows) == 1 else None
+
+
+def split_rows(data):
+    # 改行で終わるバイト列を CSV の行に分け、([(先頭の位置, 行のバイト列)], 使った長さ) を返す。
+    # 引用符の中の改行では区切らない（最後が引用符の途中なら、その行は使った長さに含めない）
+    rows = []
+    start = pos = 0
+    quotes = 0
+    for line in data.splitlines(keepends=True):
+        pos += len(line)
+        quotes += line.count(b'"')
+        if quotes % 2:
+            continue
+        rows.append((start, data[start:pos]))
+        start = pos
+        quotes = 0
+    return rows, start
+
+
+def bounded_map(executor, fn, items, window, *args):
+    # 結果ファイルをまとめて処理するツール（regrade_results.py / quiz_certificates.py）用。
+    # executor.map は入力を先に全部読んでしまうので、処理中のものを window 個までに抑えて順に返す
+    in_flight = collections.deque()
+    for item in items:
+        in_flight.append(executor.submit(fn, item, *args))
+        if len(in_flight) >= window:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+class CsvMeta:
+    # 結果 CSV の行ごとのクイズ情報。位置が同じでも研修IDとタイムスタンプが違えば
+    # （CSV が作り直された後の古い情報なので）使わない
+    def __init__(self, csv_path):
+        self.path = csv_path + META_SUFFIX
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rows ("
+                "pos INTEGER PRIMARY KEY, "
+                "user_id TEXT NOT NULL, "
+                "timestamp TEXT NOT NULL, "
+                "quiz TEXT NOT NULL, "
+                "quiz_hash TEXT NOT NULL)"
+            )
+        return self._conn
+
+    def add(self, rows):
+        # rows: [(位置, レコード)]。クイズ情報のないレコードは書かない
+        rows = [(pos, r.user_id, r.timestamp, r.quiz, r.quiz_hash) for pos, r in rows if r.quiz or r.quiz_hash]
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?)", rows)
+
+    def lookup(self, positions, contiguous=False):
+        # {位置: (研修ID, タイムスタンプ, クイズ, ハッシュ)}。contiguous なら最初から最後の位置までをまとめて引く
+        if not positions or not os.path.exists(self.path):
+            return {}
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            if contiguous:
+                cursor = conn.execute("SELECT * FROM rows WHERE pos BETWEEN ? AND ?", (positions[0], positions[-1]))
+                found.update((row[0], row[1:]) for row in cursor)
+            else:
+                for i in range(0, len(positions), META_CHUNK):
+                    chunk = positions[i:i + META_CHUNK]
+                    cursor = conn.execute(
+                        f"SELECT * FROM rows WHERE pos IN ({','.join('?' * len(chunk))})", chunk)
+                    found.update((row[0], row[1:]) for row in cursor)
+        return found
+
+    def attach(self, rows, contiguous=False):
+        # [(位置, レコード)] のレコードにクイズ情報を付ける
+        found = self.lookup([pos for pos, _ in rows], contiguous)
+        return [(pos, with_meta(record, found.get(pos))) for pos, record in rows]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def with_meta(record, meta):
+    # CsvMeta.lookup の値を、同じ行のものであればレコードに付ける
+    if meta is None or meta[0] != record.user_id or meta[1] != record.timestamp:
+        return record
+    return replace(record, quiz=meta[2], quiz_hash=meta[3])
+
+
+class CsvResultSink:
+    def __init__(self, path=RESULT_FILE):
+        self.path = path
+        self.meta = CsvMeta(path)
+
+    def write(self, records, sync):
+        with open(self.path, "ab") as f:
+            if fcntl is not None:
+                # 別プロセスからの追記と行が混ざらないようにする（クイズ情報も同じロックの中で書く）
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            pos = f.seek(0, os.SEEK_END)
+            if pos == 0:
+                header = codecs.BOM_UTF8 + csv_line(csv_header(records[0]))
+                f.write(header)
+                pos = len(header)
+            rows = []
+            for record in records:
+                line = csv_line(csv_row(record))
+                f.write(line)
+                rows.append((pos, record))
+                pos += len(line)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+            self.meta.add(rows)
+
+    def iter_records(self):
+        # read_rows_since を繰り返して先頭から読む（読む量はチャンクごとに一定）
+        offset = 0
+        while True:
+            rows, next_offset = self.read_rows_since(offset)
+            for _, record in rows:
+                yield record
+            if next_offset <= offset:
+                return
+            offset = next_offset
+
+    def read_since(self, offset, max_bytes=4 * 1024 * 1024):
+        # offset（バイト位置）以降の完全な行を読み、(レコード, 次の offset) を返す
+        rows, offset = self.read_rows_since(offset, max_bytes)
+        return [record for _, record in rows], offset
+
+    def read_rows_since(self, offset, max_bytes=4 * 1024 * 1024):
+        # read_since と同じだが、各行の先頭のバイト位置も返す: ([(位置, レコード)], 次の offset)
+        if not os.path.exists(self.path):
+            return [], 0
+        with open(self.path, "rb") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+            if os.fstat(f.fileno()).st_size < offset:
+                # ファイルが作り直された
+                offset = 0
+            f.seek(offset)
+            data = f.read(max_bytes)
+            end = data.rfind(b"\n") + 1
+            while end == 0 and len(data) == max_bytes:
+                # 1行が max_bytes より長い
+                more = f.read(max_bytes)
+                if not more:
+                    break
+                data += more
+                end = data.rfind(b"\n") + 1
+        lines, used = split_rows(data[:end])
+        rows = []
+        for start, line in lines:
+            record = _parse_bytes(line)
+            if record is not None:
+                rows.append((offset + start, record))
+        # 読んだ範囲の最後が引用符の途中なら、その行は次に回す
+        return self.meta.attach(rows, contiguous=True), offset + used
+
+    def read_at(self, offsets):
+        # read_rows_since が返した位置の行を読む（読めない位置は飛ばす）
+        if not offsets or not os.path.exists(self.path):
+            return []
+        rows = []
+        with open(self.path, "rb") as f:
+            for offset in offsets:
+                f.seek(offset)
+                data = f.readline()
+                while data.count(b'"') % 2:
+                    line = f.readline()
+                    if not line:
+                        break
+                    data += line
+                record = _parse_bytes(data)
+                if record is not None:
+                    rows.append((offset, record))
+        return [record for _, record in self.meta.attach(rows)]
+
+    def close(self):
+        self.meta.close()
+
+
+class SqliteResultSink:
+    def __init__(self, path=RESULT_DB):
+        self.path = path
+        # 接続はライタースレッドの中で作る
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "timestamp TEXT NOT NULL, "
+                "score INTEGER NOT NULL, "
+                "answers TEXT NOT NULL, "
+                "user_id TEXT NOT NULL, "
+                "quiz TEXT NOT NULL DEFAULT '', "
+                "quiz_hash TEXT NOT NULL DEFAULT '')"
+            )
+            if "quiz_hash" not in _columns(self._conn):
+                # quiz_hash 列がなかった頃のデータベース
+                self._conn.execute("ALTER TABLE results ADD COLUMN quiz_hash TEXT NOT NULL DEFAULT ''")
+        return self._conn
+
+    def write(self, records, sync):
+        conn = self._connect()
+        conn.execute("PRAGMA synchronous=" + ("FULL" if sync else "NORMAL"))
+        with conn:
+            conn.executemany(
+                "INSERT INTO results (timestamp, score, answers, user_id, quiz, quiz_hash) VALUES (?, ?, ?, ?, ?, ?)",
+                [(r.timestamp, r.score, json.dumps(list(r.answers), ensure_ascii=False), r.user_id, r.quiz, r.quiz_hash)
+                 for r in records],
+            )
+
+    def iter_records(self):
+        if not os.path.exists(self.path):
+            return
+        # 読み出しは書き込み用とは別の接続で行う（WALなので書き込みを止めない）
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            cursor = conn.execute(
+                f"SELECT timestamp, score, answers, user_id, quiz, {_hash_column(conn)} FROM results ORDER BY id"
+            )
+            for row in cursor:
+                yield _sqlite_record(row)
+        finally:
+            conn.close()
+
+    def read_since(self, last_id, limit=10000):
+        # id が last_id より大きい行を読み、(レコード, 次の last_id) を返す
+        rows, last_id = self.read_rows_since(last_id, limit)
+        return [record for _, record in rows], last_id
+
+    def read_rows_since(self, last_id, limit=10000):
+        # read_since と同じだが、各行の id も返す: ([(id, レコード)], 次の last_id)
+        if not os.path.exists(self.path):
+            return [], 0
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            rows = conn.execute(
+                f"SELECT id, timestamp, score, answers, user_id, quiz, {_hash_column(conn)} "
+                "FROM results WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, limit),
+            ).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return [], last_id
+        return [(row[0], _sqlite_record(row[1:])) for row in rows], rows[-1][0]
+
+    def read_at(self, ids):
+        # read_rows_since が返した id の行を読む
+        if not ids or not os.path.exists(self.path):
+            return []
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            records = []
+            # SQLite のパラメータ数の上限を超えないよう分けて読む
+            for i in range(0, len(ids), 500):
+                part = ids[i:i + 500]
+                rows = conn.execute(
+                    f"SELECT timestamp, score, answers, user_id, quiz, {_hash_column(conn)} "
+                    f"FROM results WHERE id IN ({', '.join('?' * len(part))}) ORDER BY id",
+                    part,
+                ).fetchall()
+                records.extend(map(_sqlite_record, rows))
+        finally:
+            conn.close()
+        return records
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def _sqlite_record(row):
+    timestamp, score, answers, user_id, quiz, quiz_hash = row
+    return ResultRecord(timestamp, score, tuple(json.loads(answers)), user_id, quiz, quiz_hash)
+
+
+def _columns(conn):
+    return {row[1] for row in conn.execute("PRAGMA table_info(results)")}
+
+
+def _hash_column(conn):
+    # 読み取り専用の接続では列を足せないので、古いデータベースでは空文字を返す
+    return "quiz_hash" if "quiz_hash" in _columns(conn) else "'' AS quiz_hash"
+
+
+_STOP = object()
+
+
+class ResultWriter:
+    def __init__(self, sink, durability=DURABILITY_GROUP, max_queue=10000, batch_size=256, flush_interval=0.2,
+                 name="result", retries=RETRY_ATTEMPTS, spill_path=None):
+        if durability not in (DURABILITY_ROW, DURABILITY_GROUP):
+            raise ValueError(f"未知の durability です: {durability}")
+        self.sink = sink
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.name = name            # スレッド名と計測の区間名に使う
+        self.dropped = 0            # block=False で受け付けられなかった件数
+        self.retries = retries
+        self.spill_path = spill_path    # None なら書き直しても保存できなかったバッチは捨てる（操作ログなど）
+        self.failed_batches = 0     # 1回でも書き込みに失敗したバッチの数
+        self.spilled = 0            # 退避先に書いたまま、まだ書き戻していない件数
+        self.lost = 0               # 退避もできずに失われた件数
+        self.last_error = ""
+        self.failing = False        # 直近の書き込みが失敗したまま（成功すれば戻る）
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._listeners = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"{name}-writer", daemon=True)
+        self._thread.start()
+
+    def add_listener(self, listener):
+        # 書き込みが確定したレコードのリストを受け取る関数を登録する（ライタースレッドで呼ばれる）
+        self._listeners.append(listener)
+
+    def submit(self, record, block=True):
+        if self._closed:
+            raise RuntimeError("ResultWriter は既に閉じられています")
+        if block:
+            # キューが一杯のときは待つ（結果は捨てない）
+            self._queue.put(record)
+            return True
+        # 捨ててもよいもの（操作ログなど）は、キューが一杯なら待たずに諦める
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        # 前回のプロセスで退避したままの結果があれば先に書き戻す
+        self._restore_spilled()
+        stop = False
+        while not stop:
+            batch = []
+            item = self._queue.get()
+            # group の場合は flush_interval の間に届いたものを1回の fsync にまとめる
+            window = self.flush_interval if self.durability == DURABILITY_GROUP else 0
+            deadline = time.monotonic() + window
+            while True:
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+            if stop:
+                # シンクの接続はライタースレッドで作ったものなので、ここで閉じる
+                self.sink.close()
+            for _ in range(len(batch) + (1 if stop else 0)):
+                self._queue.task_done()
+
+    def _write_once(self, batch):
+        with timed(f"{self.name}_write"):
+            if self.durability == DURABILITY_ROW:
+                for record in batch:
+                    self.sink.write([record], sync=True)
+            else:
+                self.sink.write(batch, sync=True)
+
+    def _write(self, batch):
+        # ロックされている・ディスクが一杯などで失敗したら、間隔を伸ばしながら書き直す。
+        # それでも書けなければ退避先に残す（結果は捨てない）
+        delay = RETRY_BASE_SECONDS
+        for attempt in range(self.retries + 1):
+            try:
+                self._write_once(batch)
+                break
+            except Exception as e:
+                if attempt == 0:
+                    self.failed_batches += 1
+                self.failing = True
+                self.last_error = f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S} {e}"
+                print(f"{self.name}: {len(batch)}件の保存に失敗しました（{attempt + 1}回目）: {e}")
+                if attempt < self.retries and not self._closed:
+                    time.sleep(delay)
+                    delay = min(delay * 2, RETRY_MAX_SECONDS)
+        else:
+            self._spill(batch)
+            return
+        self.failing = False
+        self._notify(batch)
+        if self.spilled:
+            self._restore_spilled()
+
+    def _spill(self, batch):
+        if self.spill_path is None:
+            self.lost += len(batch)
+            return
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for record in batch:
+                    f.write(json.dumps(_record_dict(record), ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.spilled += len(batch)
+            print(f"{self.name}: {len(batch)}件を {self.spill_path} に退避しました")
+        except OSError as e:
+            self.lost += len(batch)
+            self.last_error = f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S} 退避にも失敗しました: {e}"
+            print(f"{self.name}: {len(batch)}件の結果を退避できませんでした: {e}")
+
+    def _restore_spilled(self):
+        # 退避先の結果を保存先に書き戻す。書けなければ退避先に残して次の機会に回す
+        if self.spill_path is None or not os.path.exists(self.spill_path):
+            return
+        try:
+            with open(self.spill_path, encoding="utf-8") as f:
+                records = [_record_from_dict(json.loads(line)) for line in f if line.strip()]
+            if records:
+                self._write_once(records)
+            os.remove(self.spill_path)
+        except Exception as e:
+            self.failing = True
+            self.last_error = f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S} 退避した結果を書き戻せませんでした: {e}"
+            print(f"{self.name}: 退避した結果を書き戻せませんでした: {e}")
+            return
+        self.spilled = 0
+        if records:
+            print(f"{self.name}: 退避していた{len(records)}件を書き戻しました")
+            self._notify(records)
+
+    def status(self):
+        return {
+            "failing": self.failing,
+            "failed_batches": self.failed_batches,
+            "spilled": self.spilled,
+            "lost": self.lost,
+            "dropped": self.dropped,
+            "last_error": self.last_error,
+            "spill_path": self.spill_path,
+        }
+
+    def _notify(self, batch):
+        for listener in self._listeners:
+            try:
+                listener(batch)
+            except Exception as e:
+                print(f"結果リスナーでエラーが発生しました: {e}")
+
+
+def make_sink(backend=None, path=None):
+    backend = backend or os.environ.get("QUIZ_RESULT_BACKEND", "csv")
+    path = path or os.environ.get("QUIZ_RESULT_PATH")
+    if backend == "csv":
+        return CsvResultSink(path or RESULT_FILE)
+    if backend == "sqlite":
+        return SqliteResultSink(path or RESULT_DB)
+    raise ValueError(f"未知の結果保存先です: {backend}")
+
+
+_writer = None
+_writer_lock = threading.Lock()
+_result_listeners = []
+
+
+def add_result_listener(listener):
+    # get_writer のライターに登録するリスナー（ライターがまだなければ作ったときに登録する）
+    with _writer_lock:
+        _result_listeners.append(listener)
+        if _writer is not None:
+            _writer.add_listener(listener)
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                sink = make_sink()
+                _writer = ResultWriter(
+                    sink,
+                    durability=os.environ.get("QUIZ_RESULT_DURABILITY", DURABILITY_GROUP),
+                    max_queue=int(os.environ.get("QUIZ_RESULT_QUEUE_SIZE", "10000")),
+                    spill_path=os.environ.get("QUIZ_RESULT_SPILL_PATH") or sink.path + SPILL_SUFFIX,
+                )
+                for listener in _result_listeners:
+                    _writer.add_listener(listener)
+                atexit.register(_writer.close)
+    return _writer
+
+
+@instrument("save_result")
+def save_result(score, answers, user_id, quiz="", quiz_hash=""):
+    # 積んだレコードを返す（修了証など、同じタイムスタンプで結果と対応づけたいもの向け）
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    record = ResultRecord(timestamp, score, tuple(answers), user_id, quiz, quiz_hash)
+    get_writer().submit(record)
+    return record
+
+
+def writer_status():
+    # 管理画面向け。ライターをまだ作っていなければ None
+    return _writer.status() if _writer is not None else None
+
+
+def save_error():
+    # 結果の保存が失敗し続けているか、退避したまま書き戻せていない結果があれば、画面に出す文言を返す
+    status = writer_status()
+    if status is None:
+        return None
+    if status["lost"]:
+        return f"{status['lost']}件の結果を保存できませんでした。管理者に連絡してください。"
+    if status["failing"] or status["spilled"]:
+        return "結果の保存に失敗しています（一時的に退避しています）。管理者に連絡してください。"
+    return None
@@ -1,61 +1,94 @@
 import streamlit as st
-import json
-import datetime
-import csv
-import os
-
-def load_quiz_data(json_path):
-    with open(json_path, "r", encoding="utf-8") as f:
-        quiz_data = json.load(f)
-    return quiz_data
-
-def save_result(score, answers, user_id):
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    output_header = ["タイムスタンプ", "スコア"] + [f"問{i+1}の回答" for i in range(len(answers))] + ["研修ID"]
-    output_row = [timestamp, score] + answers + [user_id]
-    file_exists = os.path.exists("quiz_result.csv")
-    with open("quiz_result.csv", "a", encoding="utf-8-sig", newline="") as f:
-        writer = csv.writer(f)
-        if not file_exists:
-            writer.writerow(output_header)
-        writer.writerow(output_row)
-
-def get_rank(score):
-    if score == 100:
-        return "マスター"
-    elif score >= 80:
-        return "上級者"
-    elif score >= 60:
-        return "中級者"
-    elif score >= 40:
-        return "初級者"
-    elif score >= 20:
-        return "初心者"
-    else:
-        return "入門者"
-
-def get_rank_emoji(rank):
-    if rank == "マスター":
-        return "🏆"
-    elif rank == "上級者":
-        return "🥈"
-    elif rank == "中級者":
-        return "🥉"
-    elif rank == "初級者":
-        return "🌱"
-    elif rank == "初心者":
-        return "🔰"
-    else:  # 入門者
-        return "🚩"
-
-def main():
-    quiz_file = "quiz_data_v4.json"
+from admin_pages import show_admin_pages
+from banner_assets import show_banner
+from quiz_bank import is_bank_spec, load_bank_engine
+from quiz_certificates import request_certificate
+from quiz_engine import FINISH, SHAPE_RULES, load_engine
+from quiz_metrics import instrument, rerun_finished
+from quiz_outbox import SURVEY_URL, notify_result, survey_link
+from quiz_session import (
+    advance, get_session, mark_result_saved, rerun_after_transition, rerun_page, reset_session, submit_answer,
+    transition_token,
+)
+from result_store import save_error, save_result
+
+RULES = SHAPE_RULES["questions"]
+
+def load_quiz_data(json_path, user_id=""):
+    # 遷移表にコンパイル済みのクイズ（プロセス内でキャッシュ済み）
+    # 問題バンクの設定ファイルなら、受講者ごとにバンクから抽選した問題で作る
+    if is_bank_spec(json_path):
+        return load_bank_engine(json_path, user_id, RULES)
+    return load_engine(json_path, RULES)
+
+@st.fragment
+@instrument("question_render")
+def show_question_panel(engine, session):
+    # 問題の表示部分。チェックボックスや回答ボタンの操作ではここだけが再実行される
+    rerun_finished()
+    step = engine.current(session)
+    score = session.score
+    current_q = step.question
+    answered = engine.answered(session)
+    # ボタンのキーに入れて、連打や古い画面からの操作を採点の前に捨てる
+    token = transition_token(session)
+    q = engine.question(step)
+    st.subheader("".join(q.section_title))
+    for line in q.question_text:
+        st.markdown(line)
+
+    last_selected = engine.selected(session)
+    selected = []
+    for choice in q.choices:
+        if st.checkbox(
+            choice,
+            value=(choice in last_selected),
+            key=f"chk_{current_q}_{choice}"
+        ):
+            selected.append(choice)
+
+    if not answered:
+        if st.button("回答する", key=f"btn_{current_q}_{token}"):
+            if submit_answer(engine, session, q.mask(selected), token) is not None:
+                rerun_after_transition(engine, session)
+
+    if answered:
+        st.markdown('---')
+        last_correct = engine.last_correct(session)
+        st.markdown("**✅ 正解！**" if last_correct else "**❌ 不正解**")
+        if q.correct_list:
+            correct_str = "」「".join(q.correct_list)
+            st.markdown(f'正解は「{correct_str}」です。')
+        feedback = q.feedback_correct if last_correct else q.feedback_incorrect
+        st.markdown(
+            "<div style='line-height:1.2;'>"
+            + "<br>".join(feedback) +
+            "</div>",
+            unsafe_allow_html=True
+        )
+        # 空行を入れる
+        st.markdown("<br>", unsafe_allow_html=True)
+
+        current_rank, _ = engine.rank(score)
+        if current_rank != engine.rank(engine.score_before(session))[0]:
+            st.markdown(f"スコア：{score}点　ランク：{current_rank} 🎉（ランクアップ）")
+        else:
+            st.markdown(f"スコア：{score}点　ランク：{current_rank}")
+
+        if st.button("次へ", key=f"next_{token}"):
+            if advance(engine, session, token):
+                rerun_after_transition(engine, session)
+
+def main(quiz_file="quiz_data_v4.json"):
     banner_file = "cyber_banner.jpg"
-    quiz_data = load_quiz_data(quiz_file)
+
+    # 管理者用画面（?admin=1）と講師用のライブモニター（?admin=live）
+    if show_admin_pages():
+        return
 
     st.title("サイバー衛生レベルアップクイズ")
     st.markdown("入門者からスタートし、正解するごとにレベルアップ！目指せマスター！")
-    st.image(banner_file, width="stretch")
+    show_banner(banner_file)
 
 
     params = st.query_params
@@ -68,39 +101,15 @@ def main():
         st.warning("研修IDが必要です")
         return
 
-    if "score" not in st.session_state:
-        st.session_state["score"] = 0
-    if "answers" not in st.session_state:
-        st.session_state["answers"] = []
-    if "current_q" not in st.session_state:
-        st.session_state["current_q"] = 0
-    if "answered" not in st.session_state:
-        st.session_state["answered"] = False
-    if "last_feedback" not in st.session_state:
-        st.session_state["last_feedback"] = ""
-    if "last_selected" not in st.session_state:
-        st.session_state["last_selected"] = []
-    if "last_judgement" not in st.session_state:
-        st.session_state["last_judgement"] = ""
-    if "last_correct" not in st.session_state:
-        st.session_state["last_correct"] = []
-    if "result_saved" not in st.session_state:
-        st.session_state["result_saved"] = False
-    if "previous_rank" not in st.session_state:
-        st.session_state["previous_rank"] = get_rank(0)
-
-    score = st.session_state["score"]
-    answers = st.session_state["answers"]
-    current_q = st.session_state["current_q"]
-    answered = st.session_state["answered"]
-    last_feedback = st.session_state["last_feedback"]
-    last_selected = st.session_state["last_selected"]
-    result_saved = st.session_state["result_saved"]
-
-    questions = quiz_data.get("questions", [])
-    if current_q >= len(questions):
-        rank = get_rank(score)
-        emoji = get_rank_emoji(rank)
+    latest = load_quiz_data(quiz_file, user_id)
+    session = get_session(latest, user_id)
+    # 受講中にクイズが更新されても、開始したときの版で最後まで進める
+    engine = session.engine
+    step = engine.current(session)
+    score = session.score
+
+    if step.kind == FINISH:
+        rank, emoji = engine.rank(score)
 
         st.markdown(f"**あなたのランク：{rank} {emoji}**")
         st.markdown(f"**最終スコア：{score}点**")
@@ -116,96 +125,30 @@ def main():
         else:
             st.warning("再チャレンジして、マスターを目指しましょう！")
             if st.button("再チャレンジ"):
-                st.session_state.clear()
-                st.session_state["current_q"] = 0
-                st.session_state["answered"] = False
-                st.session_state["last_feedback"] = ""
-                st.session_state["last_selected"] = []
-                st.session_state["last_judgement"] = ""
-                st.session_state["last_correct"] = []
-                st.rerun()
-
-        if not result_saved:
-            save_result(score, answers, user_id)
-            st.session_state["result_saved"] = True
+                reset_session(latest, user_id)
+                rerun_page()
+
+        if not session.result_saved:
+            record = save_result(score, engine.answer_texts(session), user_id, quiz=quiz_file, quiz_hash=engine.quiz.content_hash)
+            title = engine.quiz.title[0] if engine.quiz.title else ""
+            # 合格なら修了証をワーカーで作る（ここではキューに積むだけ）
+            request_certificate(record, title)
+            # LMS・アンケートへの通知もアウトボックスに書くだけで、送信は待たない
+            notify_result(record, title)
+            mark_result_saved(engine, session)
+        error = save_error()
+        if error:
+            st.error(error)
 
         st.markdown("---")
         st.markdown("📋 **事後アンケートにご協力ください**")
-        st.markdown("アンケートページ（ダミー）")
-        return
-
-    q = questions[current_q]
-    st.subheader(q.get("section_title", f"第{current_q+1}問"))
-    question_text = q.get("question_text", "")
-    if isinstance(question_text, list):
-        for line in question_text:
-            st.markdown(line)
-    else:
-        st.markdown(question_text)
-
-    selected = []
-    for choice in q.get("choices", []):
-        if st.checkbox(
-            choice["text"],
-            value=(choice["text"] in last_selected if answered else False),
-            key=f"chk_{current_q}_{choice['text']}"
-        ):
-            selected.append(choice["text"])
-
-    if not answered:
-        if st.button("回答する", key=f"btn_{current_q}"):
-            correct = [c["text"] for c in q.get("choices", []) if c.get("is_correct")]
-            if set(selected) == set(correct) and selected:
-                st.session_state["last_judgement"] = "**✅ 正解！**"
-                st.session_state["last_feedback"] = q.get("feedback_correct", "")
-                score += q.get("score_correct", 20)
-            else:
-                st.session_state["last_judgement"] = "**❌ 不正解**"
-                st.session_state["last_feedback"] = q.get("feedback_incorrect", "")
-                score += q.get("score_incorrect", 0)
-            st.session_state["last_correct"] = correct
-            st.session_state["score"] = score
-            answers.append(", ".join(selected))
-            st.session_state["answers"] = answers
-            st.session_state["answered"] = True
-            st.session_state["last_selected"] = selected
-            st.rerun()
-
-    if answered:
-        st.markdown('---')
-        st.markdown(st.session_state.get("last_judgement", ""))
-        correct_choices = st.session_state.get("last_correct", [])
-        if correct_choices:
-            correct_str = "」「".join(correct_choices)
-            st.markdown(f'正解は「{correct_str}」です。')
-        feedback = st.session_state["last_feedback"]
-        if isinstance(feedback, list):
-            st.markdown(
-                "<div style='line-height:1.2;'>"
-                + "<br>".join(feedback) +
-                "</div>",
-                unsafe_allow_html=True
-            )
+        if SURVEY_URL:
+            st.markdown(f"[アンケートに回答する]({survey_link(SURVEY_URL, user_id, score)})")
         else:
-            st.markdown(feedback)
-        # 空行を入れる
-        st.markdown("<br>", unsafe_allow_html=True)
+            st.markdown("アンケートページ（ダミー）")
+        return
 
-        current_rank = get_rank(score)
-        if current_rank != st.session_state["previous_rank"]:
-            st.markdown(f"スコア：{score}点　ランク：{current_rank} 🎉（ランクアップ）")
-        else:
-            st.markdown(f"スコア：{score}点　ランク：{current_rank}")
-        st.session_state["previous_rank"] = current_rank
-
-        if st.button("次へ"):
-            st.session_state["current_q"] = current_q + 1
-            st.session_state["answered"] = False
-            st.session_state["last_feedback"] = ""
-            st.session_state["last_selected"] = []
-            st.session_state["last_judgement"] = ""
-            st.session_state["last_correct"] = []
-            st.rerun()
+    show_question_panel(engine, session)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file